@@ -1,13 +1,12 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
-## TODO - log this function
-
 import sys, argparse, logging
-import pandas as pd
 
-from pymatgen.electronic_structure.plotter import BSPlotter
-from pymatgen.io.vasp import BSVasprun
+import numpy as np
+
+from compressed import iterparse, find_file
+import profiling
 
 # Adopted format: level - current function name - mess. Width is fixed as visual aid
 c_log = logging.getLogger(__name__)
@@ -15,14 +14,120 @@ std_format = '[%(levelname)5s - %(funcName)10s] %(message)s'
 logging.basicConfig(format=std_format)
 c_log.setLevel(logging.WARNING)
 
-def band_from_vasprun(vasprun: BSVasprun) -> int:
+
+def _varray(elem) -> np.ndarray:
+    return np.array([[float(x) for x in v.text.split()] for v in elem.iter("v")])
+
+
+def stream_eigenvalues(filename: str = "vasprun.xml") -> dict:
+    """
+    Streams a vasprun.xml keeping only the k-point list, weights, reciprocal lattice, fermi level and the
+    eigenvalues / occupations of the last ionic step, which go straight into preallocated
+    (spin x kpoint x band) arrays. Nothing else in the file is kept in memory.
+    """
+    data = {"kpoints": None, "weights": None, "rec_lattice": None, "efermi": None}
+    nbands, ispin = None, 1
+    eigen = occu = None
+    stack = []
+    spin = kpt = band = -1
+
+    for event, elem in iterparse(filename, events=("start", "end")):
+        if event == "start":
+            stack.append(elem.tag)
+            if elem.tag == "eigenvalues" and len(stack) > 1 and stack[-2] == "calculation":
+                if eigen is None:
+                    eigen = np.zeros((ispin, len(data["kpoints"]), nbands))
+                    occu = np.zeros_like(eigen)
+                spin = kpt = -1
+            elif elem.tag == "set" and "eigenvalues" in stack and "projected" not in stack:
+                comment = elem.get("comment", "")
+                if comment.startswith("spin"):
+                    spin, kpt = int(comment.split()[-1]) - 1, -1
+                elif comment.startswith("kpoint"):
+                    kpt, band = int(comment.split()[-1]) - 1, 0
+            continue
+
+        stack.pop()
+        tag = elem.tag
+        if tag == "r" and eigen is not None and kpt >= 0 and stack and stack[-1] == "set":
+            if "eigenvalues" in stack and "projected" not in stack:
+                e, o = elem.text.split()[:2]
+                eigen[spin, kpt, band], occu[spin, kpt, band] = float(e), float(o)
+                band += 1
+        elif tag == "varray" and stack and stack[-1] == "kpoints":
+            if elem.get("name") == "kpointlist":
+                data["kpoints"] = _varray(elem)
+            elif elem.get("name") == "weights":
+                data["weights"] = _varray(elem)[:, 0]
+        elif tag == "varray" and elem.get("name") == "rec_basis":
+            data["rec_lattice"] = _varray(elem)  # Last structure in the file wins
+        elif tag == "i" and elem.get("name") == "NBANDS" and nbands is None:
+            nbands = int(elem.text)
+        elif tag == "i" and elem.get("name") == "ISPIN" and "parameters" in stack:
+            ispin = int(elem.text)
+        elif tag == "i" and elem.get("name") == "efermi":
+            data["efermi"] = float(elem.text)
+        elif tag == "eigenvalues" and stack and stack[-1] == "calculation":
+            kpt = -1
+        if tag in ("set", "calculation", "kpoints", "structure", "parameters", "projected", "dos"):
+            elem.clear()  # Drop what has been read so memory stays flat through the file
+
+    if eigen is None:
+        raise ValueError(f"No <eigenvalues> block found in {filename}")
+    data["eigenvalues"], data["occupations"] = eigen, occu
+    return data
+
+
+def band_edges(eigenvalues: np.ndarray, occupations: np.ndarray, occu_tol: float = 1e-8) -> dict:
+    """
+    Band gap, VBM / CBM and the band edge k-point indices from (spin x kpoint x band) arrays,
+    using the same occupation rule as pymatgen's eigenvalue_band_properties.
+    """
+    occupied = occupations > occu_tol
+    vbm_k = np.where(occupied, eigenvalues, -np.inf).max(axis=(0, 2))  # Highest occupied level per kpoint
+    cbm_k = np.where(~occupied, eigenvalues, np.inf).min(axis=(0, 2))  # Lowest empty level per kpoint
+
+    vbm_idx, cbm_idx = int(np.argmax(vbm_k)), int(np.argmin(cbm_k))
+    vbm, cbm = vbm_k[vbm_idx], cbm_k[cbm_idx]
+    direct = cbm_k - vbm_k
+    return {"vbm": vbm, "cbm": cbm, "gap": max(cbm - vbm, 0.0),
+            "vbm_kpoint": vbm_idx, "cbm_kpoint": cbm_idx,
+            "direct_gap": max(direct.min(), 0.0), "direct_kpoint": int(np.argmin(direct)),
+            "is_direct": vbm_idx == cbm_idx}
+
+
+def kpoint_distances(kpoints: np.ndarray, rec_lattice: np.ndarray) -> np.ndarray:
     """
-    Useful docstring. This is called from argparse so make it clear;
-    i.e multiples 3 numbers and returns thew output
+    Cumulative cartesian distance along the k-path (1/Angstrom, with the 2 pi) for plotting line mode runs.
     """
-    bandstructure = vasprun.get_band_structure()
-    b = BSPlotter(bs=bandstructure)
-    return x  # Try to return the pymatgen format here so it can still be used as a function
+    cart = np.dot(kpoints, rec_lattice * 2 * np.pi)
+    return np.concatenate(([0.0], np.cumsum(np.linalg.norm(np.diff(cart, axis=0), axis=1))))
+
+
+def band_from_vasprun(vasprun: str = "vasprun.xml") -> dict:
+    """
+    Band structure extractor that streams only the eigenvalue and kpoint blocks out of a vasprun.xml.
+    Returns the (spin x kpoint x band) eigenvalues / occupations, the kpoints, their path distance and the
+    band gap, VBM / CBM and band edge k-points.
+    """
+    data = stream_eigenvalues(vasprun)
+    data.update(band_edges(data["eigenvalues"], data["occupations"]))
+    if data["rec_lattice"] is not None:
+        data["kdist"] = kpoint_distances(data["kpoints"], data["rec_lattice"])
+    c_log.info(f"{data['eigenvalues'].shape} (spin, kpoint, band) eigenvalues read")
+    return data
+
+
+def bands_to_table(data: dict) -> str:
+    """
+    Plain text table, one row per kpoint: distance then every band (spin up bands first, then spin down)
+    """
+    eigen = data["eigenvalues"]
+    kdist = data.get("kdist", np.arange(eigen.shape[1], dtype=float))
+    table = np.column_stack([kdist] + [eigen[s] for s in range(eigen.shape[0])])
+    lines = [f"# kdist  bands(spin x band = {eigen.shape[0]} x {eigen.shape[2]})  efermi = {data['efermi']}"]
+    lines.extend(" ".join(f"{x:10.5f}" for x in row) for row in table)
+    return "\n".join(lines)
 
 
 def cli_run(argv) -> None:
@@ -33,11 +138,13 @@ def cli_run(argv) -> None:
     global c_log
 
     parser = argparse.ArgumentParser(description=band_from_vasprun.__doc__)  # Parser init
-    parser.add_argument("vasprun", type=str, default="vasprun.xml", help="vasprun file location")
-    parser.add_argument("--optional", dest="optional", type=int, default=4, help="OptionalArgument")
+    parser.add_argument("vasprun", type=str, default="vasprun.xml", nargs="?", help="vasprun file location")
+    parser.add_argument("-o", "--output", dest="output", type=str, default=None,
+                        help="Write the bands out, .npz for arrays anything else for a text table")
     parser.add_argument("--debug", dest="debug", action="store_true")  # Always have the debug optional
     parser.add_argument("--verbose", dest="verbose", action="store_true")  # Always have the verbose optional
 
+    profiling.add_profile_argument(parser)
     args = parser.parse_args(argv)
 
     if args.debug:  # Always include method for switching verbosity
@@ -45,9 +152,27 @@ def cli_run(argv) -> None:
     if args.verbose:
         c_log.setLevel(logging.INFO)
     c_log.debug(args)
+    profiling.start(args.profile)
+    args.vasprun = find_file(args.vasprun) or args.vasprun  # vasprun.xml.gz etc when there is no plain file
+
+    with profiling.phase("parse+analyse"):
+        data = band_from_vasprun(args.vasprun)
+    k = data["kpoints"]
+    print(f"Band gap: {data['gap']:.4f} eV ({'direct' if data['is_direct'] else 'indirect'})\n"
+          f"Direct gap: {data['direct_gap']:.4f} eV at k {np.round(k[data['direct_kpoint']], 4)}\n"
+          f"VBM: {data['vbm']:.4f} eV at k {np.round(k[data['vbm_kpoint']], 4)}\n"
+          f"CBM: {data['cbm']:.4f} eV at k {np.round(k[data['cbm_kpoint']], 4)}\n"
+          f"Fermi level: {data['efermi']}")
 
-    vasprun = BSVasprun(filename=args.vasprun)
+    if args.output is not None:
+        with profiling.phase("write"):
+            if args.output.endswith(".npz"):
+                np.savez_compressed(args.output, **{k: v for k, v in data.items() if v is not None})
+            else:
+                with open(args.output, "w") as f:
+                    f.write(bands_to_table(data) + "\n")
+    profiling.report()
 
 
 if __name__ == "__main__":
-    cli_run(sys.argv[1:])
\ No newline at end of file
+    cli_run(sys.argv[1:])
@@ -0,0 +1,439 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import sys, argparse, logging, os, json, time, platform, statistics, tempfile, io, contextlib
+
+import numpy as np
+
+# Adopted format: level - current function name - mess. Width is fixed as visual aid
+c_log = logging.getLogger(__name__)
+std_format = '[%(levelname)5s - %(funcName)10s] %(message)s'
+logging.basicConfig(format=std_format)
+c_log.setLevel(logging.WARNING)
+
+TOOLS_DIR = os.path.dirname(os.path.realpath(__file__))
+FIXTURES = os.path.join(TOOLS_DIR, "tests")
+
+# Case name -> {"setup": f(size, workdir) -> zero argument callable, "sizes": {tier: [sizes]}}
+# A size of None means the tests/ fixture as is, anything else is a synthetic input of that size
+CASES = {}
+TIERS = ("fixture", "small", "large")
+
+
+def benchmark(name: str, small=(), large=()):
+    """
+    Registers a benchmark case. The decorated setup builds (or reuses) the input for a size and returns the
+    callable that gets timed, so input generation never counts towards the timing.
+    """
+    def register(setup):
+        CASES[name] = {"setup": setup, "sizes": {"fixture": [None], "small": list(small), "large": list(large)}}
+        return setup
+    return register
+
+
+# ---- Synthetic inputs, written once into workdir and reused across runs ---- #
+
+def synthetic_structure(n_atoms: int, poscar: str = "POSCAR"):
+    """
+    Fixture structure tiled into the smallest k x k x k supercell holding at least n_atoms sites.
+    """
+    from pymatgen.core import Structure
+    structure = Structure.from_file(os.path.join(FIXTURES, poscar))
+    k = int(np.ceil((n_atoms / len(structure)) ** (1 / 3)))
+    structure.make_supercell([k, k, k])
+    return structure
+
+
+def synthetic_chgcar(grid: int, workdir: str) -> str:
+    """
+    Spin polarised CHGCAR on a grid^3 mesh (grid 500 is ~2.5 GB of text).
+    """
+    filename = os.path.join(workdir, f"CHGCAR_{grid}")
+    if not os.path.exists(filename):
+        from pymatgen.core import Structure
+        from pymatgen.io.vasp import Chgcar, Poscar
+        rng = np.random.default_rng(0)
+        data = {"total": rng.random((grid, grid, grid)), "diff": rng.random((grid, grid, grid)) - 0.5}
+        Chgcar(Poscar(Structure.from_file(os.path.join(FIXTURES, "POSCAR"))), data).write_file(filename)
+    return filename
+
+
+def synthetic_outcar(n_steps: int, workdir: str) -> str:
+    """
+    The fixture OUTCAR repeated n_steps times, i.e an n_steps ionic relaxation (1000 steps is ~1.3 GB)
+    """
+    filename = os.path.join(workdir, f"OUTCAR_{n_steps}")
+    if not os.path.exists(filename):
+        with open(os.path.join(FIXTURES, "OUTCAR"), "rb") as f:
+            body = f.read()
+        with open(filename, "wb") as f:
+            for _ in range(n_steps):
+                f.write(body)
+    return filename
+
+
+def synthetic_vasprun(n_kpoints: int, workdir: str, n_bands: int = 64, n_ions: int = 8) -> str:
+    """
+    Minimal spin polarised vasprun.xml with eigenvalues and a projected block, enough for the band / DOS readers.
+    """
+    filename = os.path.join(workdir, f"vasprun_{n_kpoints}.xml")
+    if os.path.exists(filename):
+        return filename
+    rng = np.random.default_rng(0)
+    fields = ["s", "py", "pz", "px", "dxy", "dyz", "dz2", "dxz", "x2-y2"]
+    with open(filename, "w") as f:
+        f.write('<?xml version="1.0" encoding="ISO-8859-1"?>\n<modeling>\n<kpoints>\n<varray name="kpointlist">\n')
+        f.write("".join(f"<v> {k / n_kpoints:.8f} 0.00000000 0.00000000 </v>\n" for k in range(n_kpoints)))
+        f.write('</varray>\n<varray name="weights">\n' + f"<v> {1 / n_kpoints:.10f} </v>\n" * n_kpoints)
+        f.write('</varray>\n</kpoints>\n<parameters>\n'
+                f'<i type="int" name="NBANDS"> {n_bands} </i>\n<i type="int" name="ISPIN"> 2 </i>\n</parameters>\n')
+        f.write('<atominfo>\n<array name="atoms">\n<set>\n' + "<rc><c>Li</c><c>1</c></rc>\n" * n_ions)
+        f.write('</set>\n</array>\n</atominfo>\n<structure name="finalpos"><crystal>\n<varray name="rec_basis">\n'
+                '<v> 0.25 0 0 </v>\n<v> 0 0.25 0 </v>\n<v> 0 0 0.25 </v>\n</varray>\n</crystal></structure>\n')
+        # VASP repeats the eigenvalues as <projected><eigenvalues> ahead of the projections, readers must skip it
+        eigen_block = ['<eigenvalues>\n<array>\n<field>eigene</field>\n<field>occ</field>\n<set>\n']
+        for spin in (1, 2):
+            eigen_block.append(f'<set comment="spin {spin}">\n')
+            for k in range(n_kpoints):
+                energies = np.sort(rng.normal(0, 3, n_bands))
+                eigen_block.append(f'<set comment="kpoint {k + 1}">\n')
+                eigen_block.append("".join(f"<r> {e:10.4f} {1.0 if b < n_bands // 2 else 0.0:8.4f} </r>\n"
+                                           for b, e in enumerate(energies)))
+                eigen_block.append("</set>\n")
+            eigen_block.append("</set>\n")
+        eigen_block = "".join(eigen_block) + '</set>\n</array>\n</eigenvalues>\n'
+        f.write('<calculation>\n' + eigen_block + '<dos>\n<i name="efermi"> 0.0 </i>\n</dos>\n<projected>\n')
+        f.write(eigen_block + '<array>\n')
+        f.write("".join(f"<field>{x}</field>\n" for x in fields) + "<set>\n")
+        row = "<r> " + " ".join(["0.1000"] * len(fields)) + " </r>\n"
+        for spin in (1, 2):
+            f.write(f'<set comment="spin{spin}">\n')
+            for k in range(n_kpoints):
+                f.write(f'<set comment="kpoint {k + 1}">\n')
+                f.write("".join(f'<set comment="band {b + 1}">\n' + row * n_ions + "</set>\n" for b in range(n_bands)))
+                f.write("</set>\n")
+            f.write("</set>\n")
+        f.write("</set>\n</array>\n</projected>\n</calculation>\n</modeling>\n")
+    return filename
+
+
+# ---- Cases ---- #
+
+@benchmark("spincar_from_chgcar", small=[64], large=[256, 500])
+def _spincar(size, workdir):
+    from make_spincar import spincar_from_chgcar
+    filename = os.path.join(FIXTURES, "CHGCAR") if size is None else synthetic_chgcar(size, workdir)
+    return lambda: spincar_from_chgcar(filename)
+
+
+@benchmark("chgcar_arith", small=[64], large=[256])
+def _chgcar_arith(size, workdir):
+    from chgcar_arith import chgcar_arith
+    filename = os.path.join(FIXTURES, "CHGCAR") if size is None else synthetic_chgcar(size, workdir)
+    output = os.path.join(workdir, "CHGCAR_diff")
+    return lambda: chgcar_arith([filename, filename, filename], output=output)
+
+
+@benchmark("parse_grid", small=[64], large=[256, 500])
+def _parse_grid(size, workdir):
+    from volumetric import VolumetricFile
+    filename = os.path.join(FIXTURES, "CHGCAR") if size is None else synthetic_chgcar(size, workdir)
+
+    def run():
+        with VolumetricFile(filename) as vol:
+            return vol.read_block()
+    return run
+
+
+@benchmark("planar_average", small=[64], large=[256])
+def _planar_average(size, workdir):
+    from planar_average import slab_profile
+    filename = os.path.join(FIXTURES, "CHGCAR") if size is None else synthetic_chgcar(size, workdir)
+    return lambda: slab_profile(filename, efermi=0.0)
+
+
+@benchmark("ewald_opt_from_ox", small=[4], large=[6])
+def _ewald(size, workdir):
+    """
+    Sized cases open size Li 1/0 and size Co 3/4 choices on a 2x2x1 POSCAR_12cell, the rest are fixed.
+    """
+    from pymatgen.core import Structure
+    from ewald_opt import ewald_opt_from_ox, get_ox_poscar
+    filename = os.path.join(FIXTURES, "POSCAR_12cell")
+    structure = Structure.from_file(filename)
+    if size is None:
+        ox_states = get_ox_poscar(filename)
+    else:
+        structure.make_supercell([2, 2, 1])
+        fixed = {"Li": 1.0, "Co": 3.0, "O": -2.0}
+        ox_states = [[fixed[site.specie.symbol]] for site in structure]
+        li = [n for n, site in enumerate(structure) if site.specie.symbol == "Li"][:size]
+        co = [n for n, site in enumerate(structure) if site.specie.symbol == "Co"][:size]
+        for n in li:
+            ox_states[n] = [1.0, 0.0]
+        for n in co:
+            ox_states[n] = [3.0, 4.0]
+    return lambda: ewald_opt_from_ox(structure.copy(), ox_states, check_charge=True)
+
+
+@benchmark("frz_central_slab", small=[1000], large=[10000, 100000])
+def _freeze(size, workdir):
+    from freeze_slab_center import frz_central_slab
+    structure = synthetic_structure(4 if size is None else size)
+    return lambda: frz_central_slab(structure.copy())
+
+
+@benchmark("get_ionic_delta", small=[1000], large=[10000])
+def _ionic_delta(size, workdir):
+    from get_ionic_movement import get_ionic_delta
+    structure_1 = synthetic_structure(4 if size is None else size)
+    structure_2 = structure_1.copy()
+    structure_2.perturb(0.1)
+    return lambda: get_ionic_delta(structure_1, structure_2)
+
+
+@benchmark("make_surface", small=[14], large=[28])
+def _surface(size, workdir):
+    """
+    Size is the slab thickness in Angstrom, slabs are written into workdir/slabs
+    """
+    from pymatgen.core import Structure
+    from make_surface import make_surface
+    structure = Structure.from_file(os.path.join(FIXTURES, "POSCAR"))
+    os.makedirs(os.path.join(workdir, "slabs"), exist_ok=True)
+
+    def run():
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            make_surface(structure.copy(), miller_index=[0, 0, 1], layer_size=7 if size is None else size)
+        finally:
+            os.chdir(cwd)
+    return run
+
+
+@benchmark("make_supercell", small=[1000], large=[10000, 100000])
+def _supercell(size, workdir):
+    from make_supercell import make_supercell
+    from pymatgen.core import Structure
+    structure = Structure.from_file(os.path.join(FIXTURES, "POSCAR"))
+    k = 2 if size is None else int(np.ceil((size / len(structure)) ** (1 / 3)))
+    return lambda: make_supercell(structure.copy(), [k, k, k])  # Works in place
+
+
+@benchmark("element_subs", small=[3], large=[4])
+def _element_subs(size, workdir):
+    """
+    Size is the k x k x k supercell, k substitutions of its Co sites are enumerated (nothing written)
+    """
+    from element_subs import substitution_candidates
+    from pymatgen.core import Structure
+    structure = Structure.from_file(os.path.join(FIXTURES, "POSCAR"))
+    k = 2 if size is None else size
+
+    def run():
+        _, candidates = substitution_candidates(structure, "Co", k, scale_matrix=[k, k, k])
+        return sum(1 for _ in candidates)
+    return run
+
+
+@benchmark("displacement_set", small=[3], large=[4])
+def _displacements(size, workdir):
+    """
+    Size is the k x k x k supercell of the POSCAR fixture: symmetry, irreducible displacements and the force
+    constants rebuilt (and symmetrised) from random forces
+    """
+    from make_displacements import displacement_set, force_constants
+    from pymatgen.core import Structure
+    structure = Structure.from_file(os.path.join(FIXTURES, "POSCAR"))
+    k = 2 if size is None else size
+    rng = np.random.default_rng(0)
+
+    def run():
+        result = displacement_set(structure, [k, k, k])
+        forces = rng.random((len(result["displacements"]), len(result["supercell"]), 3))
+        return force_constants(result["rotations"], result["perms"], result["displacements"], forces)
+    return run
+
+
+@benchmark("fast_supercell_to_poscar", small=[1000], large=[10000, 100000])
+def _fast_supercell(size, workdir):
+    from make_supercell import fast_supercell_to_poscar
+    from pymatgen.core import Structure
+    structure = Structure.from_file(os.path.join(FIXTURES, "POSCAR"))
+    k = 2 if size is None else int(np.ceil((size / len(structure)) ** (1 / 3)))
+    return lambda: fast_supercell_to_poscar(structure, np.diag([k, k, k]), stream=io.StringIO())
+
+
+@benchmark("scan_outcar", small=[10], large=[1000])
+def _scan_outcar(size, workdir):
+    from vasp_scan import scan_outcar
+    filename = os.path.join(FIXTURES, "OUTCAR") if size is None else synthetic_outcar(size, workdir)
+    return lambda: scan_outcar(filename, electronic=True)
+
+
+@benchmark("energy_from_outcar", small=[10], large=[1000])
+def _energy_outcar(size, workdir):
+    from energy_from_vasprun import energy_from_outcar
+    filename = os.path.join(FIXTURES, "OUTCAR") if size is None else synthetic_outcar(size, workdir)
+    return lambda: energy_from_outcar(filename)
+
+
+@benchmark("forces_from_outcar", small=[10], large=[1000])
+def _forces_outcar(size, workdir):
+    from forces_from_vasprun import forces_from_outcar
+    filename = os.path.join(FIXTURES, "OUTCAR") if size is None else synthetic_outcar(size, workdir)
+    return lambda: forces_from_outcar(filename)
+
+
+@benchmark("band_from_vasprun", small=[200], large=[5000])
+def _band(size, workdir):
+    """
+    There is no vasprun fixture, so the fixture tier uses a small synthetic one too
+    """
+    from band_from_vasprun import band_from_vasprun
+    filename = synthetic_vasprun(20 if size is None else size, workdir)
+    return lambda: band_from_vasprun(filename)
+
+
+@benchmark("dos_from_vasprun", small=[200], large=[5000])
+def _dos(size, workdir):
+    from dos_from_vasprun import dos_from_vasprun
+    filename = synthetic_vasprun(20 if size is None else size, workdir)
+    return lambda: dos_from_vasprun(filename, ions=["1"], orbitals=["p"])
+
+
+# ---- Runner ---- #
+
+def time_case(run, repeats: int = 3, warmup: bool = True) -> dict:
+    """
+    Wall times of repeats calls, anything the call prints is swallowed. The warm up call keeps first use
+    imports (pandas, pymatgen submodules) out of the timings.
+    """
+    if warmup:
+        with contextlib.redirect_stdout(io.StringIO()):
+            run()
+    times = []
+    for _ in range(repeats):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+    return {"min": min(times), "median": statistics.median(times), "repeats": repeats}
+
+
+def run_benchmarks(names=None, tier: str = "small", repeats: int = 3, workdir: str = None,
+                   warmup: bool = True) -> dict:
+    """
+    Benchmark harness for the public functions of every tool. Each case runs on the tests/ fixtures and, for the
+    small / large tiers, on synthetic inputs scaled up to 1e5 atoms, GB sized grids and OUTCARs.
+    Returns the results keyed as name[size].
+    """
+    if TOOLS_DIR not in sys.path:
+        sys.path.insert(0, TOOLS_DIR)
+    workdir = workdir if workdir is not None else tempfile.mkdtemp(prefix="bud-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    tiers = TIERS[:TIERS.index(tier) + 1]
+
+    results = {}
+    for name in (names if names else CASES):
+        case = CASES[name]
+        for size in [s for t in tiers for s in case["sizes"][t]]:
+            key = f"{name}[{'fixture' if size is None else size}]"
+            try:
+                run = case["setup"](size, workdir)
+                results[key] = time_case(run, repeats=repeats, warmup=warmup)
+            except Exception as e:  # Report and keep going, one broken tool shouldn't hide the rest
+                c_log.warning(f"{key} failed: {type(e).__name__}: {e}")
+                results[key] = {"error": f"{type(e).__name__}: {e}"}
+                continue
+            c_log.info(f"{key}: {results[key]['min']:.4f} s")
+    return results
+
+
+def compare(results: dict, reference: dict, threshold: float = 0.25) -> list:
+    """
+    Keys whose best time is more than threshold (fractional) slower than the reference, or that now fail.
+    """
+    regressions = []
+    for key, old in reference.items():
+        new = results.get(key)
+        if new is None or "min" not in old:
+            continue
+        if "error" in new or new["min"] > old["min"] * (1 + threshold):
+            regressions.append(key)
+    return regressions
+
+
+def metadata() -> dict:
+    meta = {"python": platform.python_version(), "machine": platform.machine(), "node": platform.node(),
+            "numpy": np.__version__, "date": time.strftime("%Y-%m-%d %H:%M:%S")}
+    try:
+        from importlib.metadata import version
+        meta["pymatgen"] = version("pymatgen")
+    except Exception:
+        pass
+    return meta
+
+
+def cli_run(argv) -> None:
+    """
+    Wrapper for the above command, handles parsing of args and logging, to avoid mess
+    """
+
+    global c_log
+
+    parser = argparse.ArgumentParser(description=run_benchmarks.__doc__)  # Parser init
+    parser.add_argument("cases", type=str, nargs="*", help=f"Cases to run (default all): {', '.join(CASES)}")
+    parser.add_argument("-t", "--tier", dest="tier", type=str, default="small", choices=TIERS,
+                        help="fixture only, or also the small / large synthetic inputs")
+    parser.add_argument("-r", "--repeats", dest="repeats", type=int, default=3, help="Timed calls per case")
+    parser.add_argument("-o", "--output", dest="output", type=str, default="benchmark.json", help="Results JSON")
+    parser.add_argument("-c", "--compare", dest="compare", type=str, default=None,
+                        help="Previous results JSON, exit 1 on any regression")
+    parser.add_argument("--threshold", dest="threshold", type=float, default=0.25,
+                        help="Allowed fractional slow down before a case counts as regressed")
+    parser.add_argument("--no-warmup", dest="warmup", action="store_false",
+                        help="Skip the untimed first call, saves time on the large tier")
+    parser.add_argument("--workdir", dest="workdir", type=str, default=None,
+                        help="Where synthetic inputs are written, reusing one skips regenerating them")
+    parser.add_argument("--debug", dest="debug", action="store_true")  # Always have the debug optional
+    parser.add_argument("--verbose", dest="verbose", action="store_true")  # Always have the verbose optional
+
+    args = parser.parse_args(argv)
+
+    if args.debug:  # Always include method for switching verbosity
+        c_log.setLevel(logging.DEBUG)
+    if args.verbose:
+        c_log.setLevel(logging.INFO)
+    c_log.debug(args)
+
+    unknown = [x for x in args.cases if x not in CASES]
+    if unknown:
+        parser.error(f"Unknown cases: {' '.join(unknown)}")
+
+    results = run_benchmarks(args.cases, tier=args.tier, repeats=args.repeats, workdir=args.workdir,
+                             warmup=args.warmup)
+    with open(args.output, "w") as f:
+        json.dump({"meta": metadata(), "results": results}, f, indent=2)
+
+    regressions = []
+    reference = {}
+    if args.compare is not None:
+        with open(args.compare) as f:
+            reference = json.load(f)["results"]
+        regressions = compare(results, reference, threshold=args.threshold)
+
+    for key, result in results.items():
+        line = f"{key:40s} " + (f"{result['min']:10.4f} s" if "min" in result else f"{'FAILED':>12s}")
+        if key in reference and "min" in reference[key] and "min" in result:
+            line += f"  ({result['min'] / reference[key]['min']:6.2f}x)"
+        print(line + ("  REGRESSION" if key in regressions else ""))
+
+    if regressions:
+        c_log.warning(f"{len(regressions)} regression(s) beyond {args.threshold:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli_run(sys.argv[1:])
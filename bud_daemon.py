@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import sys, argparse, logging, os, json, socket, struct, signal, importlib, time
+
+# Adopted format: level - current function name - mess. Width is fixed as visual aid
+c_log = logging.getLogger(__name__)
+std_format = '[%(levelname)5s - %(funcName)10s] %(message)s'
+c_log.setLevel(logging.WARNING)  # Same as bud_tools, importing the client configures nothing
+
+# XDG_RUNTIME_DIR is already private to the user, the /tmp fallback is a 0700 directory of our own made by serve
+FALLBACK_DIR = os.path.join("/tmp", f"bud-tools-{os.getuid()}")
+DEFAULT_SOCKET = os.environ.get("BUD_TOOLS_SOCKET",
+                                os.path.join(os.environ["XDG_RUNTIME_DIR"], f"bud-tools-{os.getuid()}.sock")
+                                if os.environ.get("XDG_RUNTIME_DIR") else os.path.join(FALLBACK_DIR, "bud-tools.sock"))
+# Imported by every worker before it starts accepting, this is the startup cost the daemon amortises
+DEFAULT_PRELOAD = ("pymatgen.core", "pymatgen.io.vasp", "pymatgen.symmetry.analyzer", "poscar_writer")
+
+# Response frames are a channel byte, a 4 byte length and the payload
+STDOUT, STDERR, EXIT = b"o", b"e", b"x"
+HEADER = struct.Struct(">cI")
+
+
+class _FrameWriter:
+    """
+    File like object that sends everything written to it down the socket as frames on one channel.
+    """
+
+    def __init__(self, conn: socket.socket, channel: bytes):
+        self.conn = conn
+        self.channel = channel
+
+    def write(self, text: str) -> int:
+        if text:
+            data = text.encode()
+            self.conn.sendall(HEADER.pack(self.channel, len(data)) + data)
+        return len(text)
+
+    def flush(self) -> None:
+        pass
+
+    def isatty(self) -> bool:
+        return False
+
+
+def _recv_exact(conn: socket.socket, n: int) -> bytes:
+    buf = b""
+    while len(buf) < n:
+        chunk = conn.recv(n - len(buf))
+        if not chunk:
+            raise ConnectionError("Connection closed mid frame")
+        buf += chunk
+    return buf
+
+
+def _run_request(conn: socket.socket, request: dict) -> int:
+    """
+    Runs one bud-tools argv inside this (warm) worker with stdout / stderr and the logging handlers pointed at the
+    socket. Logger levels are put back afterwards so a --debug call doesn't leak into the next request.
+    """
+    import bud_tools
+
+    out, err = _FrameWriter(conn, STDOUT), _FrameWriter(conn, STDERR)
+    handlers = [h for h in logging.getLogger().handlers if isinstance(h, logging.StreamHandler)]
+    levels = {name: lg.level for name, lg in logging.root.manager.loggerDict.items() if isinstance(lg, logging.Logger)}
+    old_streams = [h.setStream(err) for h in handlers]
+    old_stdout, old_stderr, old_cwd = sys.stdout, sys.stderr, os.getcwd()
+    sys.stdout, sys.stderr = out, err
+    code = 0
+    try:
+        os.chdir(request.get("cwd", old_cwd))
+        argv = request["argv"]
+        if not argv:
+            raise KeyError("No subcommand given")
+        bud_tools.dispatch(argv[0], argv[1:])
+    except SystemExit as e:  # argparse errors and explicit exits
+        code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+        if e.code is not None and not isinstance(e.code, int):
+            err.write(f"{e.code}\n")
+    except Exception as e:
+        err.write(f"{type(e).__name__}: {e}\n")
+        code = 1
+    finally:
+        sys.stdout, sys.stderr = old_stdout, old_stderr
+        for handler, stream in zip(handlers, old_streams):
+            handler.setStream(stream)
+        for name, lg in list(logging.root.manager.loggerDict.items()):
+            if isinstance(lg, logging.Logger):  # Modules first imported by this request go back to the default
+                lg.setLevel(levels.get(name, logging.WARNING))
+        os.chdir(old_cwd)
+    return code
+
+
+def _worker(listener: socket.socket, preload) -> None:
+    """
+    Pre-forked worker: imports the heavy modules once, then accepts connections off the shared listening socket
+    until the server terminates it. Each worker handles one request at a time, the pool size sets the concurrency.
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for module in preload:
+        try:
+            importlib.import_module(module)
+        except ImportError as e:
+            c_log.warning(f"Could not preload {module}: {e}")
+    c_log.info(f"Worker {os.getpid()} ready")
+
+    while True:
+        conn, _ = listener.accept()
+        with conn:
+            try:
+                request = json.loads(conn.makefile("rb").readline())
+                if request.get("command") == "stop":
+                    conn.sendall(HEADER.pack(EXIT, 1) + b"0")
+                    os.kill(os.getppid(), signal.SIGTERM)
+                    continue
+                start = time.perf_counter()
+                code = _run_request(conn, request)
+                conn.sendall(HEADER.pack(EXIT, len(str(code))) + str(code).encode())
+                c_log.info(f"{request['argv'][:1]} -> {code} in {time.perf_counter() - start:.3f} s")
+            except (ConnectionError, BrokenPipeError, ValueError) as e:
+                c_log.info(f"Dropped request: {e}")
+
+
+def _socket_dir(socket_path: str) -> None:
+    """
+    Makes sure the socket's directory exists, the /tmp fallback only as a 0700 directory owned by this user.
+    """
+    folder = os.path.dirname(os.path.abspath(socket_path))
+    if folder != FALLBACK_DIR:
+        os.makedirs(folder, exist_ok=True)
+        return
+    c_log.warning(f"XDG_RUNTIME_DIR is not set, listening in {folder} (set BUD_TOOLS_SOCKET to choose)")
+    os.makedirs(folder, mode=0o700, exist_ok=True)
+    st = os.lstat(folder)
+    if not os.path.isdir(folder) or os.path.islink(folder) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise RuntimeError(f"{folder} is not a private directory of this user, refusing to listen in it")
+
+
+def serve(socket_path: str = DEFAULT_SOCKET, workers: int = 4, preload=DEFAULT_PRELOAD) -> None:
+    """
+    Local server mode: a pool of warm (pymatgen already imported) workers behind a Unix socket. Any bud-tools
+    argv sent by the client runs in one of them with its output streamed back, so a call costs milliseconds
+    instead of an interpreter start and the pymatgen import. Dead workers are replaced, SIGTERM stops everything.
+    """
+    _socket_dir(socket_path)
+    if os.path.exists(socket_path):
+        try:
+            socket.socket(socket.AF_UNIX).connect(socket_path)
+            raise RuntimeError(f"A server is already listening on {socket_path}")
+        except ConnectionRefusedError:
+            os.unlink(socket_path)  # Left over from a server that died
+
+    sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o177)  # The socket is 0600 from the moment it exists, no window before a chmod
+    try:
+        listener.bind(socket_path)
+    finally:
+        os.umask(umask)
+    listener.listen(64)
+
+    children = set()
+
+    def spawn():
+        pid = os.fork()  # Fork so the listening socket is shared, every worker accepts off it directly
+        if pid == 0:
+            try:
+                _worker(listener, preload)
+            finally:
+                os._exit(0)
+        children.add(pid)
+
+    def shutdown(signum, frame):
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+        listener.close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        c_log.info("Server stopped")
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    for _ in range(workers):
+        spawn()
+    c_log.info(f"Listening on {socket_path} with {workers} workers")
+
+    while True:
+        pid, status = os.wait()
+        if pid in children:
+            children.discard(pid)
+            c_log.warning(f"Worker {pid} exited ({status}), starting a new one")
+            spawn()
+
+
+def request(argv, socket_path: str = DEFAULT_SOCKET, stdout=None, stderr=None) -> int:
+    """
+    Thin client: sends argv (subcommand first) to the server and streams its stdout / stderr back as it is written.
+    Returns the tool's exit code.
+    """
+    stdout = sys.stdout if stdout is None else stdout
+    stderr = sys.stderr if stderr is None else stderr
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.connect(socket_path)
+        conn.sendall(json.dumps({"argv": list(argv), "cwd": os.getcwd()}).encode() + b"\n")
+        while True:
+            channel, length = HEADER.unpack(_recv_exact(conn, HEADER.size))
+            payload = _recv_exact(conn, length)
+            if channel == EXIT:
+                return int(payload)
+            stream = stdout if channel == STDOUT else stderr
+            stream.write(payload.decode())
+            stream.flush()
+
+
+def stop(socket_path: str = DEFAULT_SOCKET) -> None:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.connect(socket_path)
+        conn.sendall(json.dumps({"command": "stop"}).encode() + b"\n")
+        _recv_exact(conn, HEADER.size + 1)
+
+
+def available(socket_path: str = DEFAULT_SOCKET) -> bool:
+    return os.path.exists(socket_path)
+
+
+def cli_run(argv) -> None:
+    """
+    Wrapper for the above command, handles parsing of args and logging, to avoid mess
+    """
+
+    global c_log
+
+    logging.basicConfig(format=std_format)
+    parser = argparse.ArgumentParser(description=serve.__doc__)  # Parser init
+    parser.add_argument("action", type=str, choices=["serve", "stop", "run"],
+                        help="serve: start the server, stop: stop it, run <subcommand> ...: send the rest to it")
+    parser.add_argument("-s", "--socket", dest="socket", type=str, default=DEFAULT_SOCKET, help="Socket path")
+    parser.add_argument("-n", "--workers", dest="workers", type=int, default=4, help="Worker processes")
+    parser.add_argument("--preload", dest="preload", type=str, nargs="+", default=list(DEFAULT_PRELOAD),
+                        help="Modules each worker imports before accepting requests")
+    parser.add_argument("--debug", dest="debug", action="store_true")  # Always have the debug optional
+    parser.add_argument("--verbose", dest="verbose", action="store_true")  # Always have the verbose optional
+
+    # Everything after run belongs to the tool, so its flags can't clash with the ones above
+    split = argv.index("run") + 1 if "run" in argv else len(argv)
+    args = parser.parse_args(argv[:split])
+
+    if args.debug:  # Always include method for switching verbosity
+        c_log.setLevel(logging.DEBUG)
+    if args.verbose:
+        c_log.setLevel(logging.INFO)
+    c_log.debug(args)
+
+    if args.action == "serve":
+        serve(args.socket, workers=args.workers, preload=args.preload)
+    elif args.action == "stop":
+        stop(args.socket)
+    else:
+        sys.exit(request(argv[split:], socket_path=args.socket))
+
+
+if __name__ == "__main__":
+    cli_run(sys.argv[1:])
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import sys, argparse, logging, os, json, importlib, subprocess
+
+# Adopted format: level - current function name - mess. Width is fixed as visual aid
+c_log = logging.getLogger(__name__)
+std_format = '[%(levelname)5s - %(funcName)10s] %(message)s'
+c_log.setLevel(logging.WARNING)  # basicConfig is left to cli_run, importing this module configures nothing
+
+TOOLS_DIR = os.path.dirname(os.path.realpath(__file__))
+ENTRY_BUDGET = 0.1  # Seconds importing bud_tools itself may take
+
+# Subcommand -> (module, one line help). Modules are only imported once their subcommand is picked
+SUBCOMMANDS = {
+    "band_from_vasprun": ("band_from_vasprun", "Band gap, VBM/CBM and bands streamed from a vasprun.xml"),
+    "benchmark": ("benchmark", "Benchmark harness over fixtures and synthetic inputs"),
+    "chgcar_arith": ("chgcar_arith", "Chunked arithmetic over CHGCARs, i.e charge density differences"),
+    "dos_from_vasprun": ("dos_from_vasprun", "Projected DOS for chosen ions/orbitals/spins"),
+    "element_subs": ("element_subs", "Symmetry unique substitutions in a supercell"),
+    "energy_from_vasprun": ("energy_from_vasprun", "Ionic (or electronic) energy table, SCF convergence report"),
+    "export_trajectory": ("export_trajectory", "Stream trajectories to extended XYZ / packed binary"),
+    "ewald_opt": ("ewald_opt", "Ewald energy ranking of oxidation state orderings"),
+    "forces_from_vasprun": ("forces_from_vasprun", "Max / average force per ionic step"),
+    "freeze_slab_center": ("freeze_slab_center", "Selective dynamics for the middle of a slab"),
+    "get_ionic_movement": ("get_ionic_movement", "Displacement between two structures"),
+    "make_displacements": ("make_displacements", "Symmetry reduced phonon displacements, force constants back"),
+    "make_spincar": ("make_spincar", "Spin density file from a CHGCAR"),
+    "make_supercell": ("make_supercell", "Supercell POSCAR"),
+    "make_surface": ("make_surface", "Slabs from a bulk structure"),
+    "make_vasp_set": ("make_vasp_set", "VASP input sets, single or batch"),
+    "ox_cache": ("ox_cache", "Inspect or fill the oxidation state cache"),
+    "planar_average": ("planar_average", "Planar / macroscopic averaged profiles, vacuum level and work function"),
+    "place_adsorbate": ("place_adsorbate", "Adsorbates on every unique site of a set of slabs"),
+    "parse_vasp_folder": ("parse_vasp_folder", "Harvest a tree of calculations into a table"),
+    "scale_abc": ("scale_abc", "Scale lattice vectors"),
+    "scale_to_volume": ("scale_to_volume", "Scale a cell to a volume"),
+    "stretch_cell": ("stretch_cell", "Stretch a cell along chosen directions"),
+    "syminfo": ("syminfo", "Symmetry information"),
+    "vasp_scan": ("vasp_scan", "Fast OUTCAR / OSZICAR energy and force scan"),
+}
+
+
+def resolve(subcommand: str) -> str:
+    """
+    Module name for a subcommand, dashes are accepted in place of underscores (bud-tools make-supercell)
+    """
+    name = subcommand.replace("-", "_")
+    if name not in SUBCOMMANDS:
+        raise KeyError(f"Unknown subcommand {subcommand}, see bud-tools --help")
+    return SUBCOMMANDS[name][0]
+
+
+def dispatch(subcommand: str, argv) -> None:
+    """
+    Imports the subcommand's module (and only that one) and hands it the rest of argv.
+    """
+    if TOOLS_DIR not in sys.path:
+        sys.path.insert(0, TOOLS_DIR)  # Works through a symlinked bud-tools on PATH
+    module = importlib.import_module(resolve(subcommand))
+    module.cli_run(argv)
+
+
+def dispatch_daemon(argv) -> None:
+    if TOOLS_DIR not in sys.path:
+        sys.path.insert(0, TOOLS_DIR)
+    importlib.import_module("bud_daemon").cli_run(argv)
+
+
+def import_time(module: str) -> float:
+    """
+    Cumulative import time in seconds of module in a fresh interpreter, from python -X importtime
+    """
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                          cwd=TOOLS_DIR, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{proc.stderr.strip().splitlines()[-1]}")
+    for line in proc.stderr.splitlines():
+        fields = [x.strip() for x in line.split("|")]
+        if len(fields) == 3 and fields[2] == module:  # Top level entry, nested imports are indented
+            return int(fields[1]) / 1e6
+    raise RuntimeError(f"No importtime entry for {module}")
+
+
+def importtime_check(modules=None, baseline: str = None, save: str = None, tolerance: float = 0.5,
+                     entry_budget: float = ENTRY_BUDGET) -> bool:
+    """
+    Import time self check. Times bud_tools itself (which has to stay under entry_budget seconds) and each
+    module, compares against a saved baseline if given and flags anything slower than baseline * (1 + tolerance).
+    Returns True when nothing regressed.
+    """
+    modules = modules if modules else ["bud_tools"] + sorted({m for m, _ in SUBCOMMANDS.values()})
+    times = {}
+    for module in modules:
+        try:
+            times[module] = import_time(module)
+        except RuntimeError as e:
+            c_log.warning(e)
+    reference = {}
+    if baseline is not None:
+        with open(baseline) as f:
+            reference = json.load(f)
+
+    ok = True
+    for module, seconds in times.items():
+        limits = [reference[module] * (1 + tolerance)] if module in reference else []
+        if module == "bud_tools":
+            limits.append(entry_budget)
+        limit = min(limits) if limits else None
+        failed = limit is not None and seconds > limit
+        ok &= not failed
+        print(f"{module:22s} {seconds:8.3f} s" + (f"  (limit {limit:.3f} s)" if limit is not None else "")
+              + ("  REGRESSION" if failed else ""))
+
+    if save is not None:
+        with open(save, "w") as f:
+            json.dump(times, f, indent=2, sort_keys=True)
+    return ok
+
+
+def cli_run(argv) -> None:
+    """
+    Single entry point for the tools: bud-tools <subcommand> [args], args are passed straight to the script.
+    Only the chosen script is imported so startup is no slower than calling it directly.
+    """
+
+    global c_log
+
+    logging.basicConfig(format=std_format)
+    epilog = "subcommands:\n" + "\n".join(f"  {name:22s}{desc}" for name, (_, desc) in SUBCOMMANDS.items())
+    epilog += "\n  importtime            Import time self check (-h for options)"
+    epilog += "\n  daemon                Warm worker server: daemon serve | stop | run <subcommand> ..."
+    epilog += "\n\nWith BUD_TOOLS_SOCKET set to a running server's socket, calls are forwarded to it"
+    parser = argparse.ArgumentParser(description=cli_run.__doc__, epilog=epilog,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)  # Parser init
+    parser.add_argument("subcommand", type=str, help="Tool to run, see below")
+    parser.add_argument("args", nargs=argparse.REMAINDER, help="Arguments for the tool")
+
+    args = parser.parse_args(argv)
+
+    if args.subcommand == "daemon":
+        dispatch_daemon(args.args)
+        return
+    if args.subcommand != "importtime":
+        if "BUD_TOOLS_SOCKET" in os.environ and os.path.exists(os.environ["BUD_TOOLS_SOCKET"]):
+            import bud_daemon  # A warm server is running, hand the call over to it
+            sys.exit(bud_daemon.request([args.subcommand] + args.args, socket_path=os.environ["BUD_TOOLS_SOCKET"]))
+        try:
+            dispatch(args.subcommand, args.args)
+        except KeyError as e:
+            parser.error(e.args[0])
+        return
+
+    check = argparse.ArgumentParser(prog="bud-tools importtime", description=importtime_check.__doc__)
+    check.add_argument("modules", type=str, nargs="*", help="Modules to time, default is every subcommand")
+    check.add_argument("--baseline", dest="baseline", type=str, default=None, help="JSON of previous timings")
+    check.add_argument("--save", dest="save", type=str, default=None, help="Write the timings as a new baseline")
+    check.add_argument("--tolerance", dest="tolerance", type=float, default=0.5,
+                       help="Allowed fractional slow down against the baseline")
+    check.add_argument("--entry-budget", dest="entry_budget", type=float, default=ENTRY_BUDGET,
+                       help="Seconds importing bud_tools itself may take")
+    check.add_argument("--debug", dest="debug", action="store_true")  # Always have the debug optional
+    check.add_argument("--verbose", dest="verbose", action="store_true")  # Always have the verbose optional
+
+    check_args = check.parse_args(args.args)
+
+    if check_args.debug:  # Always include method for switching verbosity
+        c_log.setLevel(logging.DEBUG)
+    if check_args.verbose:
+        c_log.setLevel(logging.INFO)
+    c_log.debug(check_args)
+
+    if not importtime_check(check_args.modules, baseline=check_args.baseline, save=check_args.save,
+                            tolerance=check_args.tolerance, entry_budget=check_args.entry_budget):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli_run(sys.argv[1:])
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import sys, argparse, logging, string, ast
+
+import numpy as np
+
+from volumetric import VolumetricFile, VolumetricWriter, check_compatible, DEFAULT_CHUNK
+import profiling
+
+# Adopted format: level - current function name - mess. Width is fixed as visual aid
+c_log = logging.getLogger(__name__)
+std_format = '[%(levelname)5s - %(funcName)10s] %(message)s'
+logging.basicConfig(format=std_format)
+c_log.setLevel(logging.WARNING)
+
+NAMES = string.ascii_lowercase  # Inputs are a, b, c ... in the expression, in the order given
+
+
+def compile_expression(expression: str, n_files: int):
+    """
+    Compiles the expression once, only the file names (a, b, ...) and np may appear in it
+    """
+    tree = ast.parse(expression, mode="eval")
+    allowed = set(NAMES[:n_files]) | {"np"}
+    unknown = sorted({node.id for node in ast.walk(tree) if isinstance(node, ast.Name)} - allowed)
+    if unknown:
+        raise ValueError(f"Unknown names in '{expression}': {', '.join(unknown)}, "
+                         f"inputs are {', '.join(sorted(allowed))}")
+    return compile(tree, "<expression>", "eval")
+
+
+def chgcar_arith(filenames: list, expression: str = None, output: str = "CHGCAR_diff", chunk: int = DEFAULT_CHUNK,
+                 total_only: bool = False, lattice_tol: float = 1e-4, threads: int = None) -> int:
+    """
+    Volumetric arithmetic over CHGCAR / LOCPOT files (i.e the charge density difference rho(AB) - rho(A) - rho(B)),
+    without loading any of them whole. The files are referred to as a, b, c ... in the expression (numpy is np) and
+    default to a - b - c .... Grids are read in aligned chunks, the expression is applied chunk by chunk and the
+    result written as it comes, so memory is a few chunks whatever the file size.
+    Every block all inputs share (total, then magnetisation) is processed unless total_only.
+    The output takes the header of the first file, augmentation occupancies are not carried over.
+    Returns the number of blocks written.
+    """
+    if len(filenames) > len(NAMES):
+        raise ValueError(f"At most {len(NAMES)} inputs")
+    expression = expression if expression else " - ".join(NAMES[:len(filenames)])
+    code = compile_expression(expression, len(filenames))
+    files = [VolumetricFile(f, threads=threads) for f in filenames]
+    try:
+        check_compatible(files, lattice_tol=lattice_tol)
+        c_log.info(f"{output} = {expression} on a {'x'.join(str(x) for x in files[0].grid)} grid")
+        with VolumetricWriter(output, files[0].header, files[0].grid_line) as writer:
+            n_blocks = 0
+            while True:
+                names = {"np": np}
+                for chunks in zip(*(f.values(chunk) for f in files)):
+                    names.update(zip(NAMES, chunks))
+                    writer.write(np.asarray(eval(code, {"__builtins__": {}}, names), dtype=float))
+                n_blocks += 1
+                if total_only:
+                    break
+                more = [f.next_block() for f in files]
+                if not all(more):
+                    if any(more):
+                        c_log.info(f"Only {n_blocks} block(s) in every input, extra blocks ignored")
+                    break
+                writer.new_block()
+    finally:
+        for f in files:
+            f.close()
+    return n_blocks
+
+
+def cli_run(argv) -> None:
+    """
+    Wrapper for the above command, handles parsing of args and logging, to avoid mess
+    """
+
+    global c_log
+
+    parser = argparse.ArgumentParser(description=chgcar_arith.__doc__)  # Parser init
+    parser.add_argument("inputs", type=str, nargs="+", help="CHGCAR / LOCPOT files, a b c ... in the expression")
+    parser.add_argument("-e", "--expr", dest="expression", type=str, default=None,
+                        help="Expression of a, b, c ... and np, default is a - b - c ...")
+    parser.add_argument("-o", "--output", dest="output", type=str, default="CHGCAR_diff", help="Output file")
+    parser.add_argument("-c", "--chunk", dest="chunk", type=int, default=DEFAULT_CHUNK,
+                        help="Grid values per chunk, memory follows this rather than the file size")
+    parser.add_argument("-j", "--threads", dest="threads", type=int, default=None,
+                        help="Threads converting grid text, default is one per CPU")
+    parser.add_argument("-t", "--total-only", dest="total_only", action="store_true",
+                        help="Only the first (total) block, skip the magnetisation")
+    parser.add_argument("--lattice-tol", dest="lattice_tol", type=float, default=1e-4,
+                        help="Largest lattice difference in Angstrom allowed between inputs")
+    parser.add_argument("--debug", dest="debug", action="store_true")  # Always have the debug optional
+    parser.add_argument("--verbose", dest="verbose", action="store_true")  # Always have the verbose optional
+
+    profiling.add_profile_argument(parser)
+    args = parser.parse_args(argv)
+
+    if args.debug:  # Always include method for switching verbosity
+        c_log.setLevel(logging.DEBUG)
+    if args.verbose:
+        c_log.setLevel(logging.INFO)
+    c_log.debug(args)
+    profiling.start(args.profile)
+
+    try:
+        with profiling.phase("arithmetic"):
+            n_blocks = chgcar_arith(args.inputs, expression=args.expression, output=args.output, chunk=args.chunk,
+                                    total_only=args.total_only, lattice_tol=args.lattice_tol, threads=args.threads)
+    except (ValueError, SyntaxError) as e:
+        profiling.report()
+        parser.error(str(e))
+    print(f"{n_blocks} block(s) written to {args.output}")
+    profiling.report()
+
+
+if __name__ == "__main__":
+    cli_run(sys.argv[1:])
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import logging, os, io, shutil, subprocess, gzip, lzma, bz2
+import xml.etree.ElementTree as ET
+
+# Adopted format: level - current function name - mess. Width is fixed as visual aid
+c_log = logging.getLogger(__name__)
+std_format = '[%(levelname)5s - %(funcName)10s] %(message)s'
+logging.basicConfig(format=std_format)
+c_log.setLevel(logging.WARNING)
+
+EXTENSIONS = (".gz", ".xz", ".bz2")
+# Compression is told from the first bytes, not the name, so a renamed file still opens
+MAGIC = {b"\x1f\x8b": "gz", b"\xfd7zXZ\x00": "xz", b"BZh": "bz2"}
+# Multithreaded decompressors tried in order before the standard library, all write to stdout
+DECOMPRESSORS = {"gz": [["pigz", "-dc"]], "xz": [["xz", "-dc", "-T0"]],
+                 "bz2": [["lbzip2", "-dc"], ["pbzip2", "-dc"]]}
+STDLIB = {"gz": gzip.open, "xz": lzma.open, "bz2": bz2.open}
+USE_EXTERNAL = os.environ.get("BUD_TOOLS_NO_PIPE") is None  # Set BUD_TOOLS_NO_PIPE to always use the stdlib
+
+
+def compression(filename: str):
+    """
+    "gz", "xz", "bz2" or None for a plain file
+    """
+    with open(filename, "rb") as f:
+        start = f.read(6)
+    for magic, kind in MAGIC.items():
+        if start.startswith(magic):
+            return kind
+    return None
+
+
+def variants(name: str) -> tuple:
+    """
+    name and its compressed names, in the order they are looked for
+    """
+    return (name,) + tuple(name + ext for ext in EXTENSIONS)
+
+
+def find_file(filename: str):
+    """
+    filename if it exists, else its first existing compressed version (vasprun.xml -> vasprun.xml.gz), else None
+    """
+    for candidate in variants(filename):
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+
+def strip_extension(filename: str) -> str:
+    """
+    File name without a compression extension, for matching on names like OUTCAR or vasprun.xml
+    """
+    for ext in EXTENSIONS:
+        if filename.endswith(ext):
+            return filename[:-len(ext)]
+    return filename
+
+
+class _PipeReader(io.RawIOBase):
+    """
+    Raw stream over a decompressor's stdout. Closing it early stops the decompressor, so a parser that only
+    wants the start of a file never inflates the rest.
+    """
+
+    def __init__(self, command: list, filename: str):
+        self.command = command
+        self.proc = subprocess.Popen(command + [filename], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        n = self.proc.stdout.readinto(b)
+        if not n and self.proc.wait() != 0:
+            raise OSError(f"{' '.join(self.command)} failed: {self.proc.stderr.read().decode().strip()}")
+        return n
+
+    def close(self) -> None:
+        if not self.closed:
+            if self.proc.poll() is None:
+                self.proc.terminate()
+            self.proc.stdout.close()
+            self.proc.stderr.close()
+            self.proc.wait()
+        super().close()
+
+
+def open_file(filename: str, mode: str = "rb", external: bool = None):
+    """
+    Opens a plain or compressed (gz / xz / bz2) file for streaming reads. Compressed files are piped through a
+    multithreaded decompressor (pigz, xz -T0, lbzip2) when one is installed, else the standard library module,
+    and are decompressed as the parser reads: nothing goes to disk and only what is read is inflated.
+    mode is "rb", or "r" / "rt" for text.
+    """
+    kind = compression(filename)
+    if kind is None:
+        return open(filename, mode)
+    external = USE_EXTERNAL if external is None else external
+    stream = None
+    for command in DECOMPRESSORS[kind] if external else []:
+        if shutil.which(command[0]):
+            c_log.debug(f"{filename}: {kind} through {command[0]}")
+            stream = io.BufferedReader(_PipeReader(command, filename), buffer_size=1 << 20)
+            break
+    if stream is None:
+        c_log.debug(f"{filename}: {kind} through the standard library")
+        stream = STDLIB[kind](filename, "rb")
+    return stream if "b" in mode else io.TextIOWrapper(stream, encoding="utf-8")
+
+
+def iterparse(filename: str, events=("end",)):
+    """
+    ET.iterparse over a plain or compressed file. The file (and any decompressor) is closed when the loop ends
+    or is left early, a parser stopping after the first ionic steps stops the decompression there too.
+    """
+    with open_file(filename) as f:
+        yield from ET.iterparse(f, events=events)
+
+
+def read_file(filename: str) -> bytes:
+    """
+    Whole decompressed content, for parsers that need random access (regex scans)
+    """
+    with open_file(filename) as f:
+        return f.read()
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import sys, argparse, logging
+
+import numpy as np
+
+from compressed import iterparse, find_file
+import profiling
+
+# Adopted format: level - current function name - mess. Width is fixed as visual aid
+c_log = logging.getLogger(__name__)
+std_format = '[%(levelname)5s - %(funcName)10s] %(message)s'
+logging.basicConfig(format=std_format)
+c_log.setLevel(logging.WARNING)
+
+ORBITAL_GROUPS = {"s": ("s",),
+                  "p": ("px", "py", "pz"),
+                  "d": ("dxy", "dyz", "dz2", "dxz", "dx2", "x2-y2"),
+                  "f": ("fy3x2", "fxyz", "fyz2", "fz3", "fxz2", "fzx2", "fx3",
+                        "f-3", "f-2", "f-1", "f0", "f1", "f2", "f3")}
+
+
+def orbital_mask(fields, orbitals=None) -> np.ndarray:
+    """
+    Boolean mask over the <projected> field names, orbital groups (s, p, d, f) expand to their members.
+    None selects every orbital.
+    """
+    if orbitals is None:
+        return np.ones(len(fields), dtype=bool)
+    wanted = set()
+    for orbital in orbitals:
+        wanted.update(ORBITAL_GROUPS.get(orbital, (orbital,)))
+    return np.array([f in wanted for f in fields], dtype=bool)
+
+
+def ion_mask(symbols, ions=None) -> np.ndarray:
+    """
+    ions can hold element symbols or 1 based site indices (as VASP counts them), None selects every ion.
+    """
+    if ions is None:
+        return np.ones(len(symbols), dtype=bool)
+    mask = np.zeros(len(symbols), dtype=bool)
+    for ion in ions:
+        if str(ion).isdigit():
+            mask[int(ion) - 1] = True
+        else:
+            mask |= np.array([s == ion for s in symbols])
+    return mask
+
+
+def _set_index(elem, prefix: str) -> int:
+    """
+    0 based index from a <set comment="kpoint 3"> style comment (the projected block writes spin1 without a space)
+    """
+    return int(elem.get("comment")[len(prefix):]) - 1
+
+
+def _in_projection(stack: list) -> bool:
+    """
+    Inside <projected><array>, the projections themselves. VASP writes a <projected><eigenvalues> copy of the
+    eigenvalues (fields eigene / occ) before it, which has to be told apart.
+    """
+    return "projected" in stack and stack[stack.index("projected") + 1:stack.index("projected") + 2] == ["array"]
+
+
+def stream_projections(filename: str = "vasprun.xml", ions=None, orbitals=None, spins=None) -> dict:
+    """
+    Streams a vasprun.xml keeping the last eigenvalues plus, while walking the <projected> block, only the sum of
+    the selected ion / orbital projections per (spin, kpoint, band). Unselected spins are skipped without
+    conversion and the full (spin x kpoint x band x ion x orbital) array is never built.
+    """
+    data = {"symbols": [], "weights": None, "efermi": None}
+    nbands, ispin = None, 1
+    eigen = proj = None
+    ions_sel = orbs_sel = None
+    fields = []
+    stack = []
+    spin = kpt = band = -1
+
+    for event, elem in iterparse(filename, events=("start", "end")):
+        tag = elem.tag
+        if event == "start":
+            stack.append(tag)
+            if tag == "eigenvalues" and stack[-2] == "calculation" and eigen is None:
+                eigen = np.zeros((ispin, len(data["weights"]), nbands))
+            elif tag == "projected" and proj is None:
+                proj = np.zeros((ispin, len(data["weights"]), nbands))
+            elif tag == "set" and ("eigenvalues" in stack or "projected" in stack):
+                comment = elem.get("comment", "")
+                if comment.startswith("spin"):
+                    spin = _set_index(elem, "spin")
+                elif comment.startswith("kpoint"):
+                    kpt, band = _set_index(elem, "kpoint"), 0
+                elif comment.startswith("band"):
+                    band = _set_index(elem, "band")
+                elif stack[-3:-1] == ["projected", "array"] and orbs_sel is None:  # Fields are read by the first set
+                    orbs_sel = orbital_mask(fields, orbitals)
+                    ions_sel = ion_mask(data["symbols"], ions)
+                    c_log.info(f"Summing {ions_sel.sum()} ions x {[f for f, m in zip(fields, orbs_sel) if m]}")
+            continue
+
+        stack.pop()
+        in_projected = "projected" in stack
+        if tag == "r" and kpt >= 0 and not in_projected and "eigenvalues" in stack:
+            eigen[spin, kpt, band] = float(elem.text.split()[0])
+            band += 1
+        elif tag == "set" and _in_projection(stack) and elem.get("comment", "").startswith("band"):
+            if spins is None or spin + 1 in spins:
+                rows = np.fromstring(" ".join(r.text for r in elem), sep=" ").reshape((len(ions_sel), -1))
+                proj[spin, kpt, band] = rows[ions_sel][:, orbs_sel].sum()
+        elif tag == "field" and stack[-2:] == ["projected", "array"]:
+            fields.append(elem.text.strip())
+        elif tag == "array" and elem.get("name") == "atoms" and "atominfo" in stack:
+            data["symbols"] = [rc[0].text.strip() for rc in elem.iter("rc")]
+        elif tag == "varray" and elem.get("name") == "weights" and stack[-1] == "kpoints":
+            data["weights"] = np.array([float(v.text) for v in elem])
+        elif tag == "i" and elem.get("name") == "NBANDS" and nbands is None:
+            nbands = int(elem.text)
+        elif tag == "i" and elem.get("name") == "ISPIN" and "parameters" in stack:
+            ispin = int(elem.text)
+        elif tag == "i" and elem.get("name") == "efermi":
+            data["efermi"] = float(elem.text)
+
+        if tag == "set" and "atominfo" not in stack or tag in ("calculation", "kpoints", "structure", "parameters"):
+            elem.clear()  # Drop what has been read so memory stays flat through the file
+
+    if eigen is None:
+        raise ValueError(f"No <eigenvalues> block found in {filename}")
+    if proj is None:
+        raise ValueError(f"No <projected> block found in {filename}, was the run done with LORBIT?")
+    data["eigenvalues"], data["projections"] = eigen, proj
+    return data
+
+
+def smear(energies: np.ndarray, weights: np.ndarray, grid: np.ndarray, sigma: float) -> np.ndarray:
+    """
+    Gaussian broadened DOS on grid: the weighted states are binned per spin and the bins convolved with the
+    gaussian in one FFT, rather than summing a gaussian per state. energies / weights are (spin x states).
+    Each state is shared linearly between its two neighbouring grid points to keep the binning error small.
+    """
+    n = len(grid)
+    de = grid[1] - grid[0]
+    position = (energies - grid[0]) / de
+    lower = np.floor(position).astype(int)
+    upper_share = position - lower
+    binned = np.zeros((len(energies), n + 1))
+    for spin in range(len(energies)):
+        inside = (lower[spin] >= 0) & (lower[spin] < n)
+        low, share, w = lower[spin][inside], upper_share[spin][inside], weights[spin][inside]
+        binned[spin] += np.bincount(low, weights=w * (1 - share), minlength=n + 1)[:n + 1]
+        binned[spin] += np.bincount(low + 1, weights=w * share, minlength=n + 1)[:n + 1]
+    binned = binned[:, :n] / de
+    if sigma <= 0:
+        return binned
+
+    offsets = (np.arange(2 * n) - n) * de
+    kernel = np.exp(-0.5 * (offsets / sigma) ** 2)
+    kernel /= kernel.sum()
+    size = 4 * n  # Zero padding so the convolution doesn't wrap round
+    full = np.fft.irfft(np.fft.rfft(binned, size, axis=-1) * np.fft.rfft(kernel, size), size, axis=-1)
+    return full[:, n:2 * n]
+
+
+def dos_from_vasprun(vasprun: str = "vasprun.xml", ions=None, orbitals=None, spins=None, sigma: float = 0.05,
+                     npoints: int = 3001, erange=None) -> dict:
+    """
+    Projected DOS from vasprun.xml. Choose the ions (element symbols or 1 based indices), orbitals
+    (s, p, d, f or single ones like px, dz2) and spins up front, only those projections are accumulated while
+    the file streams past. The total and projected DOS come back as (spin x npoints) arrays in states/eV.
+    """
+    with profiling.phase("parse"):
+        data = stream_projections(vasprun, ions=ions, orbitals=orbitals, spins=spins)
+    eigen, proj = data["eigenvalues"], data["projections"]
+    spin_factor = 2 / eigen.shape[0]  # Non spin polarised bands hold two electrons, same as the DOSCAR total
+    if spins is not None:
+        keep = [s - 1 for s in spins if s <= eigen.shape[0]]
+        eigen, proj = eigen[keep], proj[keep]
+
+    if erange is None:
+        erange = (eigen.min() - 5 * sigma, eigen.max() + 5 * sigma)
+    grid = np.linspace(erange[0], erange[1], npoints)
+    k_weights = np.broadcast_to(data["weights"][None, :, None], eigen.shape) * spin_factor
+
+    flat = eigen.reshape((eigen.shape[0], -1))
+    with profiling.phase("smear"):
+        total = smear(flat, k_weights.reshape(flat.shape), grid, sigma)
+        projected = smear(flat, (k_weights * proj).reshape(flat.shape), grid, sigma)
+    c_log.info(f"{eigen.shape} (spin, kpoint, band) states smeared onto {npoints} points")
+    return {"energies": grid, "total": total, "projected": projected, "efermi": data["efermi"]}
+
+
+def cli_run(argv) -> None:
+    """
+    Wrapper for the above command, handles parsing of args and logging, to avoid mess
+    """
+
+    global c_log
+
+    parser = argparse.ArgumentParser(description=dos_from_vasprun.__doc__)  # Parser init
+    parser.add_argument("vasprun", type=str, default="vasprun.xml", nargs="?", help="vasprun file location")
+    parser.add_argument("-a", "--ions", dest="ions", type=str, nargs="+", default=None,
+                        help="Element symbols and/or 1 based site indices to project onto")
+    parser.add_argument("-l", "--orbitals", dest="orbitals", type=str, nargs="+", default=None,
+                        help="s, p, d, f or single orbitals i.e px dz2")
+    parser.add_argument("-s", "--spin", dest="spins", type=int, nargs="+", default=None, choices=[1, 2],
+                        help="Spin channels to keep (1 up, 2 down)")
+    parser.add_argument("--sigma", dest="sigma", type=float, default=0.05, help="Gaussian smearing width in eV")
+    parser.add_argument("--npoints", dest="npoints", type=int, default=3001, help="Energy grid points")
+    parser.add_argument("--erange", dest="erange", type=float, nargs=2, default=None, help="Energy window in eV")
+    parser.add_argument("-o", "--output", dest="output", type=str, default=None,
+                        help="Write to file, .npz for arrays anything else for a text table")
+    parser.add_argument("--debug", dest="debug", action="store_true")  # Always have the debug optional
+    parser.add_argument("--verbose", dest="verbose", action="store_true")  # Always have the verbose optional
+
+    profiling.add_profile_argument(parser)
+    args = parser.parse_args(argv)
+
+    if args.debug:  # Always include method for switching verbosity
+        c_log.setLevel(logging.DEBUG)
+    if args.verbose:
+        c_log.setLevel(logging.INFO)
+    c_log.debug(args)
+    profiling.start(args.profile)
+    args.vasprun = find_file(args.vasprun) or args.vasprun  # vasprun.xml.gz etc when there is no plain file
+
+    dos = dos_from_vasprun(args.vasprun, ions=args.ions, orbitals=args.orbitals, spins=args.spins,
+                           sigma=args.sigma, npoints=args.npoints, erange=args.erange)
+
+    with profiling.phase("write"):
+        if args.output is not None and args.output.endswith(".npz"):
+            np.savez_compressed(args.output, **{k: v for k, v in dos.items() if v is not None})
+        else:
+            n_spin = len(dos["total"])
+            table = np.column_stack([dos["energies"]] + list(dos["total"]) + list(dos["projected"]))
+            header = f"# energy  total x{n_spin}  projected x{n_spin}  efermi = {dos['efermi']}"
+            text = header + "\n" + "\n".join(" ".join(f"{x:12.6f}" for x in row) for row in table)
+            if args.output is None:
+                print(text)
+            else:
+                with open(args.output, "w") as f:
+                    f.write(text + "\n")
+    profiling.report()
+
+
+if __name__ == "__main__":
+    cli_run(sys.argv[1:])
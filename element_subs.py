@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import sys, argparse, logging, os, heapq
+from itertools import combinations, islice
+from math import comb
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from pymatgen.core import Structure
+from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
+
+from make_supercell import supercell_arrays, lattice_points_in_supercell
+from poscar_writer import poscar_string
+import profiling
+
+# Adopted format: level - current function name - mess. Width is fixed as visual aid
+c_log = logging.getLogger(__name__)
+std_format = '[%(levelname)5s - %(funcName)10s] %(message)s'
+logging.basicConfig(format=std_format)
+c_log.setLevel(logging.WARNING)
+
+
+def _scale_matrix(scale_matrix) -> np.ndarray:
+    scale_matrix = np.array([1, 1, 1] if scale_matrix is None else scale_matrix, dtype=int)
+    if scale_matrix.shape != (3, 3):
+        scale_matrix = scale_matrix * np.eye(3, dtype=int)
+    return scale_matrix
+
+
+def supercell_operations(parent: Structure, scale_matrix=None, symprec: float = 0.01) -> tuple:
+    """
+    Symmetry operations of the parent cell expressed in the supercell's fractional basis, as (rotations, translations)
+    in row vector form (x' = x @ R + t). Rotations that don't map the supercell lattice onto itself are dropped
+    (i.e the 4-fold axis of a 2x1x1 cell) and every surviving operation is combined with the parent lattice
+    translations inside the supercell.
+    """
+    scale_matrix = _scale_matrix(scale_matrix)
+    inverse = np.linalg.inv(scale_matrix)
+
+    rotations, translations = [], []
+    for op in SpacegroupAnalyzer(parent, symprec=symprec).get_symmetry_operations(cartesian=False):
+        rotation = scale_matrix @ op.rotation_matrix.T @ inverse
+        if not np.allclose(rotation, np.round(rotation), atol=1e-6):
+            continue
+        rotations.append(np.round(rotation))
+        translations.append(op.translation_vector @ inverse)
+    c_log.info(f"{len(rotations)} parent operations kept in the supercell, "
+               f"x {round(abs(np.linalg.det(scale_matrix)))} lattice translations")
+    return np.array(rotations), np.array(translations), lattice_points_in_supercell(scale_matrix)
+
+
+def site_permutations(frac_coords: np.ndarray, lattice: np.ndarray, operations: tuple, tol: float = 0.1) -> np.ndarray:
+    """
+    How each operation permutes the given sites, (n_ops x n_sites) with perm[o, i] the site that i is sent to.
+    Rotation parts and lattice translations are matched separately and composed, n_sites^2 work per rotation and per
+    translation rather than per operation. tol is the cartesian matching distance in Angstrom.
+    """
+    rotations, translations, lattice_shifts = operations
+
+    def match(images):
+        d = images[:, None, :] - frac_coords[None, :, :]
+        d -= np.round(d)
+        dist = np.linalg.norm(d @ lattice, axis=-1)
+        nearest = np.argmin(dist, axis=1)
+        if dist[np.arange(len(images)), nearest].max() > tol or len(np.unique(nearest)) != len(images):
+            return None
+        return nearest
+
+    rot_perms = [p for p in (match(frac_coords @ r + t) for r, t in zip(rotations, translations)) if p is not None]
+    if len(rot_perms) < len(rotations):
+        c_log.warning(f"{len(rotations) - len(rot_perms)} operations don't map the sites onto themselves, dropped")
+    shift_perms = [p for p in (match(frac_coords + s) for s in lattice_shifts) if p is not None]
+    perms = np.array([s[r] for r in rot_perms for s in shift_perms])
+    return np.unique(perms, axis=0)  # Operations that act the same on these sites only need checking once
+
+
+def _canonical(chunk: np.ndarray, perms: np.ndarray) -> np.ndarray:
+    """
+    Mask of the combinations (rows of sorted site indices) that are the lexicographically smallest image of
+    themselves under every permutation, exactly one per symmetry equivalence class survives.
+    """
+    images = np.sort(perms[:, chunk], axis=-1)  # (ops x chunk x k)
+    differ = images != chunk[None]
+    first = np.argmax(differ, axis=-1)
+    smaller = np.take_along_axis(images, first[..., None], -1)[..., 0] < np.take_along_axis(
+        np.broadcast_to(chunk, images.shape), first[..., None], -1)[..., 0]
+    return ~np.any(smaller & differ.any(axis=-1), axis=0)
+
+
+# Set once per worker by _init_worker, so the permutation table and Ewald matrix are not pickled with every chunk
+_SHARED = {}
+
+
+def _init_worker(perms, ewald) -> None:
+    _SHARED["perms"] = perms
+    _SHARED["ewald"] = ewald
+
+
+def _filter_chunk(chunk: np.ndarray) -> list:
+    """
+    Worker: canonical combinations of a chunk with their orbit size and, if set up, Ewald energy
+    """
+    perms, ewald = _SHARED["perms"], _SHARED["ewald"]
+    unique = chunk[_canonical(chunk, perms)]
+    energies = ewald_energies(unique, **ewald) if ewald is not None else [None] * len(unique)
+    return [(tuple(int(i) for i in c), len(np.unique(np.sort(perms[:, c], axis=-1), axis=0)), e)
+            for c, e in zip(unique, energies)]
+
+
+def _chunks(n_sites: int, n_subs: int, size: int, firsts):
+    """
+    Combinations in chunks, only those starting at one of firsts
+    """
+    it = ((first,) + rest for first in firsts for rest in combinations(range(first + 1, n_sites), n_subs - 1))
+    while True:
+        chunk = np.array(list(islice(it, size)), dtype=np.int32).reshape((-1, n_subs))
+        if not len(chunk):
+            return
+        yield chunk
+
+
+def ewald_setup(structure: Structure, sites, charge: float) -> dict:
+    """
+    Ewald matrix of the oxidation state decorated parent, scaled so a substitution only changes the charge
+    scale of the substituted sites: E = s M s with s = q_new / q_parent, done per candidate in O(k^2).
+    Energies of different candidates are only comparable because they share one composition (and net charge),
+    the charged cell background pymatgen adds to total_energy is the same constant for all of them and left out.
+    """
+    from pymatgen.analysis.ewald import EwaldSummation
+
+    matrix = EwaldSummation(structure).total_energy_matrix
+    parent = np.array([site.specie.oxi_state for site in structure], dtype=float)[sites]
+    if np.any(parent == 0):
+        raise ValueError("Substituted sites carry a zero oxidation state, set it with --ox")
+    sites = np.asarray(sites)
+    sub = matrix[np.ix_(sites, sites)]
+    return {"total": float(matrix.sum()), "row_sums": matrix[sites].sum(axis=1), "sub_matrix": sub,
+            "scale": charge / parent - 1}
+
+
+def ewald_energies(chunk: np.ndarray, total: float, row_sums: np.ndarray, sub_matrix: np.ndarray,
+                   scale: np.ndarray) -> np.ndarray:
+    """
+    Ewald energy for each row of substituted (local) site indices, vectorised over the chunk
+    """
+    d = scale[chunk]
+    cross = sub_matrix[chunk[:, :, None], chunk[:, None, :]]
+    return total + 2 * np.sum(d * row_sums[chunk], axis=1) + np.einsum("bi,bij,bj->b", d, cross, d)
+
+
+def unique_substitutions(structure: Structure, species: str, n_subs: int, operations: tuple, charge: float = None,
+                         processes: int = 1, chunk_size: int = None, symprec_distance: float = 0.1):
+    """
+    Generator over the symmetry unique ways of substituting n_subs of the species sites, yielding
+    (site indices into structure, multiplicity, ewald energy or None). Combinations are checked in chunks,
+    chunks go to a process pool with only a few in flight so neither the combinations nor the results are ever
+    held as a whole list. If charge is given (needs oxidation states on structure) each result carries the
+    prescreen Ewald energy.
+    """
+    sites = np.array([i for i, site in enumerate(structure) if site.specie.symbol == species])
+    if not len(sites):
+        raise ValueError(f"No {species} sites in {structure.composition.reduced_formula}")
+    if not 0 < n_subs <= len(sites):
+        raise ValueError(f"Can't substitute {n_subs} of {len(sites)} {species} sites")
+
+    perms = site_permutations(structure.frac_coords[sites], structure.lattice.matrix, operations,
+                              tol=symprec_distance)
+    perms = perms.astype(np.int32)
+    # A canonical combination starts at the lowest index of that site's orbit, so only those starts are generated
+    firsts = np.flatnonzero(np.all(perms >= np.arange(len(sites)), axis=0))
+    total = sum(comb(len(sites) - 1 - first, n_subs - 1) for first in firsts)
+    c_log.info(f"{total} of {comb(len(sites), n_subs)} combinations of {n_subs}/{len(sites)} {species} sites to check, "
+               f"{len(perms)} distinct operations")
+    if total > 1E08:
+        c_log.warning(f"{total} combinations to check, this will take a while")
+
+    ewald = ewald_setup(structure, sites, charge) if charge is not None else None
+    chunk_size = chunk_size or max(1, min(65536, int(4E06 // (len(perms) * n_subs))))  # Bounds the ops x chunk block
+    chunks = _chunks(len(sites), n_subs, chunk_size, firsts)
+
+    if processes <= 1:
+        _init_worker(perms, ewald)
+        for chunk in chunks:
+            for c, mult, energy in _filter_chunk(chunk):
+                yield sites[list(c)], mult, energy
+        return
+
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=(perms, ewald)) as pool:
+        pending = [pool.submit(_filter_chunk, chunk) for chunk in islice(chunks, 2 * processes)]
+        while pending:
+            results = pending.pop(0).result()  # In order, so the output numbering doesn't depend on the pool
+            pending.extend(pool.submit(_filter_chunk, chunk) for chunk in islice(chunks, 1))
+            for c, mult, energy in results:
+                yield sites[list(c)], mult, energy
+
+
+def substituted_poscar(structure: Structure, indices, new_species: str, comment: str = None) -> str:
+    """
+    POSCAR string of structure with the sites at indices swapped to new_species, the new sites moved to the end
+    so the species lines stay grouped. Built from the arrays, no Structure copy per candidate.
+    """
+    symbols = np.array([site.specie.symbol for site in structure], dtype=object)
+    symbols[indices] = new_species
+    order = np.concatenate((np.setdiff1d(np.arange(len(structure)), indices), np.sort(indices)))
+    symbols = symbols[order]
+    return poscar_string(structure.lattice.matrix, structure.frac_coords[order], labels=symbols,
+                         symbols=symbols.astype(str),
+                         comment=comment or f"{species_count(symbols)} sub {' '.join(str(i) for i in indices)}")
+
+
+def species_count(symbols) -> str:
+    names, starts, counts = np.unique(symbols.astype(str), return_index=True, return_counts=True)
+    return "".join(f"{n}{c}" for _, n, c in sorted(zip(starts, names, counts)))
+
+
+def substitution_candidates(parent: Structure, species: str, n_subs: int, scale_matrix=None, symprec: float = 0.01,
+                            processes: int = 1, charge: float = None) -> tuple:
+    """
+    The supercell of parent (site properties / oxidation states carried over) and the unique_substitutions
+    generator over it, using the parent's operations
+    """
+    structure = parent
+    if scale_matrix is not None:
+        lattice, frac_coords, site_index = supercell_arrays(parent.lattice.matrix, parent.frac_coords, scale_matrix)
+        structure = Structure(lattice, [parent[i].species for i in site_index], frac_coords)
+    operations = supercell_operations(parent, scale_matrix, symprec=symprec)
+    return structure, unique_substitutions(structure, species, n_subs, operations, charge=charge, processes=processes)
+
+
+def element_subs(structure: Structure, species: str, new_species: str, n_subs: int, scale_matrix=None,
+                 output: str = "subs", symprec: float = 0.01, processes: int = 1, charge: float = None,
+                 top: int = None) -> int:
+    """
+    Enumerates the symmetry unique substitutions of n_subs species sites by new_species in the supercell
+    (scale_matrix) of the structure, deduped with the parent cell's space group operations.
+    Each unique structure is written as it is found to output/POSCAR_00001 ..., with index.csv holding the
+    substituted sites, multiplicity and optional Ewald prescreen energy. Giving the new species charge turns the
+    prescreen on, with top only the lowest Ewald energy candidates are written.
+    Returns the number of structures written.
+    """
+    if top is not None and charge is None:
+        raise ValueError("Ranking the top candidates needs the Ewald prescreen, give the new species charge")
+    structure, candidates = substitution_candidates(structure, species, n_subs, scale_matrix=scale_matrix,
+                                                    symprec=symprec, processes=processes, charge=charge)
+    os.makedirs(output, exist_ok=True)
+    if top is not None:  # Only the best top are kept, as a bounded heap
+        with profiling.phase("enumerate"):
+            best = heapq.nsmallest(top, candidates, key=lambda x: x[2])
+        candidates = iter(best)
+
+    written = 0
+    with open(os.path.join(output, "index.csv"), "w") as index, profiling.phase("enumerate+write"):
+        index.write("name,multiplicity,ewald_energy,sites\n")
+        for indices, mult, energy in candidates:
+            written += 1
+            name = f"POSCAR_{written:05d}"
+            with open(os.path.join(output, name), "w") as f:
+                f.write(substituted_poscar(structure, indices, new_species) + "\n")
+            index.write(f"{name},{mult},{'' if energy is None else f'{energy:.6f}'},{' '.join(map(str, indices))}\n")
+    c_log.info(f"{written} unique structures written to {output}")
+    return written
+
+
+def parse_ox(values) -> dict:
+    ox = {}
+    for value in values or []:
+        element, state = value.split("=")
+        ox[element] = float(state)
+    return ox
+
+
+def cli_run(argv) -> None:
+    """
+    Wrapper for the above command, handles parsing of args and logging, to avoid mess
+    """
+
+    global c_log
+
+    parser = argparse.ArgumentParser(description=element_subs.__doc__)  # Parser init
+    parser.add_argument("poscar", type=str, default="POSCAR", nargs="?", help="Location of POSCAR file")
+    parser.add_argument("-e", "--element", dest="element", type=str, required=True, help="Species to substitute")
+    parser.add_argument("-r", "--replace", dest="replace", type=str, required=True, help="Species put in its place")
+    parser.add_argument("-n", "--number", dest="number", type=int, default=None, help="Sites substituted")
+    parser.add_argument("-x", "--fraction", dest="fraction", type=float, default=None,
+                        help="Fraction of the element's sites substituted, instead of -n")
+    parser.add_argument("-s", "--scale", dest="scale_matrix", type=int, nargs="+", default=None,
+                        help="Supercell of the POSCAR to enumerate in, 3 (diagonal) or 9 (row major) integers")
+    parser.add_argument("-o", "--output", dest="output", type=str, default="subs", help="Folder for the POSCARs")
+    parser.add_argument("-p", "--processes", dest="processes", type=int, default=1, help="Processes to enumerate with")
+    parser.add_argument("--symprec", dest="symprec", type=float, default=0.01, help="Symmetry tolerance")
+    parser.add_argument("--ewald", dest="ewald", action="store_true",
+                        help="Prescreen with the Ewald energy, needs --ox for the replacing species, "
+                             "the others are guessed unless given")
+    parser.add_argument("--ox", dest="ox", type=str, nargs="+", default=None,
+                        help="Oxidation states as El=state, i.e Li=1 Co=3 O=-2 Mg=2 (implies --ewald, must include "
+                             "the replacing species)")
+    parser.add_argument("--top", dest="top", type=int, default=None,
+                        help="Only write the top lowest Ewald energy structures (implies --ewald)")
+    parser.add_argument("--count", dest="count", action="store_true",
+                        help="Only print how many unique structures there are")
+    parser.add_argument("--debug", dest="debug", action="store_true")  # Always have the debug optional
+    parser.add_argument("--verbose", dest="verbose", action="store_true")  # Always have the verbose optional
+
+    profiling.add_profile_argument(parser)
+    args = parser.parse_args(argv)
+
+    if args.debug:  # Always include method for switching verbosity
+        c_log.setLevel(logging.DEBUG)
+    if args.verbose:
+        c_log.setLevel(logging.INFO)
+    c_log.debug(args)
+    profiling.start(args.profile)
+
+    scale_matrix = args.scale_matrix
+    if scale_matrix is not None and len(scale_matrix) == 9:
+        scale_matrix = [scale_matrix[0:3], scale_matrix[3:6], scale_matrix[6:9]]
+    elif scale_matrix is not None and len(scale_matrix) != 3:
+        parser.error(f"--scale needs 3 or 9 integers, got {len(scale_matrix)}")
+
+    with profiling.phase("parse"):
+        structure = Structure.from_file(filename=args.poscar)
+    n_cells = round(abs(np.linalg.det(_scale_matrix(scale_matrix))))
+    n_sites = sum(site.specie.symbol == args.element for site in structure) * n_cells
+    number = args.number if args.number is not None else (
+        round(args.fraction * n_sites) if args.fraction is not None else None)
+    if number is None:
+        parser.error("Give the number of substitutions with -n or a fraction with -x")
+
+    charge = None
+    ox = parse_ox(args.ox)
+    if args.ewald or args.ox or args.top:
+        if args.replace not in ox:  # An isovalent charge scales nothing, every candidate would tie
+            parser.error(f"--ewald / --top rank by charge, give the oxidation state of {args.replace} "
+                         f"with --ox {args.replace}=<state>")
+        if len(ox) > 1:
+            structure.add_oxidation_state_by_element({k: v for k, v in ox.items() if k != args.replace})
+        else:
+            from ox_cache import OxidationCache, add_oxidation_state_cached
+            add_oxidation_state_cached(structure, cache=OxidationCache())
+        charge = ox[args.replace]
+        host = next(s.specie.oxi_state for s in structure if s.specie.symbol == args.element)
+        if charge == host:
+            c_log.warning(f"{args.replace} has the same oxidation state as {args.element} ({host}), every candidate "
+                          f"has the same Ewald energy and the ranking / --top keeps an arbitrary subset")
+
+    if args.count:
+        with profiling.phase("enumerate"):
+            _, candidates = substitution_candidates(structure, args.element, number, scale_matrix=scale_matrix,
+                                                    symprec=args.symprec, processes=args.processes)
+            unique = weighted = 0
+            for _, mult, _ in candidates:
+                unique += 1
+                weighted += mult
+        print(f"{unique} unique of {weighted} substitutions of {number} {args.element} by {args.replace}")
+        profiling.report()
+        return
+
+    written = element_subs(structure, args.element, args.replace, number, scale_matrix=scale_matrix,
+                           output=args.output, symprec=args.symprec, processes=args.processes, charge=charge,
+                           top=args.top)
+    print(f"{written} structures written to {args.output}")
+    profiling.report()
+
+
+if __name__ == "__main__":
+    cli_run(sys.argv[1:])
@@ -3,10 +3,19 @@
 
 ## TODO - log this function
 
-import sys, argparse, logging
-import pandas as pd
+from __future__ import annotations  # Type hints only, pandas / pymatgen are imported where used
 
-from pymatgen.io.vasp import Vasprun
+import sys, argparse, logging, os
+import xml.etree.ElementTree as ET
+from typing import TYPE_CHECKING
+import numpy as np
+
+from compressed import iterparse, find_file, variants
+from vasp_scan import scan_file, scan_status, NELM, EDIFF
+import profiling
+
+if TYPE_CHECKING:
+    from pymatgen.io.vasp import Vasprun
 
 # Adopted format: level - current function name - mess. Width is fixed as visual aid
 c_log = logging.getLogger(__name__)
@@ -15,23 +24,26 @@ logging.basicConfig(format=std_format)
 c_log.setLevel(logging.WARNING)
 
 
-def energy_from_vasprun(vs: Vasprun, resolution: int = 1, electronic: bool = False) -> str:
+def energy_table(energies, resolution: int = 1, scf_energies=None, scf_offsets=None) -> str:
     """
-    Gets Energies from vasprun and returns the change in force as convergence improves
+    Formats ionic energies (already strided by resolution) as the step / energy table.
+    If the ragged scf_energies / scf_offsets pair is given, every electronic step is listed instead
     """
+    import pandas as pd
 
     x = ["ION_STEP"]
     y = ["Energy"]
     x_2 = ["E_STEP"]
-    for step, result in enumerate(vs.ionic_steps[::resolution]):
+    electronic = scf_energies is not None
+    for step, energy in enumerate(energies):
         if electronic:
-            for num, elec in enumerate(result["electronic_steps"]):
+            for num, elec in enumerate(scf_energies[scf_offsets[step]:scf_offsets[step + 1]]):
                 x_2.append(num)
-                y.append(round(elec["e_fr_energy"], 5))
+                y.append(round(elec, 5))
                 x.append(step * resolution)
         else:
-            energy = result["e_fr_energy"]
             y.append(round(energy, 5))
+            x.append(step * resolution)
 
     if electronic:
         zp = zip(x, x_2, y)
@@ -41,6 +53,259 @@ def energy_from_vasprun(vs: Vasprun, resolution: int = 1, electronic: bool = Fal
     return p.to_string(header=False, index=False)
 
 
+def energy_from_vasprun(vs: Vasprun, resolution: int = 1, electronic: bool = False) -> str:
+    """
+    Gets Energies from vasprun and returns the change in force as convergence improves
+    """
+
+    steps = vs.ionic_steps[::resolution]
+    energies = [result["e_fr_energy"] for result in steps]
+    if not electronic:
+        return energy_table(energies, resolution=resolution)
+
+    scf = [[elec["e_fr_energy"] for elec in result["electronic_steps"]] for result in steps]
+    scf_offsets = np.concatenate(([0], np.cumsum([len(x) for x in scf])))
+    return energy_table(energies, resolution=resolution,
+                        scf_energies=[e for x in scf for e in x], scf_offsets=scf_offsets)
+
+
+def energy_from_outcar(filename: str = "OUTCAR", resolution: int = 1, electronic: bool = False) -> str:
+    """
+    Same table as energy_from_vasprun read by the byte level scanner from an OUTCAR or OSZICAR,
+    useful when the vasprun is missing or truncated
+    """
+
+    scan = scan_file(filename, electronic=electronic)
+    energies = scan["energies"][::resolution]
+    if not electronic:
+        return energy_table(energies, resolution=resolution)
+
+    offsets = scan["scf_offsets"]
+    starts, stops = offsets[:-1][::resolution], offsets[1:][::resolution]
+    scf = [scan["scf_energies"][a:b] for a, b in zip(starts, stops)]
+    scf_offsets = np.concatenate(([0], np.cumsum([len(x) for x in scf])))
+    scf_energies = np.concatenate(scf) if scf else np.zeros(0)
+    return energy_table(energies, resolution=resolution, scf_energies=scf_energies, scf_offsets=scf_offsets)
+
+
+def stream_scf(filename: str = "vasprun.xml") -> dict:
+    """
+    Streams a vasprun.xml for the electronic steps only: the e_fr_energy of every <scstep> goes into one flat
+    array with offsets per ionic step (scf_energies[scf_offsets[i]:scf_offsets[i + 1]] belong to ionic step i),
+    the same ragged layout vasp_scan returns. NELM and EDIFF are taken from the parameters.
+    A truncated file keeps the ionic steps that were completed.
+    """
+    scf, offsets, energies = [], [0], []
+    nelm, ediff = 60, 1e-4
+    stack = []
+    try:
+        for event, elem in iterparse(filename, events=("start", "end")):
+            if event == "start":
+                stack.append(elem.tag)
+                continue
+            stack.pop()
+            tag = elem.tag
+            if tag == "i" and elem.get("name") == "e_fr_energy" and len(stack) > 1 and stack[-1] == "energy":
+                if stack[-2] == "scstep":
+                    scf.append(float(elem.text))
+                elif stack[-2] == "calculation":
+                    energies.append(float(elem.text))
+            elif tag == "i" and elem.get("name") == "NELM" and "parameters" in stack:
+                nelm = int(elem.text)
+            elif tag == "i" and elem.get("name") == "EDIFF" and "parameters" in stack:
+                ediff = float(elem.text)
+            elif tag == "calculation":
+                offsets.append(len(scf))
+                elem.clear()  # Nothing else in the step is needed, memory stays flat through the file
+            elif tag in ("structure", "varray", "dos", "eigenvalues", "projected"):
+                elem.clear()
+    except ET.ParseError as e:
+        c_log.warning(f"{filename} is truncated ({e}), keeping {len(offsets) - 1} complete ionic steps")
+
+    return {"energies": np.array(energies[:len(offsets) - 1]),
+            "scf_energies": np.array(scf[:offsets[-1]]), "scf_offsets": np.array(offsets),
+            "nelm": nelm, "ediff": ediff}
+
+
+def scf_statistics(scf_energies, scf_offsets, nelm: int = 60, ediff: float = 1e-4, tail: int = 3) -> dict:
+    """
+    Per ionic step statistics of the ragged electronic energies, vectorised over the whole run (no loop per step).
+        n_scf: electronic steps taken
+        de_final: |dE| of the last electronic step
+        de_tail: largest |dE| over the last tail electronic steps, a tail that stays large is a step that stalled
+        rate: convergence rate, least squares slope of log10|dE| per electronic step (-1 is a decade per step)
+        hit_nelm: step ran into NELM (None if nelm is unknown)
+        converged: de_final within EDIFF and NELM not hit (None if ediff is unknown)
+        n_running: electronic steps after the last complete ionic step, a running or truncated job
+    """
+    offsets = np.asarray(scf_offsets, dtype=int)
+    e = np.asarray(scf_energies, dtype=float)
+    n_running = len(e) - offsets[-1]
+    e = e[:offsets[-1]]  # Only complete ionic steps have statistics
+    counts = np.diff(offsets)
+    n = len(counts)
+    step = np.repeat(np.arange(n), counts)  # Ionic step of every electronic step
+
+    de = np.abs(np.diff(e))
+    same = step[1:] == step[:-1]  # Differences across an ionic step boundary aren't electronic steps
+    de, de_step = de[same], step[1:][same]
+    position = (np.arange(len(e)) - offsets[step])[1:][same]  # 1 based electronic step of each dE
+    n_de = np.bincount(de_step, minlength=n)
+
+    de_final = np.full(n, np.nan)
+    has = n_de > 0
+    last = np.cumsum(n_de) - 1
+    de_final[has] = de[last[has]]
+
+    in_tail = position > (counts[de_step] - 1 - tail)
+    de_tail = np.full(n, np.nan)
+    if in_tail.any():
+        tail_max = np.zeros(n)
+        np.maximum.at(tail_max, de_step[in_tail], de[in_tail])
+        de_tail[has] = tail_max[has]
+
+    y = np.log10(np.maximum(de, 1e-12))  # Exactly repeated energies would otherwise give -inf
+    x = position.astype(float)
+    sx, sy = np.bincount(de_step, x, n), np.bincount(de_step, y, n)
+    sxx, sxy = np.bincount(de_step, x * x, n), np.bincount(de_step, x * y, n)
+    denominator = n_de * sxx - sx ** 2
+    rate = np.full(n, np.nan)
+    fit = n_de > 1
+    rate[fit] = (n_de[fit] * sxy[fit] - sx[fit] * sy[fit]) / denominator[fit]
+
+    hit_nelm = counts >= nelm if nelm is not None else None
+    converged = None
+    if ediff is not None:
+        converged = (np.nan_to_num(de_final, nan=np.inf) <= ediff) & (~hit_nelm if hit_nelm is not None else True)
+    return {"n_scf": counts, "de_final": de_final, "de_tail": de_tail, "rate": rate,
+            "hit_nelm": hit_nelm, "converged": converged, "n_running": int(n_running)}
+
+
+def flag_scf(stats: dict, nelm: int = 60, slow_rate: float = -0.1, crowded: float = 0.8) -> list:
+    """
+    Reasons a run's SCF looks pathological, empty when it looks healthy:
+    any ionic step hitting NELM, the last ionic step not converged, a median rate slower than slow_rate
+    decades per step, or the average step count above the crowded fraction of NELM. A job still in an ionic step
+    is noted with how many electronic steps that step has taken. Checks needing an unknown NELM / EDIFF are skipped.
+    """
+    n = len(stats["n_scf"])
+    running = stats.get("n_running", 0)
+    running = [f"running: {running} electronic steps into ionic step {n}"] if running else []
+    if n == 0:
+        return ["no complete ionic steps"] + running
+    reasons = []
+    hits = int(stats["hit_nelm"].sum()) if stats["hit_nelm"] is not None else 0
+    if hits:
+        reasons.append(f"{hits}/{n} steps hit NELM")
+    if stats["converged"] is not None and not stats["converged"][-1]:
+        reasons.append("last step not converged")
+    rates = stats["rate"][~np.isnan(stats["rate"])]
+    if len(rates) and np.median(rates) > slow_rate:
+        reasons.append(f"slow rate {np.median(rates):.3f}")
+    if nelm is not None and stats["n_scf"].mean() > crowded * nelm:
+        reasons.append(f"mean {stats['n_scf'].mean():.1f} steps of NELM {nelm}")
+    return reasons + running
+
+
+def scf_parameters(filename: str) -> tuple:
+    """
+    (NELM, EDIFF) for the run filename belongs to: from the OUTCAR header, or for an OSZICAR (which doesn't
+    have them) from the OUTCAR or else the INCAR next to it. (None, None) when neither is there.
+    """
+    folder = os.path.dirname(filename)
+    outcar = filename if "OUTCAR" in os.path.basename(filename) else find_file(os.path.join(folder, "OUTCAR"))
+    if outcar is not None:
+        status = scan_status(outcar)
+        return status["nelm"], status["ediff"]
+    incar = find_file(os.path.join(folder, "INCAR"))
+    if incar is None:
+        c_log.info(f"No OUTCAR or INCAR next to {filename}, NELM and EDIFF are unknown")
+        return None, None
+    with open(incar, "rb") as f:
+        text = b"\n".join(line.split(b"#")[0].split(b"!")[0] for line in f)  # Drop comments
+    nelm, ediff = NELM.search(text), EDIFF.search(text)
+    return int(nelm.group(1)) if nelm else 60, float(ediff.group(1)) if ediff else 1e-4  # VASP defaults
+
+
+def read_scf(filename: str) -> dict:
+    """
+    Ragged electronic energies from a vasprun.xml, OUTCAR or OSZICAR (the last two through vasp_scan)
+    """
+    if any(x in os.path.basename(filename) for x in ("OUTCAR", "OSZICAR")):
+        scan = scan_file(filename, electronic=True)
+        nelm, ediff = scf_parameters(filename)
+        return {"energies": scan["energies"], "scf_energies": scan["scf_energies"],
+                "scf_offsets": scan["scf_offsets"], "nelm": nelm, "ediff": ediff}
+    return stream_scf(filename)
+
+
+def scf_stats_table(stats: dict, resolution: int = 1) -> str:
+    lines = [f"{'ION_STEP':>8s} {'N_SCF':>6s} {'dE_final':>10s} {'dE_tail':>10s} {'RATE':>7s}  FLAGS"]
+    for i in range(0, len(stats["n_scf"]), resolution):
+        flags = ("NELM " if stats["hit_nelm"] is not None and stats["hit_nelm"][i] else "") \
+            + ("UNCONVERGED" if stats["converged"] is not None and not stats["converged"][i] else "")
+        lines.append(f"{i:8d} {stats['n_scf'][i]:6d} {stats['de_final'][i]:10.2e} {stats['de_tail'][i]:10.2e} "
+                     f"{stats['rate'][i]:7.3f}  {flags}")
+    return "\n".join(lines)
+
+
+def _scf_summary(filename: str) -> dict:
+    """
+    One row of the folder report, failures are kept as a flag rather than stopping the sweep
+    """
+    try:
+        data = read_scf(filename)
+        stats = scf_statistics(data["scf_energies"], data["scf_offsets"], nelm=data["nelm"], ediff=data["ediff"])
+        rates = stats["rate"][~np.isnan(stats["rate"])]
+        return {"file": filename, "n_ionic": len(stats["n_scf"]),
+                "mean_scf": float(stats["n_scf"].mean()) if len(stats["n_scf"]) else 0.0,
+                "max_scf": int(stats["n_scf"].max()) if len(stats["n_scf"]) else 0,
+                "median_rate": float(np.median(rates)) if len(rates) else float("nan"),
+                "nelm": data["nelm"], "flags": flag_scf(stats, nelm=data["nelm"])}
+    except Exception as e:
+        c_log.debug(f"{filename}: {type(e).__name__}: {e}")
+        return {"file": filename, "n_ionic": 0, "flags": [f"unreadable: {type(e).__name__}"]}
+
+
+def find_scf_files(root: str) -> list:
+    """
+    One file per calculation folder under root: vasprun.xml, else OSZICAR, else OUTCAR
+    """
+    found = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in ("vasprun.xml", "OSZICAR", "OUTCAR"):
+            present = [x for x in variants(name) if x in filenames]
+            if present:
+                found.append(os.path.join(dirpath, present[0]))
+                break
+    return sorted(found)
+
+
+def scf_report(roots, processes: int = 1, flagged_only: bool = False) -> str:
+    """
+    SCF convergence survey over every calculation under roots, one line per run with its flags
+    """
+    files = [f for root in roots for f in (find_scf_files(root) if os.path.isdir(root) else [root])]
+    if processes > 1 and len(files) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            rows = list(pool.map(_scf_summary, files, chunksize=max(1, len(files) // (4 * processes))))
+    else:
+        rows = [_scf_summary(f) for f in files]
+
+    lines = [f"{'N_IONIC':>7s} {'MEAN_SCF':>8s} {'MAX_SCF':>7s} {'RATE':>7s}  {'FILE':40s} FLAGS"]
+    for row in rows:
+        if flagged_only and not row["flags"]:
+            continue
+        if row["n_ionic"] == 0:
+            lines.append(f"{0:7d} {'-':>8s} {'-':>7s} {'-':>7s}  {row['file']:40s} {'; '.join(row['flags'])}")
+            continue
+        lines.append(f"{row['n_ionic']:7d} {row['mean_scf']:8.1f} {row['max_scf']:7d} {row['median_rate']:7.3f}  "
+                     f"{row['file']:40s} {'; '.join(row['flags']) or 'ok'}")
+    c_log.info(f"{sum(bool(r['flags']) for r in rows)}/{len(rows)} runs flagged")
+    return "\n".join(lines)
+
+
 def cli_run(argv) -> None:
     """
     Wrapper for the above command, handles parsing of args and logging, to avoid mess
@@ -49,28 +314,85 @@ def cli_run(argv) -> None:
     global c_log
 
     parser = argparse.ArgumentParser(description=energy_from_vasprun.__doc__)  # Parser init
-    parser.add_argument("vasprun", type=str, default="vasprun.xml", help="vasprun file location")
+    parser.add_argument("vasprun", type=str, default=["vasprun.xml"], nargs="*",
+                        help="vasprun file location, an OUTCAR / OSZICAR is read with the fast scanner instead. "
+                             "Folders (or several files) give the SCF convergence report, one line per run")
 
     parser.add_argument("-r", "--res", dest="resolution", default=1, type=int,
                         help="Parse vasprun for every nth ionic step")
     parser.add_argument("-e", "--electronic", action="store_true",
                         help="whether to parse energies per every electronic step")
+    parser.add_argument("-s", "--scf-stats", dest="scf_stats", action="store_true",
+                        help="Per ionic step SCF statistics (steps, final / tail dE, convergence rate) instead")
+    parser.add_argument("--flagged", dest="flagged", action="store_true",
+                        help="SCF report only lists the runs flagged as pathological")
+    parser.add_argument("-n", "--processes", dest="processes", type=int, default=1,
+                        help="Processes for the SCF report over many runs")
     parser.add_argument("--debug", dest="debug", action="store_true")  # Always have the debug optional
     parser.add_argument("--verbose", dest="verbose", action="store_true")  # Always have the verbose optional
 
+    profiling.add_profile_argument(parser)
     args = parser.parse_args(argv)
 
     if args.debug:  # Always include method for switching verbosity
         c_log.setLevel(logging.DEBUG)
     if args.verbose:
         c_log.setLevel(logging.INFO)
+    c_log.debug(args)
+    profiling.start(args.profile)
+
+    if len(args.vasprun) > 1 or os.path.isdir(args.vasprun[0]):
+        with profiling.phase("scf_report"):
+            report = scf_report(args.vasprun, processes=args.processes, flagged_only=args.flagged)
+        print(report)
+        profiling.report()
+        return
+    args.vasprun = find_file(args.vasprun[0]) or args.vasprun[0]  # vasprun.xml.gz etc when there is no plain file
+
+    if args.scf_stats:
+        with profiling.phase("parse"):
+            data = read_scf(args.vasprun)
+        with profiling.phase("analyse"):
+            stats = scf_statistics(data["scf_energies"], data["scf_offsets"], nelm=data["nelm"], ediff=data["ediff"])
+            flags = flag_scf(stats, nelm=data["nelm"])
+        print(scf_stats_table(stats, resolution=args.resolution))
+        nelm = data["nelm"] if data["nelm"] is not None else "N/A"
+        ediff = f"{data['ediff']:.1e}" if data["ediff"] is not None else "N/A"
+        print(f"# NELM {nelm}, EDIFF {ediff}: {'; '.join(flags) or 'ok'}")
+        profiling.report()
+        return
+
+    if any(x in os.path.basename(args.vasprun) for x in ("OUTCAR", "OSZICAR")):
+        with profiling.phase("parse"):
+            table = energy_from_outcar(filename=args.vasprun, resolution=args.resolution, electronic=args.electronic)
+        print(table)
+        profiling.report()
+        return
 
-    vs = Vasprun(filename=args.vasprun,
-                 ionic_step_skip=0, ionic_step_offset=0,
-                 parse_dos=False, parse_eigen=False,
-                 parse_projected_eigen=False, parse_potcar_file=False, occu_tol=1e-8, exception_on_bad_xml=True)
+    from pymatgen.io.vasp import Vasprun
+    try:
+        with profiling.phase("parse"):
+            vs = Vasprun(filename=args.vasprun,
+                         ionic_step_skip=0, ionic_step_offset=0,
+                         parse_dos=False, parse_eigen=False,
+                         parse_projected_eigen=False, parse_potcar_file=False, occu_tol=1e-8,
+                         exception_on_bad_xml=True)
+    except Exception as e:  # Missing or truncated vasprun, fall back to the cheapest file next to it
+        folder = os.path.dirname(args.vasprun)
+        fallback = [x for x in (find_file(os.path.join(folder, name)) for name in ("OSZICAR", "OUTCAR")) if x]
+        if not fallback:
+            raise
+        c_log.warning(f"Could not read {args.vasprun} ({e}), falling back to {fallback[0]}")
+        with profiling.phase("parse"):
+            table = energy_from_outcar(filename=fallback[0], resolution=args.resolution, electronic=args.electronic)
+        print(table)
+        profiling.report()
+        return
 
-    print(energy_from_vasprun(vs=vs, resolution=args.resolution))
+    with profiling.phase("analyse"):
+        table = energy_from_vasprun(vs=vs, resolution=args.resolution, electronic=args.electronic)
+    print(table)
+    profiling.report()
 
 
 if __name__ == "__main__":
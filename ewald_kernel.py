@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import logging, itertools
+
+import numpy as np
+from scipy import constants
+from scipy.special import erfc
+from scipy.spatial import cKDTree
+
+# Adopted format: level - current function name - mess. Width is fixed as visual aid
+c_log = logging.getLogger(__name__)
+std_format = '[%(levelname)5s - %(funcName)10s] %(message)s'
+logging.basicConfig(format=std_format)
+c_log.setLevel(logging.WARNING)
+
+CONV_FACT = 1e10 * constants.e / (4 * np.pi * constants.epsilon_0)  # e^2 / (4 pi eps0) in eV * Angstrom
+BLOCK_ELEMENTS = 1 << 22  # Largest temporary in the blocked loops, 32 MB of float64
+
+
+def optimal_eta(n_sites: int, volume: float, weight: float = 2 ** -0.5) -> float:
+    """
+    Splitting parameter that balances the real and reciprocal sums for a given accuracy: the real sum costs
+    ~N^2 rmax^3 / V and the reciprocal one ~N gmax^3 V, with rmax ~ eta^-1/2 and gmax ~ eta^1/2 this is minimal at
+    eta = pi (weight N / V^2)^(1/3). weight is the relative cost of a reciprocal term, pymatgen's default is kept.
+    """
+    return np.pi * (weight * n_sites / volume ** 2) ** (1 / 3)
+
+
+def cutoffs(eta: float, accuracy: float = 12.0) -> tuple:
+    """
+    Real and reciprocal cutoffs where both sums' terms have fallen to 10^-accuracy
+    """
+    accf = np.sqrt(np.log(10 ** accuracy))
+    return accf / np.sqrt(eta), 2 * np.sqrt(eta) * accf
+
+
+class EwaldKernel:
+    """
+    Ewald sum of point charges at fixed positions, as the quadratic form E(q) = q.A.q (+ the charged cell term),
+    A being the same pair matrix as pymatgen's total_energy_matrix divided by q_i q_j.
+    Everything depends on the positions only, so one kernel serves every charge assignment of a structure.
+    Pair terms are evaluated in blocks of rows (real space, pairs within rmax found by a k-d tree over the sites'
+    periodic images) and of G vectors (reciprocal space, as matrix products of cos / sin phases) so no temporary
+    exceeds about block elements.
+    Only half of the G vectors are kept, S(-G) being the conjugate of S(G).
+    """
+
+    def __init__(self, lattice, cart_coords, eta: float = None, accuracy: float = 12.0,
+                 weight: float = 2 ** -0.5, block: int = BLOCK_ELEMENTS):
+        self.lattice = np.asarray(lattice, dtype=float)
+        self.coords = np.asarray(cart_coords, dtype=float).reshape((-1, 3))
+        self.n_sites = len(self.coords)
+        self.volume = abs(np.linalg.det(self.lattice))
+        self.eta = eta if eta else optimal_eta(self.n_sites, self.volume, weight)
+        self.sqrt_eta = np.sqrt(self.eta)
+        self.rmax, self.gmax = cutoffs(self.eta, accuracy)
+        self.block = block
+        self.wrapped = (self.coords @ np.linalg.inv(self.lattice)) % 1.0 @ self.lattice
+        self.images = self._images()
+        self._tree = None
+        self.gvectors, self.gweights = self._gvectors()
+        c_log.debug(f"eta {self.eta:.4f}, rmax {self.rmax:.3f} A ({len(self.images)} images), "
+                    f"gmax {self.gmax:.3f} 1/A ({len(self.gvectors)} G vectors)")
+
+    @classmethod
+    def from_structure(cls, structure, **kwargs):
+        return cls(structure.lattice.matrix, structure.cart_coords, **kwargs)
+
+    def _images(self) -> np.ndarray:
+        """
+        Lattice translations that can bring a site of the cell within rmax of another
+        """
+        spacing = self.volume / np.linalg.norm(np.cross(self.lattice[[1, 2, 0]], self.lattice[[2, 0, 1]]), axis=1)
+        reach = np.ceil(self.rmax / spacing).astype(int) + 1
+        shifts = np.array(list(itertools.product(*(range(-n, n + 1) for n in reach))), dtype=float)
+        images = shifts @ self.lattice
+        longest = np.linalg.norm(self.lattice, axis=1).sum()  # Bound on a displacement within the cell
+        return images[np.linalg.norm(images, axis=1) <= self.rmax + longest]
+
+    def _gvectors(self) -> tuple:
+        """
+        Half space of reciprocal lattice vectors 0 < |G| <= gmax, with the weight of each (both G and -G)
+        """
+        recip = 2 * np.pi * np.linalg.inv(self.lattice).T
+        reach = np.floor(self.gmax * np.linalg.norm(self.lattice, axis=1) / (2 * np.pi)).astype(int)
+        m = np.array(list(itertools.product(*(range(-n, n + 1) for n in reach))), dtype=int).reshape((-1, 3))
+        first = np.where(m[:, 0] != 0, m[:, 0], np.where(m[:, 1] != 0, m[:, 1], m[:, 2]))
+        g = m[first > 0] @ recip
+        g2 = (g ** 2).sum(axis=1)
+        g, g2 = g[g2 <= self.gmax ** 2], g2[g2 <= self.gmax ** 2]
+        weights = 2 * (2 * np.pi / self.volume) * CONV_FACT * np.exp(-g2 / (4 * self.eta)) / g2
+        return g, weights
+
+    def _phases(self):
+        """
+        cos / sin of G.r for all sites, in blocks of G vectors
+        """
+        size = max(1, self.block // max(self.n_sites, 1))
+        for start in range(0, len(self.gvectors), size):
+            theta = self.gvectors[start:start + size] @ self.coords.T
+            yield self.gweights[start:start + size], np.cos(theta), np.sin(theta)
+
+    def _real_rows(self, rows: np.ndarray) -> np.ndarray:
+        """
+        Real space part of A for the given rows: erfc(sqrt(eta) r) / r summed over lattice images, halved
+        """
+        if self._tree is None:  # Every site at every image, built once and shared by all row blocks
+            self._tree = cKDTree((self.images[:, None, :] + self.wrapped[None, :, :]).reshape((-1, 3)))
+        out = np.zeros((len(rows), self.n_sites))
+        per_row = 4 / 3 * np.pi * self.rmax ** 3 * self.n_sites / self.volume  # Pairs within rmax of a site
+        n_rows = max(1, int(self.block // max(per_row, self.n_sites)))
+        for start in range(0, len(rows), n_rows):
+            block = rows[start:start + n_rows]
+            pairs = cKDTree(self.wrapped[block]).sparse_distance_matrix(self._tree, self.rmax, output_type="ndarray")
+            pairs = pairs[pairs["v"] > 1e-8]  # A site and itself
+            flat = pairs["i"] * self.n_sites + pairs["j"] % self.n_sites
+            values = erfc(self.sqrt_eta * pairs["v"]) / pairs["v"]
+            out[start:start + len(block)] = np.bincount(flat, weights=values, minlength=len(block) * self.n_sites) \
+                .reshape((len(block), self.n_sites))
+        return 0.5 * CONV_FACT * out
+
+    def matrix_rows(self, rows=None) -> np.ndarray:
+        """
+        Rows of A (len(rows) x n_sites): real, reciprocal and, on the diagonal, self terms. All rows gives the
+        full matrix, a handful of rows is all an enumeration over a few variable sites needs.
+        """
+        rows = np.arange(self.n_sites) if rows is None else np.asarray(rows, dtype=int)
+        out = self._real_rows(rows)
+        for weights, cos, sin in self._phases():
+            out += (cos[:, rows] * weights[:, None]).T @ cos + (sin[:, rows] * weights[:, None]).T @ sin
+        out[np.arange(len(rows)), rows] -= CONV_FACT * np.sqrt(self.eta / np.pi)
+        return out
+
+    def charged_cell(self, total_charge: float) -> float:
+        """
+        Neutralising background energy of a charged cell, as pymatgen adds it to total_energy
+        """
+        return -CONV_FACT / 2 * np.pi / self.volume / self.eta * total_charge ** 2
+
+    def energy(self, charges, charged_cell: bool = True) -> float:
+        """
+        Total energy for one charge vector without holding A: the real part row block by row block, the
+        reciprocal part from the structure factor S(G) = sum_j q_j exp(i G.r_j), which is O(n_G N) rather than N^2.
+        """
+        q = np.asarray(charges, dtype=float)
+        rows = np.arange(self.n_sites)
+        size = max(1, self.block // max(self.n_sites, 1))
+        real = sum(q[rows[i:i + size]] @ self._real_rows(rows[i:i + size]) @ q for i in range(0, self.n_sites, size))
+        recip = sum(weights @ ((cos @ q) ** 2 + (sin @ q) ** 2) for weights, cos, sin in self._phases())
+        point = -CONV_FACT * np.sqrt(self.eta / np.pi) * (q ** 2).sum()
+        return real + recip + point + (self.charged_cell(q.sum()) if charged_cell else 0.0)
+
+    def substitution_energies(self, base, sites, values, charged_cell: bool = True) -> np.ndarray:
+        """
+        Energies of many charge vectors that differ from base only on sites, values being (n_vectors x len(sites)).
+        With d = q - base, E(q) = E(base) + 2 d.(A base)_sites + d.A_sites,sites.d, so after one O(len(sites) N)
+        setup each vector costs O(len(sites)^2) and the whole batch is a few matrix products.
+        """
+        base = np.asarray(base, dtype=float)
+        sites = np.asarray(sites, dtype=int)
+        values = np.atleast_2d(np.asarray(values, dtype=float))
+        rows = self.matrix_rows(sites)
+        delta = values - base[sites]
+        energies = (self.energy(base, charged_cell=False) + 2 * delta @ (rows @ base)
+                    + np.einsum("mi,ij,mj->m", delta, rows[:, sites], delta))
+        if charged_cell:
+            energies += self.charged_cell(base.sum() + delta.sum(axis=1))
+        return energies
+
+
+def compare_pymatgen(structure, charges, **kwargs) -> tuple:
+    """
+    This kernel's energy against pymatgen's EwaldSummation (total_energy, with the same eta) for one charge
+    vector. Returns (ours, pymatgen's).
+    """
+    from pymatgen.analysis.ewald import EwaldSummation
+    kernel = EwaldKernel.from_structure(structure, **kwargs)
+    s = structure.copy()
+    s.add_oxidation_state_by_site(list(charges))
+    reference = EwaldSummation(s, eta=kernel.eta, acc_factor=kwargs.get("accuracy", 12.0)).total_energy
+    return kernel.energy(charges), reference
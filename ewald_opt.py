@@ -1,12 +1,14 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
-import sys, argparse, logging
-from itertools import product
-import time
+import sys, argparse, logging, os, time, json, hashlib
 
+import numpy as np
 from pymatgen.core import Structure
-from pymatgen.analysis import ewald
+
+from ewald_kernel import EwaldKernel, BLOCK_ELEMENTS, compare_pymatgen
+from poscar_writer import write_structure
+import profiling
 
 # Adopted format: level - current function name - mess. Width is fixed as visual aid
 c_log = logging.getLogger(__name__)
@@ -49,7 +51,43 @@ def get_ox_poscar(filename: str):
     return ox_states
 
 
-def ewald_opt_from_ox(structure: Structure, ox_states_matrices, check_charge=True) -> list:
+def input_fingerprint(structure: Structure, ox_states_matrices, **settings) -> str:
+    """
+    Hash of everything an enumeration depends on, a checkpoint is only resumed for the same inputs
+    """
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(structure.lattice.matrix, dtype=float).tobytes())
+    h.update(np.ascontiguousarray(structure.cart_coords, dtype=float).tobytes())
+    h.update(json.dumps([[float(x) for x in ox] for ox in ox_states_matrices]).encode())
+    h.update(json.dumps(settings, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def save_checkpoint(filename: str, fingerprint: str, cursor: int, energies: np.ndarray, values: np.ndarray) -> None:
+    """
+    Enumeration cursor (permutations done) and the kept results (energies, ox states of the variable sites).
+    Written to a temporary file and renamed over the old one, so a kill mid write leaves the last checkpoint intact.
+    """
+    tmp = filename + ".tmp"
+    with open(tmp, "wb") as f:
+        np.savez(f, fingerprint=fingerprint, cursor=cursor, energies=energies, values=values)
+    os.replace(tmp, filename)
+    c_log.debug(f"Checkpoint at {cursor} permutations, {len(energies)} kept: {filename}")
+
+
+def load_checkpoint(filename: str, fingerprint: str) -> tuple:
+    """
+    (cursor, energies, values) from save_checkpoint, ValueError if it was written for other inputs
+    """
+    with np.load(filename) as data:
+        if str(data["fingerprint"]) != fingerprint:
+            raise ValueError(f"{filename} was written for a different structure / ox states / settings")
+        return int(data["cursor"]), data["energies"], data["values"]
+
+
+def ewald_opt_from_ox(structure: Structure, ox_states_matrices, check_charge=True, accuracy: float = 12.0,
+                      eta: float = None, validate: bool = False, top: int = None, checkpoint: str = None,
+                      checkpoint_every: float = 60.0, resume: bool = False) -> list:
     """
     What was expected to just be a wrapped of a piece of pymatgen code
     instead has become me painstaking reading 2 wiki pages on Ewald Calculations aswell as 2000 lines of f90
@@ -64,12 +102,16 @@ def ewald_opt_from_ox(structure: Structure, ox_states_matrices, check_charge=Tru
     ox_state_matrices in form [[1,0], [2,0] [2,1] [3,2] [0,1]]
     check_charge: bool, whether to ensure charge is not charged.
     If its supplied in a different form the code will (try?!) to clean it up.
+    accuracy: digits the Ewald sums are converged to, eta: splitting parameter (default is the optimal one)
+    validate: recompute the best ordering with pymatgen's EwaldSummation and warn on a mismatch
+    top: only keep the top lowest energy orderings, which also lifts the permutation limit
+    checkpoint: file the cursor and kept results are saved to every checkpoint_every seconds (and on Ctrl-C),
+    with resume the run carries on from it rather than from the first permutation
 
-    This method invokes the same structure across all calculations which speeds up subsequent calls to the ewald
-    sum call
-
-    TODO - If initial state has a species with Ox = 0 then the pymatgen call will crash.
-     Not sure if this is a realistic approach or not.
+    The Ewald pair matrix only depends on the positions, so it is set up once (ewald_kernel.EwaldKernel) and every
+    permutation is then E(base) + the change on the sites that have more than one ox state, for whole batches
+    of permutations at a time. Energies are the pymatgen total_energy_matrix sum (no charged cell term).
+    Permutations are numbered in itertools.product order, so the cursor alone says where to carry on.
 
     TODO - Implement the monte carlo method that is on pymatgen for defect ewald summation since large cells + multiple ox states
      results in a mess
@@ -86,41 +128,93 @@ def ewald_opt_from_ox(structure: Structure, ox_states_matrices, check_charge=Tru
     for i in ox_states_matrices:
         perm_cost *= len(i)
 
-    if perm_cost > 2E06:
-        c_log.warning(f"Huge amount of possible permutations from ox_states: {perm_cost}, exitting as generation"
-                      f" of perms will crash")
+    if perm_cost > 2E06 and top is None:
+        c_log.warning(f"Huge amount of possible permutations from ox_states: {perm_cost}, exitting as keeping"
+                      f" them all will crash. Give top to only keep the best")
         return
 
-    permutation_list = list(product(*ox_states_matrices))
-
-    c_log.info(f"Total Permuatations: {len(permutation_list)}")
+    c_log.info(f"Total Permuatations: {perm_cost}")
     if check_charge:
         c_log.info(f"Stripping charged final structures (if sum(perrm) == 0 )")
-        permutation_list = [x for x in permutation_list if sum(x) == 0]
-
-    cost = len(structure) * len(permutation_list)
-    if len(cost) > 2000:
-        c_log.warning(f"total permutations to ewald sum is > 1000, this may hang. For now proceeding")
-    if len(permutation_list) > 1E06:
-        c_log.warning(f"okay, permutation cost is > 1E6, Exitting to save your PC. Expected to take afew minutes")
-        c_log.warning(f"If someone wants to come up with a Monte Carlo methos that iterates smartly, go for it")
-        return
 
-    pm = permutation_list[0]
-    structure.add_oxidation_state_by_site(oxidation_states=pm)
-    ewa = ewald.EwaldSummation(structure)
-    e_pm = [(sum(sum(ewa.total_energy_matrix)), pm)]
+    base = np.array([x[0] for x in ox_states_matrices], dtype=float)
+    sites = [n for n, x in enumerate(ox_states_matrices) if len(x) > 1]
+    shape = [len(ox_states_matrices[n]) for n in sites]
+    choices = np.zeros((len(sites), max(shape, default=1)))  # Padded, row i holds the ox states of sites[i]
+    for i, n in enumerate(sites):
+        choices[i, :shape[i]] = ox_states_matrices[n]
+
+    fingerprint = input_fingerprint(structure, ox_states_matrices, check_charge=bool(check_charge),
+                                    accuracy=accuracy, eta=eta, top=top)
+    cursor, kept_e, kept_v = 0, np.zeros(0), np.zeros((0, len(sites)))
+    if resume and checkpoint is not None and os.path.isfile(checkpoint):
+        cursor, kept_e, kept_v = load_checkpoint(checkpoint, fingerprint)
+        c_log.info(f"Resuming from {checkpoint}: {cursor} / {perm_cost} permutations done, {len(kept_e)} kept")
+
+    with profiling.phase("ewald_setup"):
+        kernel = EwaldKernel.from_structure(structure, accuracy=accuracy, eta=eta)
+        rows = kernel.matrix_rows(sites)  # The only part of the matrix the permutations need
+        e_base = kernel.energy(base, charged_cell=False)
+
+    batch = max(1, BLOCK_ELEMENTS // max(len(sites), 1) // 8)
+    last_save = time.monotonic()
+    with profiling.phase("ewald_permutations") as timing:
+        try:
+            while cursor < perm_cost:
+                stop = min(cursor + batch, perm_cost)
+                index = np.arange(cursor, stop)
+                digits = np.array(np.unravel_index(index, shape)) if sites else np.zeros((0, len(index)), dtype=int)
+                values = choices[np.arange(len(sites))[:, None], digits].T
+                if check_charge:
+                    values = values[np.abs(base.sum() - base[sites].sum() + values.sum(axis=1)) < 1e-6]
+                delta = values - base[sites]
+                energies = e_base + 2 * delta @ (rows @ base) + np.einsum("mi,ij,mj->m", delta, rows[:, sites], delta)
+                kept_e, kept_v = np.concatenate((kept_e, energies)), np.concatenate((kept_v, values))
+                if top is not None and len(kept_e) > top:
+                    best = np.argpartition(kept_e, top - 1)[:top]
+                    kept_e, kept_v = kept_e[best], kept_v[best]
+                cursor = stop
+                c_log.debug(f"Current on: {cursor} / {perm_cost}, Runtime: {round(timing.elapsed(), 3)}")
+                if checkpoint is not None and time.monotonic() - last_save > checkpoint_every:
+                    save_checkpoint(checkpoint, fingerprint, cursor, kept_e, kept_v)
+                    last_save = time.monotonic()
+        except KeyboardInterrupt:
+            if checkpoint is not None:
+                save_checkpoint(checkpoint, fingerprint, cursor, kept_e, kept_v)
+                c_log.warning(f"Interrupted at {cursor} / {perm_cost} permutations, resume from {checkpoint}")
+            raise
+    if checkpoint is not None:
+        save_checkpoint(checkpoint, fingerprint, cursor, kept_e, kept_v)
+
+    order = np.argsort(kept_e, kind="stable")
+    full = np.repeat(base[None, :], len(order), axis=0)
+    full[:, sites] = kept_v[order]
+    e_pm = list(zip(kept_e[order].tolist(), map(tuple, full.tolist())))
+    c_log.info(f"{len(e_pm)} permutations kept")
+
+    if validate and e_pm:
+        with profiling.phase("ewald_validate"):
+            ours, reference = compare_pymatgen(structure, e_pm[0][1], accuracy=accuracy, eta=kernel.eta)
+        if abs(ours - reference) > 1e-6 * max(1.0, abs(reference)):
+            c_log.warning(f"Lowest ordering: {ours} eV here but {reference} eV from pymatgen")
+        else:
+            c_log.info(f"Lowest ordering matches pymatgen: {ours} vs {reference} eV")
+    return e_pm
+
 
-    t = time.time()
-    for n, ox_states in enumerate(permutation_list[1:]):
-        c_log.debug(f"Current on: {n} / {len(permutation_list[1:])}")
+def write_ranked(structure: Structure, e_pm: list, folder: str, n: int = None) -> list:
+    """
+    POSCARs of the n (default all) lowest energy orderings with their oxidation states on the species
+    (folder/POSCAR_001 being the lowest), the energy goes in the comment line. Returns the file names.
+    """
+    os.makedirs(folder, exist_ok=True)
+    filenames = []
+    for rank, (energy, ox_states) in enumerate(e_pm[:n], start=1):
         s = structure.copy()
-        s.add_oxidation_state_by_site(oxidation_states=ox_states)
-        p = ewa.compute_sub_structure(sub_structure=s)  # Returns the sum(sum(total_energy_matrix)) Using a scale factor
-        e_pm.append((p, ox_states))
-        c_log.debug(f"Runtime: {round(time.time() - t, 3)}")
-    e_pm.sort(key=lambda x: x[0])
-    return e_pm
+        s.add_oxidation_state_by_site(oxidation_states=list(ox_states))
+        filenames.append(os.path.join(folder, f"POSCAR_{rank:03d}"))
+        write_structure(s, comment=f"{s.formula} rank {rank} Ewald {energy:.6f} eV", filename=filenames[-1])
+    return filenames
 
 
 def cli_run(argv) -> None:
@@ -132,10 +226,30 @@ def cli_run(argv) -> None:
 
     parser = argparse.ArgumentParser(description=ewald_opt_from_ox.__doc__)  # Parser init
     parser.add_argument("POSCAR", type=str, default="tests/POSCAR_Large.vasp", help="Location of a formatted POSCAR")
-    parser.add_argument("c", "--check_charge", default=True, action="store_true", help="Whether to check for chg bal")
+    parser.add_argument("--no-check-charge", dest="check_charge", action="store_false",
+                        help="Keep charged orderings too, default only charge balanced ones are summed")
+    parser.add_argument("--accuracy", dest="accuracy", type=float, default=12.0,
+                        help="Digits the real and reciprocal Ewald sums are converged to")
+    parser.add_argument("--eta", dest="eta", type=float, default=None,
+                        help="Ewald splitting parameter, default is the optimal one for the cell")
+    parser.add_argument("--validate", dest="validate", action="store_true",
+                        help="Check the lowest ordering against pymatgen's EwaldSummation")
+    parser.add_argument("-k", "--top", dest="top", type=int, default=None,
+                        help="Only keep the top lowest energy orderings, needed past 2E6 permutations")
+    parser.add_argument("-o", "--output", dest="output", type=str, default="ewald_opt",
+                        help="Folder for the ranked POSCARs and the checkpoint")
+    parser.add_argument("-w", "--write", dest="write", type=int, default=10,
+                        help="Number of lowest energy POSCARs written, 0 for none")
+    parser.add_argument("--checkpoint", dest="checkpoint", type=str, default=None,
+                        help="Checkpoint file, default is checkpoint.npz in the output folder")
+    parser.add_argument("--checkpoint-every", dest="checkpoint_every", type=float, default=60.0,
+                        help="Seconds between checkpoints")
+    parser.add_argument("--resume", dest="resume", action="store_true",
+                        help="Carry on from the checkpoint instead of starting over")
     parser.add_argument("--debug", dest="debug", action="store_true")  # Always have the debug optional
     parser.add_argument("--verbose", dest="verbose", action="store_true")  # Always have the verbose optional
 
+    profiling.add_profile_argument(parser)
     args = parser.parse_args(argv)
 
     if args.debug:  # Always include method for switching verbosity
@@ -143,11 +257,30 @@ def cli_run(argv) -> None:
     if args.verbose:
         c_log.setLevel(logging.INFO)
     c_log.debug(args)
+    profiling.start(args.profile)
+
+    with profiling.phase("parse"):
+        structure = Structure.from_file(filename=args.POSCAR)
+        ox_states = get_ox_poscar(filename=args.POSCAR)
+    checkpoint = args.checkpoint if args.checkpoint else os.path.join(args.output, "checkpoint.npz")
+    os.makedirs(os.path.dirname(os.path.abspath(checkpoint)), exist_ok=True)
+    try:
+        e_pm = ewald_opt_from_ox(structure=structure, ox_states_matrices=ox_states, check_charge=args.check_charge,
+                                 accuracy=args.accuracy, eta=args.eta, validate=args.validate, top=args.top,
+                                 checkpoint=checkpoint, checkpoint_every=args.checkpoint_every, resume=args.resume)
+    except ValueError as e:
+        profiling.report()
+        parser.error(str(e))
+    if not e_pm:
+        profiling.report()
+        return
 
-    structure = Structure.from_file(filename=args.POSCAR)
-
-    ox_states = get_ox_poscar(filename=args.POSCAR)
-    x = ewald_opt_from_ox(structure=structure, ox_states_matrices=ox_states, check_charge=True)
+    with profiling.phase("write"):
+        written = write_ranked(structure, e_pm, args.output, n=args.write) if args.write > 0 else []
+    print(f"{'RANK':>5s} {'ENERGY':>18s}  POSCAR")
+    for rank, (energy, _) in enumerate(e_pm[:max(args.write, 10)], start=1):
+        print(f"{rank:5d} {energy:18.6f}  {written[rank - 1] if rank <= len(written) else ''}")
+    profiling.report()
 
 
 if __name__ == "__main__":
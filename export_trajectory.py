@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import sys, argparse, logging, os, mmap, re, struct, functools
+import xml.etree.ElementTree as ET
+from collections import deque
+
+import numpy as np
+
+from compressed import iterparse, variants
+from vasp_scan import _map_file, FORCE_BLOCK, IONIC_TOTEN
+import profiling
+
+# Adopted format: level - current function name - mess. Width is fixed as visual aid
+c_log = logging.getLogger(__name__)
+std_format = '[%(levelname)5s - %(funcName)10s] %(message)s'
+logging.basicConfig(format=std_format)
+c_log.setLevel(logging.WARNING)
+
+KBAR_TO_EV_A3 = 0.1 / 160.21766208  # kB -> eV/A^3, stress is written in the ASE sign convention (-VASP)
+LATTICE_BLOCK = re.compile(rb"direct lattice vectors[^\n]*\n((?:[^\n]*\n){3})")
+STRESS_KB = re.compile(rb"in kB\s+(\S+)\s+(\S+)\s+(\S+)\s+(\S+)\s+(\S+)\s+(\S+)")
+TITEL = re.compile(rb"TITEL\s+=\s+\S+\s+(\S+)")
+IONS_PER_TYPE = re.compile(rb"ions per type =\s+([\d ]+)")
+ENERGY_NO_ENTROPY = re.compile(rb"energy\(sigma->0\)\s+=\s+(\S+)")
+
+# Packed binary: magic, then per frame a fixed header and the arrays as little endian float64 / uint8
+PACKED_MAGIC = b"BUDTRJ1\n"
+PACKED_HEADER = struct.Struct("<iidd??")  # n_atoms, step, energy, e0, has_forces, has_stress
+
+
+def _stress_matrix(voigt) -> np.ndarray:
+    """
+    xx yy zz xy yz zx (OUTCAR order) to 3x3
+    """
+    xx, yy, zz, xy, yz, zx = voigt
+    return np.array([[xx, xy, zx], [xy, yy, yz], [zx, yz, zz]])
+
+
+def iter_vasprun(filename: str = "vasprun.xml"):
+    """
+    Streams the ionic steps of a vasprun.xml as frame dicts (symbols, lattice, cartesian positions, forces, stress
+    in kB, energy, e0, step). Every <calculation> is dropped once its frame is yielded, so memory doesn't grow with
+    the trajectory. A truncated file ends at the last complete step.
+    """
+    symbols = []
+    frame = {}
+    stack = []
+    step = 0
+    try:
+        for event, elem in iterparse(filename, events=("start", "end")):
+            if event == "start":
+                stack.append(elem.tag)
+                continue
+            stack.pop()
+            tag, name = elem.tag, elem.get("name")
+            in_step = len(stack) > 1 and "calculation" in stack
+            if tag == "array" and name == "atoms" and "atominfo" in stack:
+                symbols = [rc[0].text.strip() for rc in elem.iter("rc")]
+            elif in_step and tag == "varray" and name == "basis" and stack[-2] == "structure":
+                frame["lattice"] = _varray(elem)
+            elif in_step and tag == "varray" and name == "positions" and stack[-1] == "structure":
+                frame["frac"] = _varray(elem)
+            elif in_step and tag == "varray" and name in ("forces", "stress") and stack[-1] == "calculation":
+                frame[name] = _varray(elem)
+            elif in_step and tag == "i" and stack[-1] == "energy" and stack[-2] == "calculation":
+                if name == "e_fr_energy":
+                    frame["energy"] = float(elem.text)
+                elif name == "e_0_energy":
+                    frame["e0"] = float(elem.text)
+            elif tag == "calculation":
+                if "frac" in frame and "energy" in frame:
+                    yield {"symbols": symbols, "lattice": frame["lattice"],
+                           "positions": frame["frac"] @ frame["lattice"], "forces": frame.get("forces"),
+                           "stress": frame.get("stress"), "energy": frame["energy"],
+                           "e0": frame.get("e0", frame["energy"]), "step": step}
+                step += 1
+                frame = {}
+                elem.clear()
+            elif tag in ("scstep", "eigenvalues", "dos", "projected", "structure"):
+                elem.clear()
+    except ET.ParseError as e:
+        c_log.warning(f"{filename} is truncated ({e}), stopping after {step} ionic steps")
+
+
+def _varray(elem) -> np.ndarray:
+    return np.array([[float(x) for x in v.text.split()] for v in elem])
+
+
+def _outcar_symbols(buf) -> list:
+    titles = [m.group(1).decode().split("_")[0] for m in TITEL.finditer(buf)]
+    counts = IONS_PER_TYPE.search(buf)
+    if not titles or counts is None:
+        raise ValueError("No TITEL / ions per type lines, can't tell which atom is which")
+    return [el for el, n in zip(titles, counts.group(1).split()) for _ in range(int(n))]
+
+
+def iter_outcar(filename: str = "OUTCAR"):
+    """
+    Same frames from an OUTCAR, read through a memory map one ionic step at a time: each TOTAL-FORCE block
+    (cartesian positions and forces) is paired with the last lattice and stress printed before it and the
+    TOTEN after it. Incomplete last steps are skipped.
+    """
+    buf = _map_file(filename)
+    try:
+        symbols = _outcar_symbols(buf)
+        for step, block in enumerate(FORCE_BLOCK.finditer(buf)):
+            energy = IONIC_TOTEN.search(buf, block.end())
+            if energy is None:
+                c_log.info(f"{filename}: step {step} has no TOTEN, file is likely truncated")
+                break
+            lattice_at = buf.rfind(b"direct lattice vectors", 0, block.start())
+            stress_at = buf.rfind(b"in kB", 0, block.start())
+            lattice = np.fromstring(LATTICE_BLOCK.match(buf, lattice_at).group(1), sep=" ").reshape((3, 6))[:, :3]
+            rows = np.fromstring(block.group(1), sep=" ").reshape((len(symbols), 6))
+            e0 = ENERGY_NO_ENTROPY.search(buf, energy.end())
+            stress = None
+            if stress_at != -1:
+                stress = _stress_matrix([float(x) for x in STRESS_KB.match(buf, stress_at).groups()])
+            yield {"symbols": symbols, "lattice": lattice, "positions": rows[:, :3], "forces": rows[:, 3:],
+                   "stress": stress, "energy": float(energy.group(1)),
+                   "e0": float(e0.group(1)) if e0 else float(energy.group(1)), "step": step}
+    finally:
+        if isinstance(buf, mmap.mmap):
+            buf.close()
+
+
+def iter_frames(filename: str):
+    if "OUTCAR" in os.path.basename(filename):
+        return iter_outcar(filename)
+    return iter_vasprun(filename)
+
+
+def _same_frame(a: dict, b: dict, tol: float, energy_tol: float) -> bool:
+    """
+    Near identical: same atoms, energies within energy_tol and no atom moved more than tol (minimum image)
+    """
+    if len(a["positions"]) != len(b["positions"]) or abs(a["energy"] - b["energy"]) > energy_tol:
+        return False
+    if not np.allclose(a["lattice"], b["lattice"], atol=tol):
+        return False
+    frac = (a["positions"] - b["positions"]) @ np.linalg.inv(a["lattice"])
+    frac -= np.round(frac)
+    return np.max(np.linalg.norm(frac @ a["lattice"], axis=1)) < tol
+
+
+def select_frames(frames, stride: int = 1, fmax: float = None, emin: float = None, emax: float = None,
+                  dedup: float = None, dedup_energy: float = 1e-3, window: int = 10):
+    """
+    Filters a frame stream lazily: every stride-th ionic step, frames whose largest force is above fmax (eV/A)
+    or whose energy per atom is outside emin / emax are dropped, and with dedup (A) a frame matching one of the
+    last window kept frames is skipped. Only the window is held in memory.
+    """
+    recent = deque(maxlen=window)
+    for frame in frames:
+        if frame["step"] % stride:
+            continue
+        per_atom = frame["energy"] / len(frame["positions"])
+        if (emin is not None and per_atom < emin) or (emax is not None and per_atom > emax):
+            continue
+        if fmax is not None and frame["forces"] is not None \
+                and np.max(np.linalg.norm(frame["forces"], axis=1)) > fmax:
+            continue
+        if dedup is not None:
+            if any(_same_frame(frame, kept, dedup, dedup_energy) for kept in recent):
+                continue
+            recent.append(frame)
+        yield frame
+
+
+def extxyz_frame(frame: dict, source: str = "") -> str:
+    """
+    One extended XYZ frame in the layout ASE reads: energy / free_energy in eV, forces in eV/A and stress in
+    eV/A^3 with ASE's sign (VASP's kB negated)
+    """
+    n = len(frame["positions"])
+    lattice = " ".join(f"{x:.10f}" for x in frame["lattice"].ravel())
+    properties = "species:S:1:pos:R:3" + (":forces:R:3" if frame["forces"] is not None else "")
+    info = [f'Lattice="{lattice}"', f"Properties={properties}", f"energy={frame['e0']:.10f}",
+            f"free_energy={frame['energy']:.10f}"]
+    if frame["stress"] is not None:
+        stress = -np.asarray(frame["stress"]) * KBAR_TO_EV_A3
+        info.append('stress="' + " ".join(f"{x:.10e}" for x in stress.ravel()) + '"')
+    info += [f"step={frame['step']}", f'source="{source}"' if source else "", 'pbc="T T T"']
+
+    columns = [frame["positions"]] + ([frame["forces"]] if frame["forces"] is not None else [])
+    block = np.empty((n, 1 + 3 * len(columns)), dtype=object)
+    block[:, 0] = frame["symbols"]
+    block[:, 1:] = np.hstack(columns)
+    row = "%-2s" + " %16.10f" * (block.shape[1] - 1) + "\n"
+    return f"{n}\n{' '.join(x for x in info if x)}\n" + (row * n) % tuple(block.ravel().tolist())
+
+
+@functools.lru_cache(maxsize=None)
+def _atomic_number(symbol: str) -> int:
+    from pymatgen.core import Element  # Only for the symbol -> Z lookup
+    return Element(symbol).Z
+
+
+def packed_frame(frame: dict) -> bytes:
+    """
+    Binary record: header, atomic numbers (uint8), lattice, positions, then forces / stress if present (float64)
+    """
+    n = len(frame["positions"])
+    has_forces, has_stress = frame["forces"] is not None, frame["stress"] is not None
+    parts = [PACKED_HEADER.pack(n, frame["step"], frame["energy"], frame["e0"], has_forces, has_stress),
+             np.array([_atomic_number(s) for s in frame["symbols"]], dtype=np.uint8).tobytes(),
+             np.asarray(frame["lattice"], dtype="<f8").tobytes(), np.asarray(frame["positions"], dtype="<f8").tobytes()]
+    if has_forces:
+        parts.append(np.asarray(frame["forces"], dtype="<f8").tobytes())
+    if has_stress:
+        parts.append(np.asarray(frame["stress"], dtype="<f8").tobytes())
+    return b"".join(parts)
+
+
+def read_packed(filename: str):
+    """
+    Generator over the frames of a packed file, stress comes back in kB as stored
+    """
+    from pymatgen.core import Element
+    with open(filename, "rb") as f:
+        if f.read(len(PACKED_MAGIC)) != PACKED_MAGIC:
+            raise ValueError(f"{filename} is not a packed trajectory")
+        while True:
+            header = f.read(PACKED_HEADER.size)
+            if len(header) < PACKED_HEADER.size:
+                return
+            n, step, energy, e0, has_forces, has_stress = PACKED_HEADER.unpack(header)
+            numbers = np.frombuffer(f.read(n), dtype=np.uint8)
+            lattice = np.frombuffer(f.read(72), dtype="<f8").reshape((3, 3))
+            positions = np.frombuffer(f.read(24 * n), dtype="<f8").reshape((n, 3))
+            forces = np.frombuffer(f.read(24 * n), dtype="<f8").reshape((n, 3)) if has_forces else None
+            stress = np.frombuffer(f.read(72), dtype="<f8").reshape((3, 3)) if has_stress else None
+            yield {"symbols": [Element.from_Z(int(z)).symbol for z in numbers], "lattice": lattice,
+                   "positions": positions, "forces": forces, "stress": stress, "energy": energy, "e0": e0,
+                   "step": step}
+
+
+def export_trajectory(filenames, output: str, fmt: str = "extxyz", **filters) -> int:
+    """
+    Streams ionic steps (lattice, positions, energy, forces, stress) from vasprun.xml / OUTCAR files into one
+    extended XYZ or packed binary file for ML potential training. Frames are read, filtered (stride, force and
+    energy limits, near duplicate removal) and written one at a time, memory use doesn't depend on trajectory length.
+    Returns the number of frames written.
+    """
+    written = 0
+    with open(output, "wb" if fmt == "packed" else "w") as f:
+        if fmt == "packed":
+            f.write(PACKED_MAGIC)
+        for filename in filenames:
+            count = written
+            for frame in select_frames(iter_frames(filename), **filters):
+                f.write(packed_frame(frame) if fmt == "packed" else extxyz_frame(frame, source=filename))
+                written += 1
+            c_log.info(f"{filename}: {written - count} frames")
+    return written
+
+
+def find_trajectories(paths) -> list:
+    """
+    Files as given, folders are walked for vasprun.xml (OUTCAR where there is no vasprun)
+    """
+    found = []
+    for path in paths:
+        if not os.path.isdir(path):
+            found.append(path)
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            for name in ("vasprun.xml", "OUTCAR"):
+                present = [x for x in variants(name) if x in filenames]
+                if present:
+                    found.append(os.path.join(dirpath, present[0]))
+                    break
+    return sorted(found)
+
+
+def cli_run(argv) -> None:
+    """
+    Wrapper for the above command, handles parsing of args and logging, to avoid mess
+    """
+
+    global c_log
+
+    parser = argparse.ArgumentParser(description=export_trajectory.__doc__)  # Parser init
+    parser.add_argument("inputs", type=str, nargs="*", default=["vasprun.xml"],
+                        help="vasprun.xml / OUTCAR files or folders to walk for them")
+    parser.add_argument("-o", "--output", dest="output", type=str, default="train.extxyz",
+                        help="Output file, a .bin name selects the packed binary format")
+    parser.add_argument("--format", dest="fmt", type=str, default=None, choices=["extxyz", "packed"],
+                        help="Output format, default from the output name")
+    parser.add_argument("-s", "--stride", dest="stride", type=int, default=1, help="Keep every nth ionic step")
+    parser.add_argument("--fmax", dest="fmax", type=float, default=None,
+                        help="Drop frames with any force above this (eV/A)")
+    parser.add_argument("--emin", dest="emin", type=float, default=None, help="Drop frames below this eV/atom")
+    parser.add_argument("--emax", dest="emax", type=float, default=None, help="Drop frames above this eV/atom")
+    parser.add_argument("--dedup", dest="dedup", type=float, default=None,
+                        help="Skip frames where no atom moved more than this (A) from a recently kept frame")
+    parser.add_argument("--dedup-energy", dest="dedup_energy", type=float, default=1e-3,
+                        help="Energy difference (eV) below which frames can count as duplicates")
+    parser.add_argument("--dedup-window", dest="window", type=int, default=10,
+                        help="Recently kept frames compared against")
+    parser.add_argument("--debug", dest="debug", action="store_true")  # Always have the debug optional
+    parser.add_argument("--verbose", dest="verbose", action="store_true")  # Always have the verbose optional
+
+    profiling.add_profile_argument(parser)
+    args = parser.parse_args(argv)
+
+    if args.debug:  # Always include method for switching verbosity
+        c_log.setLevel(logging.DEBUG)
+    if args.verbose:
+        c_log.setLevel(logging.INFO)
+    c_log.debug(args)
+    profiling.start(args.profile)
+
+    fmt = args.fmt or ("packed" if args.output.endswith(".bin") else "extxyz")
+    files = find_trajectories(args.inputs)
+    with profiling.phase("stream+write"):
+        written = export_trajectory(files, args.output, fmt=fmt, stride=args.stride, fmax=args.fmax, emin=args.emin,
+                                    emax=args.emax, dedup=args.dedup, dedup_energy=args.dedup_energy,
+                                    window=args.window)
+    print(f"{written} frames from {len(files)} files written to {args.output}")
+    profiling.report()
+
+
+if __name__ == "__main__":
+    cli_run(sys.argv[1:])
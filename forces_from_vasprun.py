@@ -3,11 +3,19 @@
 
 ## TODO - log this function
 
-import sys, argparse, logging
-import pandas as pd
+from __future__ import annotations  # Type hints only, pandas / pymatgen are imported where used
+
+import sys, argparse, logging, os
+from typing import TYPE_CHECKING
+import numpy as np
 from numpy import linalg as la
 
-from pymatgen.io.vasp import Vasprun
+from compressed import find_file
+from vasp_scan import scan_outcar
+import profiling
+
+if TYPE_CHECKING:
+    from pymatgen.io.vasp import Vasprun
 
 # Adopted format: level - current function name - mess. Width is fixed as visual aid
 c_log = logging.getLogger(__name__)
@@ -16,21 +24,19 @@ logging.basicConfig(format=std_format)
 c_log.setLevel(logging.WARNING)
 
 
-def forces_from_vasprun(vs: Vasprun, resolution: int = 1) -> str:
+def forces_table(force_matrices, resolution: int = 1) -> str:
     """
-    Gets forces from vasprun and returns the change in force as convergence improves
+    Formats a sequence of (n_ions, 3) force matrices (already strided by resolution) as the step / max / avg table
     """
+    import pandas as pd
 
     x = ["STEP"]
     y_max = ["Max_F"]
     y_avg = ["Avg_F"]
-    for step, result in enumerate(vs.ionic_steps[::resolution]):
-        force_matrix = result["forces"]
-        force_norms = [la.norm(x) for x in force_matrix]
-        max_force = max(force_norms)
-        avg_force = sum(force_norms) / len(force_norms)
-        y_max.append(max_force)
-        y_avg.append(avg_force)
+    for step, force_matrix in enumerate(force_matrices):
+        force_norms = la.norm(np.asarray(force_matrix), axis=1)
+        y_max.append(force_norms.max())
+        y_avg.append(force_norms.sum() / len(force_norms))
         x.append(step * resolution)
 
     zp = zip(x, y_max, y_avg)
@@ -38,6 +44,42 @@ def forces_from_vasprun(vs: Vasprun, resolution: int = 1) -> str:
     return p.to_string(header=False, index=False)
 
 
+def forces_from_vasprun(vs: Vasprun, resolution: int = 1) -> str:
+    """
+    Gets forces from vasprun and returns the change in force as convergence improves
+    """
+
+    return forces_table([result["forces"] for result in vs.ionic_steps[::resolution]], resolution=resolution)
+
+
+def forces_from_outcar(filename: str = "OUTCAR", resolution: int = 1) -> str:
+    """
+    Same table as forces_from_vasprun but read straight out of an OUTCAR by the byte level scanner,
+    useful when the vasprun is missing or truncated
+    """
+
+    forces = scan_outcar(filename)["forces"]
+    return forces_table(forces[::resolution], resolution=resolution)
+
+
+def final_forces(folder: str):
+    """
+    (n_ions, 3) forces of the last complete ionic step of the calculation in folder, streamed from the vasprun.xml
+    or else scanned from the OUTCAR (plain or compressed). None if neither has a complete step.
+    """
+    from export_trajectory import iter_vasprun
+
+    forces = None
+    vasprun, outcar = find_file(os.path.join(folder, "vasprun.xml")), find_file(os.path.join(folder, "OUTCAR"))
+    if vasprun is not None:
+        for frame in iter_vasprun(vasprun):
+            forces = frame["forces"] if frame["forces"] is not None else forces
+    if forces is None and outcar is not None:
+        steps = scan_outcar(outcar)["forces"]
+        forces = steps[-1] if len(steps) else None
+    return forces
+
+
 def cli_run(argv) -> None:
     """
     Wrapper for the above command, handles parsing of args and logging, to avoid mess
@@ -46,24 +88,52 @@ def cli_run(argv) -> None:
     global c_log
 
     parser = argparse.ArgumentParser(description=forces_from_vasprun.__doc__)  # Parser init
-    parser.add_argument("vasprun", type=str, default="vasprun.xml", help="vasprun file location")
+    parser.add_argument("vasprun", type=str, default="vasprun.xml",
+                        help="vasprun file location, an OUTCAR is read with the fast scanner instead")
     parser.add_argument("--res", dest="resolution", default=1, type=int, help="Parse vasprun for every nth ionic step")
     parser.add_argument("--debug", dest="debug", action="store_true")  # Always have the debug optional
     parser.add_argument("--verbose", dest="verbose", action="store_true")  # Always have the verbose optional
 
+    profiling.add_profile_argument(parser)
     args = parser.parse_args(argv)
 
     if args.debug:  # Always include method for switching verbosity
         c_log.setLevel(logging.DEBUG)
     if args.verbose:
         c_log.setLevel(logging.INFO)
-
-    vs = Vasprun(filename=args.vasprun,
-                 ionic_step_skip=0, ionic_step_offset=0,
-                 parse_dos=False, parse_eigen=False,
-                 parse_projected_eigen=False, parse_potcar_file=False, occu_tol=1e-8, exception_on_bad_xml=True)
-
-    print(forces_from_vasprun(vs=vs, resolution=args.resolution))
+    profiling.start(args.profile)
+    args.vasprun = find_file(args.vasprun) or args.vasprun  # vasprun.xml.gz etc when there is no plain file
+
+    if "OUTCAR" in os.path.basename(args.vasprun):
+        with profiling.phase("parse"):
+            table = forces_from_outcar(filename=args.vasprun, resolution=args.resolution)
+        print(table)
+        profiling.report()
+        return
+
+    from pymatgen.io.vasp import Vasprun
+    try:
+        with profiling.phase("parse"):
+            vs = Vasprun(filename=args.vasprun,
+                         ionic_step_skip=0, ionic_step_offset=0,
+                         parse_dos=False, parse_eigen=False,
+                         parse_projected_eigen=False, parse_potcar_file=False, occu_tol=1e-8,
+                         exception_on_bad_xml=True)
+    except Exception as e:  # Missing or truncated vasprun, fall back to the OUTCAR next to it
+        outcar = find_file(os.path.join(os.path.dirname(args.vasprun), "OUTCAR"))
+        if outcar is None:
+            raise
+        c_log.warning(f"Could not read {args.vasprun} ({e}), falling back to {outcar}")
+        with profiling.phase("parse"):
+            table = forces_from_outcar(filename=outcar, resolution=args.resolution)
+        print(table)
+        profiling.report()
+        return
+
+    with profiling.phase("analyse"):
+        table = forces_from_vasprun(vs=vs, resolution=args.resolution)
+    print(table)
+    profiling.report()
 
 
 if __name__ == "__main__":
@@ -1,14 +1,15 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
-import sys, argparse, logging, json, math, time
+import sys, argparse, logging, json, math
 from monty.json import MontyEncoder
 
 from scipy.cluster.vq import kmeans
 from pymatgen.core import Structure
 from pymatgen.core.surface import Slab
-from pymatgen.io.vasp import Poscar
-from pymatgen.analysis.adsorption import AdsorbateSiteFinder
+
+from poscar_writer import write_structure
+import profiling
 
 # Adopted format: level - current function name - mess. Width is fixed as visual aid
 c_log = logging.getLogger(__name__)
@@ -51,11 +52,10 @@ def frz_central_slab(slab: Slab, frz_prop=0.30) -> Slab:
 
     """
     if type(slab) == Slab:  # This method is very costly (10 seconds for 40 atom systems)
-        t = time.time()
-        surface_sites = slab.get_surface_sites()
+        with profiling.phase("get_surface_sites") as timing:
+            surface_sites = slab.get_surface_sites()
         total_layers = (len(slab) / len(surface_sites["top"]))
-        t2 = time.time()
-        c_log.debug(f"Function call get_surface_sites took: {round(t2 - t, 3)} seconds?!")
+        c_log.debug(f"Function call get_surface_sites took: {round(timing.wall, 3)} seconds?!")
     elif type(slab) == Structure:  # Quicker but perhaps less reliable
         c_log.info(f"input file has been opened as: {type(slab)}, This may speed things up at a risk")
         total_layers = get_layer_count_from_structure(structure=slab, dimension=2, layer_tol=0.25)
@@ -113,6 +113,7 @@ def cli_run(argv) -> None:
     parser.add_argument("--debug", dest="debug", action="store_true")  # Always have the debug optional
     parser.add_argument("--verbose", dest="verbose", action="store_true")  # Always have the verbose optional
 
+    profiling.add_profile_argument(parser)
     args = parser.parse_args(argv)
 
     if args.debug:  # Always include method for switching verbosity
@@ -120,16 +121,21 @@ def cli_run(argv) -> None:
     if args.verbose:
         c_log.setLevel(logging.INFO)
     c_log.debug(args)
+    profiling.start(args.profile)
 
-    if args.fast or not args.slab_file.endswith("json"): # Use the fast method.
-        slab = Structure.from_file(filename=args.slab_file)
-    else:
-        f = open(args.slab_file)
-        d = json.load(f)
-        slab = Slab.from_dict(d=d)
-
-    dyn_slab = frz_central_slab(slab, args.frz_prop)
-    print(Poscar(dyn_slab, selective_dynamics=dyn_slab.site_properties["selective_dynamics"]))
+    with profiling.phase("parse"):
+        if args.fast or not args.slab_file.endswith("json"): # Use the fast method.
+            slab = Structure.from_file(filename=args.slab_file)
+        else:
+            f = open(args.slab_file)
+            d = json.load(f)
+            slab = Slab.from_dict(d=d)
+
+    with profiling.phase("analyse"):
+        dyn_slab = frz_central_slab(slab, args.frz_prop)
+    with profiling.phase("write"):
+        write_structure(dyn_slab, selective_dynamics=dyn_slab.site_properties["selective_dynamics"], end="\n")
+    profiling.report()
 
 
 if __name__ == "__main__":
@@ -8,6 +8,8 @@ import numpy as np
 
 from pymatgen.core import Structure
 
+import profiling
+
 # Adopted format: level - current function name - mess. Width is fixed as visual aid
 c_log = logging.getLogger(__name__)
 std_format = '[%(levelname)5s - %(funcName)10s] %(message)s'
@@ -58,6 +60,7 @@ def cli_run(argv) -> None:
     parser.add_argument("--debug", dest="debug", action="store_true")  # Always have the debug optional
     parser.add_argument("--verbose", dest="verbose", action="store_true")  # Always have the verbose optional
 
+    profiling.add_profile_argument(parser)
     args = parser.parse_args(argv)
 
     if args.debug:  # Always include method for switching verbosity
@@ -65,21 +68,25 @@ def cli_run(argv) -> None:
     if args.verbose:
         c_log.setLevel(logging.INFO)
     c_log.debug(args)
+    profiling.start(args.profile)
 
     strip_val = 0
     if args.strip:
         strip_val = 0.05
 
-    structure_1 = Structure.from_file(filename=args.file_1)
-    structure_2 = Structure.from_file(filename=args.file_2)
+    with profiling.phase("parse"):
+        structure_1 = Structure.from_file(filename=args.file_1)
+        structure_2 = Structure.from_file(filename=args.file_2)
 
-    dist, vec = get_ionic_delta(structure_1, structure_2)
+    with profiling.phase("analyse"):
+        dist, vec = get_ionic_delta(structure_1, structure_2)
 
     disp_str = "Number        Distance        Vector\n" # Converting into nice print format
     for n, x in enumerate(dist): # Strip values for the strip flag
         if x > strip_val:
             disp_str += f"Atom {n}:        {round(x, 4)}        {vec[n]}\n"
     print(disp_str)
+    profiling.report()
 
 
 if __name__ == "__main__":
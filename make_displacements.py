@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import sys, argparse, logging, os, json, shutil
+
+import numpy as np
+
+from pymatgen.core import Structure
+
+from element_subs import supercell_operations, _scale_matrix
+from forces_from_vasprun import final_forces
+from poscar_writer import poscar_string, structure_arrays, write_poscar, write_structure
+import profiling
+
+# Adopted format: level - current function name - mess. Width is fixed as visual aid
+c_log = logging.getLogger(__name__)
+std_format = '[%(levelname)5s - %(funcName)10s] %(message)s'
+logging.basicConfig(format=std_format)
+c_log.setLevel(logging.WARNING)
+
+RECORD = "displacements.json"  # Written next to the calc folders, all collect needs besides the forces
+
+
+def _match_sites(images: np.ndarray, frac_coords: np.ndarray, lattice: np.ndarray, tol: float = 0.1):
+    """
+    Index of the site each image lands on, None if any image is further than tol (Angstrom) from every site
+    """
+    d = images[:, None, :] - frac_coords[None, :, :]
+    d -= np.round(d)
+    dist = np.linalg.norm(d @ lattice, axis=-1)
+    nearest = np.argmin(dist, axis=1)
+    if dist[np.arange(len(images)), nearest].max() > tol or len(np.unique(nearest)) != len(images):
+        return None
+    return nearest
+
+
+def supercell_symmetry(unit: Structure, scale_matrix=None, symprec: float = 0.01, tol: float = 0.1) -> tuple:
+    """
+    Supercell of unit and its space group, the unit cell's operations times the lattice translations inside the
+    supercell. Returns (supercell, rotations, perms): rotations (n_ops x 3 x 3) are cartesian in row vector form
+    (v' = v @ R), perms[o, i] is the site operation o sends site i to.
+    """
+    supercell = unit.copy()
+    supercell.make_supercell(_scale_matrix(scale_matrix))
+    lattice, frac_coords = supercell.lattice.matrix, supercell.frac_coords
+    rotations, translations, lattice_shifts = supercell_operations(unit, scale_matrix, symprec=symprec)
+
+    cart, rot_perms = [], []
+    for r, t in zip(rotations, translations):
+        perm = _match_sites(frac_coords @ r + t, frac_coords, lattice, tol)
+        if perm is not None:
+            cart.append(np.linalg.inv(lattice) @ r @ lattice)
+            rot_perms.append(perm)
+    if len(rot_perms) < len(rotations):
+        c_log.warning(f"{len(rotations) - len(rot_perms)} operations don't map the sites onto themselves, dropped")
+    shift_perms = [p for p in (_match_sites(frac_coords + s, frac_coords, lattice, tol) for s in lattice_shifts)
+                   if p is not None]
+    perms = np.array([s[p] for p in rot_perms for s in shift_perms])
+    rotations = np.repeat(np.array(cart), len(shift_perms), axis=0)
+    c_log.info(f"{len(supercell)} sites, {len(perms)} operations")
+    return supercell, rotations, perms
+
+
+def orbits(perms: np.ndarray) -> tuple:
+    """
+    Symmetry irreducible sites (lowest index of each orbit), and per site its orbit's irreducible site and an
+    operation that sends that site onto it
+    """
+    n_sites = perms.shape[1]
+    representative = np.full(n_sites, -1)
+    operation = np.zeros(n_sites, dtype=int)
+    for i in range(n_sites):
+        if representative[i] < 0:
+            images, first = np.unique(perms[:, i], return_index=True)
+            representative[images] = i
+            operation[images] = first
+    return np.flatnonzero(representative == np.arange(n_sites)), representative, operation
+
+
+def displacement_directions(site_rotations: np.ndarray, candidates: np.ndarray, plus_minus: bool = None) -> list:
+    """
+    Fewest of the candidate unit vectors whose images under the site symmetry span all three directions.
+    Each comes with its negative when plus_minus, or (plus_minus None) when no site operation already sends it
+    onto its negative, central differences cancelling the leading anharmonic error.
+    """
+    chosen, images, rank = [], np.zeros((0, 3)), 0
+    for d in candidates:
+        new = np.vstack((images, d @ site_rotations))
+        new_rank = np.linalg.matrix_rank(new, tol=1e-6)
+        if new_rank > rank:
+            chosen.append(d)
+            images, rank = new, new_rank
+        if rank == 3:
+            break
+    directions = []
+    for d in chosen:
+        directions.append(d)
+        if plus_minus or (plus_minus is None and not np.any(np.abs(d @ site_rotations + d).max(axis=1) < 1e-6)):
+            directions.append(-d)
+    return directions
+
+
+def displacement_set(unit: Structure, scale_matrix=None, amplitude: float = 0.01, plus_minus: bool = None,
+                     symprec: float = 0.01) -> dict:
+    """
+    Symmetry reduced finite displacements of a supercell of unit. Only one site per orbit is displaced, and only
+    along the directions its site symmetry can't generate from the others, so the number of calculations drops
+    by about the order of the group compared to every site along x, y and z.
+    Returns supercell, rotations, perms (see supercell_symmetry) and displacements, a list of
+    (site, cartesian displacement in Angstrom).
+    """
+    supercell, rotations, perms = supercell_symmetry(unit, scale_matrix, symprec=symprec)
+    irreducible, _, _ = orbits(perms)
+    candidates = unit.lattice.matrix / np.linalg.norm(unit.lattice.matrix, axis=1)[:, None]
+    displacements = []
+    for i in irreducible:
+        site_rotations = rotations[perms[:, i] == i]
+        for d in displacement_directions(site_rotations, candidates, plus_minus=plus_minus):
+            displacements.append((int(i), amplitude * d))
+    c_log.info(f"{len(irreducible)} irreducible of {len(supercell)} sites, {len(displacements)} displacements "
+               f"instead of {6 * len(supercell)}")
+    return {"supercell": supercell, "rotations": rotations, "perms": perms, "displacements": displacements}
+
+
+def write_displacements(unit: Structure, result: dict, folder: str, scale_matrix=None, amplitude: float = 0.01,
+                        symprec: float = 0.01, template: str = None, reference: bool = False) -> list:
+    """
+    One calculation folder per displacement (folder/disp-001 ...) with the displaced supercell as POSCAR and the
+    files of template (INCAR, KPOINTS, POTCAR ...) copied in. disp-000 is the undisplaced supercell if reference,
+    its residual forces are then taken off the others. The unit cell (POSCAR_unit), perfect supercell (SPOSCAR)
+    and displacements.json record what collect_force_constants needs. Returns the folders.
+    """
+    os.makedirs(folder, exist_ok=True)
+    supercell = result["supercell"]
+    write_structure(unit, filename=os.path.join(folder, "POSCAR_unit"))
+    write_structure(supercell, filename=os.path.join(folder, "SPOSCAR"))
+
+    arrays = structure_arrays(supercell)
+    inverse = np.linalg.inv(supercell.lattice.matrix)
+    jobs = [("disp-000", None, None)] if reference else []
+    jobs += [(f"disp-{n:03d}", site, vector) for n, (site, vector) in enumerate(result["displacements"], start=1)]
+    template_files = [] if template is None else [
+        os.path.join(template, x) for x in sorted(os.listdir(template))
+        if os.path.isfile(os.path.join(template, x)) and x != "POSCAR"]
+
+    folders = []
+    for name, site, vector in jobs:
+        path = os.path.join(folder, name)
+        os.makedirs(path, exist_ok=True)
+        frac_coords = arrays["frac_coords"].copy()
+        comment = f"{arrays['comment']} undisplaced"
+        if site is not None:
+            frac_coords[site] += vector @ inverse
+            comment = f"{arrays['comment']} site {site + 1} by {' '.join(f'{x:.6f}' for x in vector)}"
+        write_poscar(poscar_string(**{**arrays, "frac_coords": frac_coords, "comment": comment}),
+                     filename=os.path.join(path, "POSCAR"))
+        for filename in template_files:
+            shutil.copy(filename, path)
+        folders.append(path)
+
+    record = {"scale_matrix": _scale_matrix(scale_matrix).tolist(), "amplitude": amplitude, "symprec": symprec,
+              "reference": reference, "n_sites": len(supercell),
+              "displacements": [{"folder": name, "site": site, "vector": vector.tolist()}
+                                for name, site, vector in jobs if site is not None]}
+    with open(os.path.join(folder, RECORD), "w") as f:
+        json.dump(record, f, indent=2)
+    return folders
+
+
+def force_constants(rotations: np.ndarray, perms: np.ndarray, displacements: list, forces: list,
+                    symmetrise: bool = True) -> np.ndarray:
+    """
+    Full (n_sites x n_sites x 3 x 3) force constant matrix, phi[i, j, a, b] = -dF_jb / du_ia in eV/A^2, from the
+    forces (n_sites x 3 each) of the reduced displacements (site, cartesian vector).
+    Each irreducible site's displacements and forces are rotated by its site symmetry into a full set, its rows
+    come from one least squares solve, and the rows of the rest of its orbit are rotated copies of them.
+    """
+    n_sites = perms.shape[1]
+    irreducible, representative, operation = orbits(perms)
+    fc = np.zeros((n_sites, n_sites, 3, 3))
+    sites = np.array([site for site, _ in displacements])
+    vectors = np.array([vector for _, vector in displacements])
+    forces = np.asarray(forces, dtype=float)
+
+    for i in irreducible:
+        mine = sites == i
+        if not mine.any():
+            raise ValueError(f"No displacement of irreducible site {i + 1}")
+        site_ops = np.flatnonzero(perms[:, i] == i)
+        rot = rotations[site_ops]
+        # u' = u @ R and F'[perm[j]] = F[j] @ R for every site operation, all at once
+        u = np.einsum("ka,sab->skb", vectors[mine], rot).reshape((-1, 3))
+        rotated = np.einsum("knb,sbc->sknc", forces[mine], rot)
+        f = np.empty_like(rotated)
+        f[np.arange(len(site_ops))[:, None, None], np.arange(mine.sum())[None, :, None], perms[site_ops][:, None, :]] \
+            = rotated
+        rows, _, rank, _ = np.linalg.lstsq(u, -f.reshape((len(u), -1)), rcond=None)
+        if rank < 3:
+            raise ValueError(f"Displacements of site {i + 1} don't span 3 directions")
+        fc[i] = rows.reshape((3, n_sites, 3)).transpose(1, 0, 2)
+
+    for k in np.flatnonzero(representative != np.arange(n_sites)):
+        r, o = rotations[operation[k]], perms[operation[k]]
+        fc[k, o] = r.T @ fc[representative[k]] @ r  # phi[P(i), P(j)] = R^T phi[i, j] R
+
+    return symmetrise_force_constants(fc, rotations, perms) if symmetrise else fc
+
+
+def symmetrise_force_constants(fc: np.ndarray, rotations: np.ndarray, perms: np.ndarray) -> np.ndarray:
+    """
+    Average over the space group, then phi[i, j] = phi[j, i]^T and the acoustic sum rule (sum_j phi[i, j] = 0,
+    rigid translations cost nothing) imposed on the self terms.
+    The group is every rotation times the pure translations, so the average is taken over one operation per
+    rotation (R^T phi R for all pairs as one (N^2 x 9) . kron(R, R) product) and then over the translations, which
+    only permute: n_rotations + n_translations passes rather than their product.
+    """
+    translations = perms[np.all(np.abs(rotations - np.eye(3)) < 1e-8, axis=(1, 2))]
+    _, first = np.unique(np.round(rotations, 8).reshape((len(rotations), 9)), axis=0, return_index=True)
+    rotated = np.zeros_like(fc)
+    for r, p in zip(rotations[first], perms[first]):
+        rotated[p[:, None], p[None, :]] += (fc.reshape((-1, 9)) @ np.kron(r, r)).reshape(fc.shape)
+    average = np.zeros_like(fc)
+    for p in translations:
+        average[p[:, None], p[None, :]] += rotated
+    fc = average / (len(first) * len(translations))
+    if len(first) * len(translations) != len(rotations):
+        c_log.warning(f"{len(rotations)} operations aren't {len(first)} rotations x {len(translations)} translations")
+    fc = (fc + fc.transpose(1, 0, 3, 2)) / 2
+    diagonal = np.arange(len(fc))
+    drift = fc.sum(axis=1)
+    c_log.info(f"Acoustic sum rule violation before correction: {np.abs(drift).max():.3e} eV/A^2")
+    fc[diagonal, diagonal] -= drift
+    fc[diagonal, diagonal] = (fc[diagonal, diagonal] + fc[diagonal, diagonal].transpose(0, 2, 1)) / 2
+    return fc
+
+
+def collect_force_constants(folder: str, symmetrise: bool = True) -> np.ndarray:
+    """
+    Force constants from the finished calculations of a write_displacements folder. Symmetry is worked out again
+    from POSCAR_unit with the recorded supercell and tolerance, forces are read from each folder's vasprun.xml
+    (or OUTCAR, compressed is fine).
+    """
+    with open(os.path.join(folder, RECORD)) as f:
+        record = json.load(f)
+    unit = Structure.from_file(os.path.join(folder, "POSCAR_unit"))
+    _, rotations, perms = supercell_symmetry(unit, record["scale_matrix"], symprec=record["symprec"])
+    if perms.shape[1] != record["n_sites"]:
+        raise ValueError(f"Supercell has {perms.shape[1]} sites but the displacements were made for "
+                         f"{record['n_sites']}")
+
+    names = [d["folder"] for d in record["displacements"]] + (["disp-000"] if record["reference"] else [])
+    forces = {name: final_forces(os.path.join(folder, name)) for name in names}
+    missing = [name for name, f in forces.items() if f is None]
+    if missing:
+        raise ValueError(f"No forces yet in {', '.join(missing)}")
+    residual = forces["disp-000"] if record["reference"] else 0.0
+
+    displacements = [(d["site"], np.array(d["vector"])) for d in record["displacements"]]
+    return force_constants(rotations, perms, displacements, [forces[d["folder"]] - residual
+                                                             for d in record["displacements"]], symmetrise=symmetrise)
+
+
+def write_force_constants(fc: np.ndarray, filename: str = "FORCE_CONSTANTS") -> None:
+    """
+    Phonopy's FORCE_CONSTANTS text format (1 based site pairs, each followed by its 3x3 block), one bulk format call
+    """
+    n = len(fc)
+    pairs = np.empty((n * n, 11), dtype=object)
+    pairs[:, 0] = np.repeat(np.arange(1, n + 1), n)
+    pairs[:, 1] = np.tile(np.arange(1, n + 1), n)
+    pairs[:, 2:] = fc.reshape((n * n, 9))
+    row_fmt = "%d %d\n" + "%22.15f %22.15f %22.15f\n" * 3
+    with open(filename, "w") as f:
+        f.write(f"{n} {n}\n" + (row_fmt * len(pairs)) % tuple(pairs.ravel().tolist()))
+
+
+def cli_run(argv) -> None:
+    """
+    Wrapper for the above command, handles parsing of args and logging, to avoid mess
+    """
+
+    global c_log
+
+    parser = argparse.ArgumentParser(description=displacement_set.__doc__)  # Parser init
+    parser.add_argument("poscar", type=str, default="POSCAR", nargs="?", help="Location of the unit cell POSCAR")
+    parser.add_argument("-s", "--scale", dest="scale_matrix", type=int, nargs="+", default=None,
+                        help="Supercell of the POSCAR to displace in, 3 (diagonal) or 9 (row major) integers")
+    parser.add_argument("-a", "--amplitude", dest="amplitude", type=float, default=0.01,
+                        help="Displacement length in Angstrom")
+    parser.add_argument("--pm", dest="plus_minus", type=str, default="auto", choices=["auto", "yes", "no"],
+                        help="Also displace by minus the vector: when symmetry doesn't already give it, always, never")
+    parser.add_argument("-o", "--output", dest="output", type=str, default="phonon", help="Folder for the calcs")
+    parser.add_argument("-t", "--template", dest="template", type=str, default=None,
+                        help="Folder whose INCAR / KPOINTS / POTCAR ... are copied into every calc")
+    parser.add_argument("--reference", dest="reference", action="store_true",
+                        help="Also write the undisplaced supercell, its residual forces are subtracted on collect")
+    parser.add_argument("--symprec", dest="symprec", type=float, default=0.01, help="Symmetry tolerance")
+    parser.add_argument("-c", "--collect", dest="collect", type=str, default=None,
+                        help="Folder of finished displacement calcs to build the force constants from instead")
+    parser.add_argument("-f", "--fc", dest="fc_file", type=str, default="FORCE_CONSTANTS",
+                        help="Force constants file written by --collect")
+    parser.add_argument("--no-symmetrise", dest="symmetrise", action="store_false",
+                        help="Skip the space group / sum rule symmetrisation of the collected force constants")
+    parser.add_argument("--debug", dest="debug", action="store_true")  # Always have the debug optional
+    parser.add_argument("--verbose", dest="verbose", action="store_true")  # Always have the verbose optional
+
+    profiling.add_profile_argument(parser)
+    args = parser.parse_args(argv)
+
+    if args.debug:  # Always include method for switching verbosity
+        c_log.setLevel(logging.DEBUG)
+    if args.verbose:
+        c_log.setLevel(logging.INFO)
+    c_log.debug(args)
+    profiling.start(args.profile)
+
+    if args.collect is not None:
+        try:
+            with profiling.phase("collect"):
+                fc = collect_force_constants(args.collect, symmetrise=args.symmetrise)
+        except ValueError as e:
+            profiling.report()
+            parser.error(str(e))
+        with profiling.phase("write"):
+            write_force_constants(fc, args.fc_file)
+        print(f"{len(fc)} x {len(fc)} force constants written to {args.fc_file}")
+        profiling.report()
+        return
+
+    scale_matrix = args.scale_matrix
+    if scale_matrix is not None and len(scale_matrix) == 9:
+        scale_matrix = [scale_matrix[0:3], scale_matrix[3:6], scale_matrix[6:9]]
+    elif scale_matrix is not None and len(scale_matrix) != 3:
+        parser.error(f"--scale needs 3 or 9 integers, got {len(scale_matrix)}")
+    plus_minus = {"auto": None, "yes": True, "no": False}[args.plus_minus]
+
+    with profiling.phase("parse"):
+        unit = Structure.from_file(filename=args.poscar)
+    with profiling.phase("analyse"):
+        result = displacement_set(unit, scale_matrix, amplitude=args.amplitude, plus_minus=plus_minus,
+                                  symprec=args.symprec)
+    with profiling.phase("write"):
+        folders = write_displacements(unit, result, args.output, scale_matrix=scale_matrix, amplitude=args.amplitude,
+                                      symprec=args.symprec, template=args.template, reference=args.reference)
+    print(f"{len(folders)} calcs written to {args.output} for {len(result['supercell'])} sites "
+          f"({6 * len(result['supercell'])} without symmetry)")
+    profiling.report()
+
+
+if __name__ == "__main__":
+    cli_run(sys.argv[1:])
@@ -4,6 +4,9 @@
 import sys, argparse, logging
 from typing import Optional
 
+from compressed import open_file
+import profiling
+
 # Adopted format: level - current function name - mess. Width is fixed as visual aid
 
 c_log = logging.getLogger(__name__)
@@ -18,7 +21,7 @@ def spincar_from_chgcar(chgcar_file: str = "CHGCAR") -> Optional[str]:
     """
     global c_log
     lines = []
-    with open(chgcar_file) as f:
+    with open_file(chgcar_file, "rt") as f:
         for i in f.readlines():
             lines.append(i)
     
@@ -45,12 +48,18 @@ def cli_run(argv) -> None:
     parser = argparse.ArgumentParser(description=spincar_from_chgcar.__doc__)  # Parser init
     parser.add_argument("chgcar", type=str, default="CHGCAR", help="location of CHGCAR file")
     parser.add_argument("--debug", dest="debug", action="store_true")
+    profiling.add_profile_argument(parser)
     args = parser.parse_args(argv)
 
     if args.debug:
         c_log.setLevel(logging.DEBUG)
+    profiling.start(args.profile)
 
-    print(spincar_from_chgcar(args.chgcar))
+    with profiling.phase("analyse"):
+        spincar = spincar_from_chgcar(args.chgcar)
+    with profiling.phase("write"):
+        print(spincar)
+    profiling.report()
 
 
 if __name__ == "__main__":
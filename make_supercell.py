@@ -2,10 +2,14 @@
 # coding: utf-8
 
 import sys, argparse, logging
-from typing import Optional, List
+from typing import Optional, List, TextIO
 
-from pymatgen.core import Structure
-from pymatgen.io.vasp import Poscar
+import numpy as np
+
+from pymatgen.core import Structure, Composition
+
+from poscar_writer import poscar_string, write_poscar, write_structure
+import profiling
 
 # Adopted format: level - current function name - mess. Width is fixed as visual aid
 c_log = logging.getLogger(__name__)
@@ -32,6 +36,77 @@ def make_supercell(structure: Structure, scale_matrix: Optional[List[int]] = Non
     return structure
 
 
+def lattice_points_in_supercell(scale_matrix: np.ndarray) -> np.ndarray:
+    """
+    Fractional (supercell basis) translations of every original lattice point inside the supercell.
+    Same enumeration as pymatgen so the site ordering matches make_supercell.
+    """
+    corners = np.array([[i, j, k] for i in (0, 1) for j in (0, 1) for k in (0, 1)])
+    d_points = np.dot(corners, scale_matrix)
+    mins = np.min(d_points, axis=0)
+    maxes = np.max(d_points, axis=0) + 1
+
+    ar = np.arange(mins[0], maxes[0])[:, None] * np.array([1, 0, 0])[None, :]
+    br = np.arange(mins[1], maxes[1])[:, None] * np.array([0, 1, 0])[None, :]
+    cr = np.arange(mins[2], maxes[2])[:, None] * np.array([0, 0, 1])[None, :]
+    all_points = (ar[:, None, None] + br[None, :, None] + cr[None, None, :]).reshape((-1, 3))
+
+    frac_points = np.dot(all_points, np.linalg.inv(scale_matrix))
+    t_vecs = frac_points[np.all(frac_points < 1 - 1e-10, axis=1) & np.all(frac_points >= -1e-10, axis=1)]
+    if len(t_vecs) != round(abs(np.linalg.det(scale_matrix))):
+        raise ValueError(f"Found {len(t_vecs)} lattice points for a supercell of volume {np.linalg.det(scale_matrix)}")
+    return t_vecs
+
+
+def supercell_arrays(lattice: np.ndarray, frac_coords: np.ndarray, scale_matrix) -> tuple:
+    """
+    Array-backed equivalent of make_supercell. Tiles the fractional coordinates with numpy broadcasting
+    for any integer scaling matrix (3 diagonal values or a full 3x3) without building any site objects.
+
+    Returns the new lattice matrix, the new fractional coords and the index of the parent site for each new site,
+    which is all that is needed to carry species (or any other site property) across.
+    Ordering is parent site major, as pymatgen does it.
+    """
+    scale_matrix = np.array(scale_matrix, dtype=int)
+    if scale_matrix.shape != (3, 3):
+        scale_matrix = scale_matrix * np.eye(3, dtype=int)
+    if round(np.linalg.det(scale_matrix)) == 0:
+        raise ValueError(f"Scale matrix is singular: {scale_matrix.tolist()}")
+
+    new_lattice = np.dot(scale_matrix, lattice)
+    t_vecs = lattice_points_in_supercell(scale_matrix)
+    c_log.debug(f"Lattice points in supercell: {len(t_vecs)}")
+
+    # Follow the same cartesian round trip as pymatgen so the coordinates agree to the last bit
+    cart_coords = np.dot(frac_coords, lattice)
+    cart_shifts = np.dot(t_vecs, new_lattice)
+    new_cart = (cart_coords[:, None, :] + cart_shifts[None, :, :]).reshape((-1, 3))
+    new_frac = np.mod(np.dot(new_cart, np.linalg.inv(new_lattice)), 1)
+    new_frac = np.mod(new_frac, 1)  # Second wrap (as pymatgen does) sends the -1e-17 -> 1.0 edge case back to 0.0
+
+    site_index = np.repeat(np.arange(len(frac_coords)), len(t_vecs))
+    return new_lattice, new_frac, site_index
+
+
+def fast_supercell_to_poscar(structure: Structure, scale_matrix, stream: TextIO = None, end: str = "") -> int:
+    """
+    Lazy route for very large supercells (i.e MLIP training cells), the parent structure is only used
+    for its arrays and the supercell is never built as a pymatgen Structure.
+    Returns the number of sites written.
+    """
+    lattice, frac_coords, site_index = supercell_arrays(structure.lattice.matrix, structure.frac_coords, scale_matrix)
+    labels = np.array([site.species_string for site in structure], dtype=object)[site_index]
+    symbols = np.array([site.specie.symbol for site in structure])[site_index]
+
+    n_cells = len(frac_coords) // len(structure)
+    comment = Composition(structure.composition * n_cells).formula
+    c_log.info(f"Supercell Size: {len(frac_coords)}")
+
+    write_poscar(poscar_string(lattice, frac_coords, labels=labels, symbols=symbols, comment=comment),
+                 stream=stream, end=end)
+    return len(frac_coords)
+
+
 def cli_run(argv) -> None:
     """
     Wrapper for the above command, handles parsing of args and logging, to avoid mess
@@ -41,11 +116,14 @@ def cli_run(argv) -> None:
 
     parser = argparse.ArgumentParser(description=make_supercell.__doc__)  # Parser init
     parser.add_argument("poscar", type=str, default="POSCAR", help="Location of POSCAR file", nargs="?")
-    parser.add_argument("scale_matrix", type=int, nargs=3, default=[1, 1, 1],
-                        help="Scaling matrix as space separated integers")
+    parser.add_argument("scale_matrix", type=int, nargs="+", default=[1, 1, 1],
+                        help="Scaling matrix as space separated integers, either 3 (diagonal) or 9 (row major)")
+    parser.add_argument("-f", "--fast", dest="fast", action="store_true",
+                        help="Tile the arrays directly and write the POSCAR without building the supercell")
 
     parser.add_argument("--verbose", dest="verbose", action="store_true", help="verbose printing")
     parser.add_argument("--debug", dest="debug", action="store_true", help="flag for debugging")  # Always debug
+    profiling.add_profile_argument(parser)
     args = parser.parse_args(argv)
 
     if args.debug:
@@ -53,9 +131,26 @@ def cli_run(argv) -> None:
     if args.verbose:
         c_log.setLevel(logging.INFO)
     c_log.debug(args)
-
-    structure = Structure.from_file(filename=args.poscar)
-    print(Poscar(make_supercell(structure=structure, scale_matrix=args.scale_matrix)))
+    profiling.start(args.profile)
+
+    if len(args.scale_matrix) == 9:
+        scale_matrix = [args.scale_matrix[0:3], args.scale_matrix[3:6], args.scale_matrix[6:9]]
+    elif len(args.scale_matrix) == 3:
+        scale_matrix = args.scale_matrix
+    else:
+        parser.error(f"scale_matrix needs 3 or 9 integers, got {len(args.scale_matrix)}")
+
+    with profiling.phase("parse"):
+        structure = Structure.from_file(filename=args.poscar)
+    if args.fast:
+        with profiling.phase("tile+write"):
+            fast_supercell_to_poscar(structure=structure, scale_matrix=scale_matrix, end="\n")
+    else:
+        with profiling.phase("analyse"):
+            structure = make_supercell(structure=structure, scale_matrix=scale_matrix)
+        with profiling.phase("write"):
+            write_structure(structure, end="\n")
+    profiling.report()
 
 
 if __name__ == "__main__":
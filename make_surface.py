@@ -8,6 +8,9 @@ from pymatgen.core.surface import SlabGenerator
 from pymatgen.core.surface import Structure, get_symmetrically_equivalent_miller_indices
 from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
 
+from ox_cache import OxidationCache, add_oxidation_state_cached, DEFAULT_CACHE, CACHE_HELP
+import profiling
+
 c_log = logging.getLogger(__name__)
 # Adopted format: level - current function name - mess. Width is fixed as visual aid
 std_format = '[%(levelname)5s - %(funcName)10s] %(message)s'
@@ -17,10 +20,10 @@ c_log.setLevel(logging.WARNING)
 
 def make_surface(init_structure: Structure, miller_index: tuple = None,
                  layer_size: int = 7, vac_size: int = 13,
-                 mode: str = "move-sites") -> None:
+                 mode: str = "move-sites", ox_cache: OxidationCache = None, ox_budget: float = None) -> None:
     global c_log
     # Guess the oxidation states to detect dipole
-    init_structure.add_oxidation_state_by_guess()
+    add_oxidation_state_cached(init_structure, cache=ox_cache, time_budget=ox_budget)
 
     if miller_index is None:
         c_log.warning("NO Miller index supplied defaulting to 0 0 1")
@@ -130,8 +133,15 @@ def cli_run(argv) -> None:
     parser.add_argument("--mode", dest="recon_mode", default="move-sites", type=str,
                         help="Mode to fix Tasker type 3 slabs, either move-sites (default) or break-stio.")
 
+    parser.add_argument("--ox-cache", dest="ox_cache", type=str, default=DEFAULT_CACHE, help=CACHE_HELP)
+    parser.add_argument("--no-ox-cache", dest="use_ox_cache", action="store_false",
+                        help="Always guess oxidation states from scratch, no cache file is created")
+    parser.add_argument("--ox-budget", dest="ox_budget", type=float, default=None,
+                        help="Seconds allowed for the oxidation state guess before using bond valence")
+
     parser.add_argument("--verbose", dest="verbose", action="store_true")
     parser.add_argument("--debug", dest="debug", action="store_true")
+    profiling.add_profile_argument(parser)
     args = parser.parse_args(argv)
 
     if args.verbose:
@@ -140,11 +150,16 @@ def cli_run(argv) -> None:
         c_log.setLevel(logging.DEBUG)
 
     c_log.debug(args)
+    profiling.start(args.profile)
 
     os.makedirs("slabs/", exist_ok=True)
-    init_structure = Structure.from_file(args.bulk_poscar)
-    make_surface(init_structure, miller_index=args.millerplane, vac_size=args.vac, layer_size=args.lay,
-                 mode=args.recon_mode)
+    with profiling.phase("parse"):
+        init_structure = Structure.from_file(args.bulk_poscar)
+    ox_cache = OxidationCache(args.ox_cache) if args.use_ox_cache else None
+    with profiling.phase("make_surface"):
+        make_surface(init_structure, miller_index=args.millerplane, vac_size=args.vac, layer_size=args.lay,
+                     mode=args.recon_mode, ox_cache=ox_cache, ox_budget=args.ox_budget)
+    profiling.report()
 
 
 if __name__ == "__main__":
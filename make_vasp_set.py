@@ -1,12 +1,20 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
-import sys, argparse, logging
+import sys, argparse, logging, os, glob, re, json, itertools
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
 
 from pymatgen.io.vasp.sets import MPMetalRelaxSet, MPRelaxSet, _load_yaml_config
-from pymatgen.io.vasp.inputs import Incar
+from pymatgen.io.vasp.inputs import Incar, Potcar
 from pymatgen.core import Structure
 
+from ox_cache import OxidationCache, add_oxidation_state_cached, DEFAULT_CACHE, CACHE_HELP
+from poscar_writer import poscar_string, structure_arrays
+import profiling
+
 # Adopted format: level - current function name - mess. Width is fixed as visual aid
 c_log = logging.getLogger(__name__)
 std_format = '[%(levelname)5s - %(funcName)10s] %(message)s'
@@ -106,6 +114,29 @@ class BtRelaxInsulSet(BtRelaxUnknownSet):
         self.kwargs = kwargs
 
 
+# Flag -> group number for sort_incar_flags, built once at import rather than searched per flag
+# General order is: starting flags, writing flags, elecrelax flags, ion relax flags, performance flags, misc flags.
+INCAR_FLAG_GROUPS = {}
+for _group, _flags in enumerate([
+        ["ISTART", "ICHARG", "INIWAV", "ISPIN", "MAGMOM", "LNONCOLLINEAR", "LSORBIT", "LASPH", "METAGGA"],
+        ["NWRITE", "LWAVE", "LDOWNSAMPLE", "LCHARG", "LVTOT", "LVHAR", "LELF", "LORBIT"],
+        ["ALGO", "PREC", "ENCUT", "ENINI", "ENAUG", "NELM", "EDIFF", "LMAXMIX", "ROPT"],
+        ["ISMEAR", "SIGMA", "IMIX", "AMIX", "BMIX", "AMIX_MAG", "BMIX_MAG"],
+        ["EDIFFG", "NSW", "IBRION", "ISIF", "ISYM", "POTIM"]]):
+    INCAR_FLAG_GROUPS.update(dict.fromkeys(_flags, _group))
+INCAR_FLAG_GROUPS.update(dict.fromkeys(["NCORE", "LREAL", "KPAR"], 6))  # 5 is every LDA* flag
+
+
+def incar_flag_group(key: str) -> int:
+    """
+    Sort group of an INCAR flag, see INCAR_FLAG_GROUPS
+    """
+    group = INCAR_FLAG_GROUPS.get(key)
+    if group is None:
+        group = 5 if key.startswith("LDA") else 7
+    return group
+
+
 def sort_incar_flags(incar: Incar):
     """
     Method to sort the incar flags (from the typical alphabetical to a much more reader friendly form)
@@ -115,46 +146,13 @@ def sort_incar_flags(incar: Incar):
     starting flags, writing flags, elecrelax flags, ion relax flags, performance flags, misc flags.
 
     """
-    global c_log
 
-    start_flags = ["ISTART", "ICHARG",
-                   "INIWAV", "ISPIN", "MAGMOM", "LNONCOLLINEAR", "LSORBIT",
-                   "LASPH", "METAGGA"]
-
-    write_flags = ["NWRITE", "LWAVE", "LDOWNSAMPLE", "LCHARG", "LVTOT", "LVHAR", "LELF", "LORBIT"]
-    erel_flags = ["ALGO", "PREC", "ENCUT", "ENINI", "ENAUG", "NELM", "EDIFF", "LMAXMIX", "ROPT"]
-    erel_mixs = ["ISMEAR", "SIGMA", "IMIX", "AMIX", "BMIX", "AMIX_MAG", "BMIX_MAG"]
-    ionic_flags = ["EDIFFG", "NSW", "IBRION", "ISIF", "ISYM", "POTIM", ]
-    perf_flags = ["NCORE", "LREAL", "KPAR"]
-
-    new_incar = incar
-    for k, v in incar.items():
-        if k in start_flags:
-            new_incar[k] = (v, 0)
-        elif k in write_flags:
-            new_incar[k] = (v, 1)
-        elif k in erel_flags:
-            new_incar[k] = (v, 2)
-        elif k in erel_mixs:
-            new_incar[k] = (v, 3)
-        elif k in ionic_flags:
-            new_incar[k] = (v, 4)
-        elif k.startswith("LDA"):
-            new_incar[k] = (v, 5)
-        elif k in perf_flags:
-            new_incar[k] = (v, 6)
-        else:
-            new_incar[k] = (v, 7)
-
-    new_dict = dict(sorted(new_incar.items(), key=lambda item: item[1][1]))
-    f_dict = {k: v[0] for k, v in new_dict.items()}
-    i = Incar.from_dict(f_dict)
-
-    return i
+    return Incar({k: incar[k] for k in sorted(incar, key=incar_flag_group)})
 
 
 def make_vasp_set(structure: Structure, fmt="unknown", ox_states=None,
-                  user_incar_settings=None, user_kpoints_settings=None):
+                  user_incar_settings=None, user_kpoints_settings=None,
+                  ox_cache: OxidationCache = None, ox_budget: float = None):
     """
     Make a vaspset from a structure,
 
@@ -165,11 +163,13 @@ def make_vasp_set(structure: Structure, fmt="unknown", ox_states=None,
      Multiple system fmt (metal, insulator, unknown) specified by a string
      It will attempt to calculate the oxidation states and thus spin states for the structures.
      :)
+     Guessed oxidation states are looked up in / stored to ox_cache (by reduced formula) if one is given, and
+     ox_budget caps the guess in seconds before falling back to bond valence.
 
     """
 
     if ox_states is None:
-        structure.add_oxidation_state_by_guess()
+        add_oxidation_state_cached(structure, cache=ox_cache, time_budget=ox_budget)
     else:
         structure.add_oxidation_state_by_element(oxidation_states=ox_states)
 
@@ -189,6 +189,203 @@ def make_vasp_set(structure: Structure, fmt="unknown", ox_states=None,
     return vaspset
 
 
+# (set class, user incar settings, species order, small k mesh) -> INCAR template, filled per process as sets are
+# rendered
+_incar_templates = {}
+
+
+def _incar_template(vaspset, labels):
+    """
+    Renders every INCAR line except MAGMOM once, in sort_incar_flags order, with a species -> magmom map for
+    the per structure MAGMOM line. Returns None when the INCAR depends on more than the species present
+    (site magmoms, non collinear, EDIFF from EDIFF_PER_ATOM) so the caller renders it in full every time.
+    """
+    incar = vaspset.incar
+    settings = {**vaspset._config_dict["INCAR"], **(vaspset.user_incar_settings or {})}
+    per_atom_ediff = "EDIFF_PER_ATOM" in settings and "EDIFF" not in settings  # pymatgen scales it by the sites
+    if incar.get("LSORBIT") or incar.get("LNONCOLLINEAR") or per_atom_ediff:
+        return None
+    if "magmom" in vaspset.structure.site_properties:
+        return None
+
+    magmoms = {}
+    for label, magmom in zip(labels, incar.get("MAGMOM", [])):
+        if magmoms.setdefault(label, magmom) != magmom:  # Same species with different moments
+            return None
+
+    lines = [None if k == "MAGMOM" else str(Incar({k: incar[k]})).rstrip("\n")
+             for k in sorted(incar, key=incar_flag_group)]
+    return lines, magmoms
+
+
+def render_incar(vaspset, kpoints=None) -> str:
+    """
+    INCAR text for a vaspset with flags in sort_incar_flags order. Everything but MAGMOM only depends on the
+    set class, the user settings, which species appear in which order and whether the k mesh is small enough
+    (< 4 points) for pymatgen to swap ISMEAR = -5 for 0, so that part is rendered once per combination and
+    cached, only the MAGMOM line is filled in per structure. kpoints is vaspset.kpoints if already built.
+    """
+    labels = [site.species_string for site in vaspset.structure]
+    kpoints = vaspset.kpoints if kpoints is None else kpoints
+    small_mesh = kpoints is not None and np.prod(kpoints.kpts) < 4
+    key = (type(vaspset).__name__, json.dumps(vaspset.user_incar_settings or {}, sort_keys=True, default=str),
+           tuple(label for label, _ in itertools.groupby(labels)), bool(small_mesh))
+    if key not in _incar_templates:
+        _incar_templates[key] = _incar_template(vaspset, labels)
+        c_log.debug(f"New INCAR template for {key}")
+
+    template = _incar_templates[key]
+    if template is None:
+        incar = vaspset.incar
+        return "\n".join(str(Incar({k: incar[k]})).rstrip("\n") for k in sorted(incar, key=incar_flag_group)) + "\n"
+
+    lines, magmoms = template
+    magmom = str(Incar({"MAGMOM": [magmoms[label] for label in labels]})).rstrip("\n") if magmoms else None
+    return "\n".join(magmom if line is None else line for line in lines) + "\n"
+
+
+@lru_cache(maxsize=None)
+def potcar_text(functional: str, symbols: tuple) -> str:
+    """
+    Concatenated POTCAR for an element combination, read from the pseudopotential library once per process.
+    """
+    return str(Potcar(symbols=list(symbols), functional=functional))
+
+
+def write_rendered_input(vaspset, output_dir: str, include_cif: bool = True) -> None:
+    """
+    Faster write_input for batches, INCAR from render_incar, POTCAR from the per element combination cache and
+    POSCAR from the shared writer. KPOINTS is the only file built from scratch.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    structure = vaspset.structure
+    kpoints = vaspset.kpoints  # None when KSPACING is used
+    files = {"INCAR": render_incar(vaspset, kpoints=kpoints),
+             "POSCAR": poscar_string(**structure_arrays(structure)),
+             "POTCAR": potcar_text(vaspset.potcar_functional, tuple(vaspset.potcar_symbols))}
+    if kpoints is not None:
+        files["KPOINTS"] = str(kpoints)
+
+    for name, text in files.items():
+        with open(os.path.join(output_dir, name), "w") as f:
+            f.write(text)
+    if include_cif:
+        structure.to(filename=os.path.join(output_dir, re.sub(r"\s", "", structure.formula) + ".cif"))
+
+
+def _to_number(val):
+    """
+    Best effort conversion of a CLI string to int / float, anything else is left as is.
+    """
+    for cast in (int, float):
+        try:
+            return cast(val)
+        except ValueError:
+            pass
+    return val
+
+
+def pairs_to_dict(values, incar=False):
+    """
+    Turns the space separated key value pairs from the CLI (i.e ["ENCUT", "600", "ISPIN", "2"]) into a dict.
+    Incar flags go through pymatgen's own value processing.
+    """
+    if not values:
+        return None
+    if len(values) % 2:
+        raise ValueError(f"Expected key value pairs, got an odd number of values: {values}")
+    pairs = zip(values[::2], values[1::2])
+    if incar:
+        return {k.upper(): Incar.proc_val(k.upper(), v) for k, v in pairs}
+    return {k: _to_number(v) for k, v in pairs}
+
+
+def find_structures(source: str) -> list:
+    """
+    Every file in a directory, or everything matched by a glob, sorted.
+    """
+    if os.path.isdir(source):
+        return sorted(os.path.join(source, x) for x in os.listdir(source)
+                      if not x.startswith(".") and os.path.isfile(os.path.join(source, x)))
+    return sorted(glob.glob(source))
+
+
+def set_dir_names(filenames) -> list:
+    """
+    Output directory name per structure file: the file stem, or the parent folder for POSCAR / CONTCAR files.
+    Clashes get a _n suffix.
+    """
+    names, seen = [], {}
+    for filename in filenames:
+        stem = os.path.splitext(os.path.basename(filename))[0]
+        if stem in ("POSCAR", "CONTCAR"):
+            stem = os.path.basename(os.path.dirname(os.path.abspath(filename)))
+        seen[stem] = seen.get(stem, -1) + 1
+        names.append(stem if not seen[stem] else f"{stem}_{seen[stem]}")
+    return names
+
+
+_worker_ox_cache = None  # Per worker handle, sqlite connections can't be sent through the pool
+
+
+def _init_batch_worker(log_level, ox_cache_file) -> None:
+    """
+    Pool initializer, the set classes (and their YAML config) are loaded once per worker on import,
+    so every structure after the first only pays for its own work.
+    """
+    global _worker_ox_cache
+    c_log.setLevel(log_level)
+    if ox_cache_file is not None:
+        _worker_ox_cache = OxidationCache(ox_cache_file)
+
+
+def _make_one(job) -> tuple:
+    """
+    Pool job: read, build and write one vasp set. Returns (filename, error or None).
+    """
+    filename, output_dir, kwargs = job
+    try:
+        structure = Structure.from_file(filename)
+        vaspset = make_vasp_set(structure=structure, ox_cache=_worker_ox_cache, **kwargs)
+        write_rendered_input(vaspset, output_dir=output_dir, include_cif=True)
+    except Exception as e:  # Log and carry on, one odd structure shouldn't stop a campaign
+        return filename, f"{type(e).__name__}: {e}"
+    return filename, None
+
+
+def batch_make_vasp_sets(filenames, output_root: str, processes: int = None, progress: bool = True,
+                         ox_cache_file: str = None, **kwargs) -> list:
+    """
+    Batch version of make_vasp_set. Builds and writes a vasp set for every structure file on a process pool,
+    each into output_root/<name>. kwargs are passed through to make_vasp_set, ox_cache_file is opened per worker.
+    Failures are written to output_root/failures.log and returned as (filename, error) tuples.
+    """
+    os.makedirs(output_root, exist_ok=True)
+    jobs = [(filename, os.path.join(output_root, name), kwargs)
+            for filename, name in zip(filenames, set_dir_names(filenames))]
+    c_log.info(f"Building {len(jobs)} vasp sets in {output_root}")
+
+    failures = []
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_batch_worker,
+                             initargs=(c_log.level, ox_cache_file)) as pool:
+        futures = [pool.submit(_make_one, job) for job in jobs]
+        for n, future in enumerate(as_completed(futures), 1):
+            filename, error = future.result()
+            if error is not None:
+                failures.append((filename, error))
+                c_log.info(f"{filename}: {error}")
+            if progress:
+                sys.stderr.write(f"\r[{n}/{len(jobs)}] done, {len(failures)} failed")
+                sys.stderr.flush()
+    if progress:
+        sys.stderr.write("\n")
+
+    with open(os.path.join(output_root, "failures.log"), "w") as f:
+        for filename, error in sorted(failures):
+            f.write(f"{filename}\t{error}\n")
+    return failures
+
+
 def cli_run(argv) -> None:
     """
     Wrapper for the above command, handles parsing of args and logging, to avoid mess
@@ -197,14 +394,25 @@ def cli_run(argv) -> None:
     global c_log
 
     parser = argparse.ArgumentParser(description=make_vasp_set.__doc__)  # Parser init
-    parser.add_argument("filename", type=str, default="POSCAR", help="location of the pymatgen structure")
+    parser.add_argument("filename", type=str, default="POSCAR",
+                        help="location of the pymatgen structure (a directory or glob with --batch)")
     parser.add_argument("output_dir", type=str, default=".", help="location to create the vasp set")
+    parser.add_argument("-b", "--batch", dest="batch", action="store_true",
+                        help="Make a set for every structure in a directory / glob, one sub folder each")
+    parser.add_argument("-n", "--nproc", dest="processes", type=int, default=None,
+                        help="Number of worker processes in batch mode (default: all cores)")
 
     parser.add_argument("-f", "--fmt", dest="fmt", default="unknown", help="format of the desired incar")
 
     parser.add_argument("-o", "--ox_states", dest="ox_states", nargs="*",
                         default=None, help="oxidation states as space seperated key value pairs i.e: Li 1")
 
+    parser.add_argument("--ox-cache", dest="ox_cache", type=str, default=DEFAULT_CACHE, help=CACHE_HELP)
+    parser.add_argument("--no-ox-cache", dest="use_ox_cache", action="store_false",
+                        help="Always guess oxidation states from scratch, no cache file is created")
+    parser.add_argument("--ox-budget", dest="ox_budget", type=float, default=None,
+                        help="Seconds allowed for the oxidation state guess before using bond valence")
+
     parser.add_argument("-i", "--iflags", dest="incar_settings", nargs="*",
                         default=None, help="incar flags as space seperated key value pairs i.e: ENCUT 600")
 
@@ -214,6 +422,7 @@ def cli_run(argv) -> None:
     parser.add_argument("--debug", dest="debug", action="store_true")  # Always have the verbose optional
     parser.add_argument("--verbose", dest="verbose", action="store_true")  # Always have the verbose optional
 
+    profiling.add_profile_argument(parser)
     args = parser.parse_args(argv)
 
     if args.debug:  # Always include method for switching verbosity
@@ -221,14 +430,32 @@ def cli_run(argv) -> None:
     if args.verbose:
         c_log.setLevel(logging.INFO)
     c_log.debug(args)
+    profiling.start(args.profile)
+
+    settings = {"fmt": args.fmt, "ox_states": pairs_to_dict(args.ox_states),
+                "user_incar_settings": pairs_to_dict(args.incar_settings, incar=True),
+                "user_kpoints_settings": pairs_to_dict(args.k_settings), "ox_budget": args.ox_budget}
+    ox_cache_file = args.ox_cache if args.use_ox_cache else None
+
+    if args.batch:
+        filenames = find_structures(args.filename)
+        with profiling.phase("batch"):
+            failures = batch_make_vasp_sets(filenames, output_root=args.output_dir, processes=args.processes,
+                                            ox_cache_file=ox_cache_file, **settings)
+        print(f"{len(filenames) - len(failures)} / {len(filenames)} sets written to {args.output_dir}")
+        profiling.report()
+        return
+
+    with profiling.phase("parse"):
+        structure = Structure.from_file(args.filename)
+    ox_cache = OxidationCache(ox_cache_file) if ox_cache_file is not None else None
+    with profiling.phase("analyse"):
+        vaspset = make_vasp_set(structure=structure, ox_cache=ox_cache, **settings)
+
+    with profiling.phase("write"):
+        write_rendered_input(vaspset, output_dir=args.output_dir, include_cif=True)  # Same INCAR as batch mode
+    profiling.report()
 
 
-    structure = Structure.from_file(args.filename)
-    vaspset = make_vasp_set(structure=structure, fmt=args.fmt,
-                            ox_states=args.ox_states)
-
-    vaspset.write_input(output_dir=args.output_dir,
-                        make_dir_if_not_present=True, include_cif=True)
-
 if __name__ == "__main__":
     cli_run(sys.argv[1:])
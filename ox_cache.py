@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import sys, argparse, logging, os, json, sqlite3, time
+import multiprocessing
+
+from pymatgen.core import Structure, Composition
+from pymatgen.analysis.bond_valence import BVAnalyzer
+
+import profiling
+
+# Adopted format: level - current function name - mess. Width is fixed as visual aid
+c_log = logging.getLogger(__name__)
+std_format = '[%(levelname)5s - %(funcName)10s] %(message)s'
+logging.basicConfig(format=std_format)
+c_log.setLevel(logging.WARNING)
+
+DEFAULT_CACHE = os.environ.get("BUD_OX_CACHE",
+                               os.path.join(os.path.expanduser("~"), ".cache", "bud-tools", "ox_states.sqlite"))
+CACHE_HELP = (f"Oxidation state guess cache file, created (with its directory) if missing whenever the cache is used "
+              f"(default: $BUD_OX_CACHE or {DEFAULT_CACHE})")
+
+
+class OxidationCache:
+    """
+    Persistent, composition keyed (reduced formula) store of guessed oxidation states with LRU eviction.
+    A formula whose guess ran out of time budget is stored with no states and the budget it ran out of, so later
+    calls with the same or a smaller budget go straight to the bond valence fallback instead of paying it again,
+    while a larger (or no) budget tries the guess again.
+    """
+
+    def __init__(self, filename: str = DEFAULT_CACHE, max_entries: int = 10000):
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        self.filename = filename
+        self.max_entries = max_entries
+        self.db = sqlite3.connect(filename, timeout=30)  # Batch workers share the file
+        self.db.execute("CREATE TABLE IF NOT EXISTS ox_states "
+                        "(formula TEXT PRIMARY KEY, states TEXT, used REAL, budget REAL)")
+        if "budget" not in [name for _, name, *_ in self.db.execute("PRAGMA table_info(ox_states)")]:
+            self.db.execute("ALTER TABLE ox_states ADD COLUMN budget REAL")  # Cache from before budgets were kept
+        self.db.commit()
+
+    def get(self, formula: str, time_budget: float = None):
+        """
+        Returns (hit, states), states is an element -> oxidation state dict or None for a timed out formula.
+        A timeout only counts as a hit if time_budget is no larger than the budget it ran out of.
+        """
+        row = self.db.execute("SELECT states, budget FROM ox_states WHERE formula = ?", (formula,)).fetchone()
+        if row is None:
+            return False, None
+        states, budget = row
+        if states is None and (time_budget is None or budget is None or time_budget > budget):
+            return False, None
+        with self.db:
+            self.db.execute("UPDATE ox_states SET used = ? WHERE formula = ?", (time.time(), formula))
+        return True, (json.loads(states) if states is not None else None)
+
+    def put(self, formula: str, states, time_budget: float = None) -> None:
+        """
+        Stores a guess, states None meaning it ran out of time_budget.
+        """
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO ox_states (formula, states, used, budget) VALUES (?, ?, ?, ?)",
+                            (formula, json.dumps(states) if states is not None else None, time.time(),
+                             time_budget if states is None else None))
+            self.db.execute("DELETE FROM ox_states WHERE formula NOT IN "
+                            "(SELECT formula FROM ox_states ORDER BY used DESC LIMIT ?)", (self.max_entries,))
+
+    def clear(self) -> None:
+        with self.db:
+            self.db.execute("DELETE FROM ox_states")
+        self.db.execute("VACUUM")
+
+    def items(self) -> list:
+        """
+        (formula, states, budget) most recently used first, budget is only set for timed out formulas.
+        """
+        return [(f, json.loads(s) if s is not None else None, b)
+                for f, s, b in self.db.execute("SELECT formula, states, budget FROM ox_states ORDER BY used DESC")]
+
+    def close(self) -> None:
+        self.db.close()
+
+
+def _guess(composition: Composition):
+    """
+    Same guess add_oxidation_state_by_guess makes, element -> state for the most likely assignment.
+    """
+    guesses = composition.oxi_state_guesses()
+    if not guesses:
+        return {el.symbol: 0 for el in composition}
+    return dict(guesses[0])
+
+
+def guess_with_budget(composition: Composition, time_budget: float = None):
+    """
+    Runs the (combinatorial) oxidation state guess, in a separate process if a time budget in seconds is given
+    so it can be killed. Returns the element -> state dict or None if the budget ran out.
+    """
+    if time_budget is None:
+        return _guess(composition)
+
+    with multiprocessing.Pool(1) as pool:
+        result = pool.apply_async(_guess, (composition,))
+        try:
+            return result.get(timeout=time_budget)
+        except multiprocessing.TimeoutError:
+            c_log.info(f"Oxidation state guess for {composition.reduced_formula} ran past {time_budget} s")
+            pool.terminate()
+            return None
+
+
+def add_oxidation_state_cached(structure: Structure, cache: OxidationCache = None,
+                               time_budget: float = None) -> Structure:
+    """
+    Drop in for structure.add_oxidation_state_by_guess() that looks the reduced formula up in the cache first.
+    If the guess runs past time_budget (seconds) the bond valence estimate is used for this structure instead.
+    """
+    formula = structure.composition.reduced_formula
+    hit, states = (cache.get(formula, time_budget=time_budget) if cache is not None else (False, None))
+    c_log.debug(f"{formula}: cache {'hit' if hit else 'miss'}")
+
+    if not hit:
+        states = guess_with_budget(structure.composition, time_budget=time_budget)
+        if cache is not None:
+            cache.put(formula, states, time_budget=time_budget)
+
+    if states is not None:
+        structure.add_oxidation_state_by_element(states)
+        return structure
+
+    c_log.info(f"{formula}: falling back to the bond valence estimate")
+    try:
+        structure.add_oxidation_state_by_site(BVAnalyzer().get_valences(structure))
+    except ValueError as e:  # BV couldn't find a valid assignment either
+        c_log.warning(f"Bond valence estimate failed for {formula} ({e}), setting all states to 0")
+        structure.add_oxidation_state_by_element({el.symbol: 0 for el in structure.composition})
+    return structure
+
+
+def cli_run(argv) -> None:
+    """
+    Wrapper for the above command, handles parsing of args and logging, to avoid mess
+    """
+
+    global c_log
+
+    parser = argparse.ArgumentParser(description=OxidationCache.__doc__)  # Parser init
+    parser.add_argument("poscar", type=str, nargs="*", help="Structures to guess (and cache) oxidation states for")
+    parser.add_argument("--cache", dest="cache", type=str, default=DEFAULT_CACHE, help=CACHE_HELP)
+    parser.add_argument("--budget", dest="budget", type=float, default=None,
+                        help="Seconds to allow the guess before falling back to bond valence")
+    parser.add_argument("--list", dest="list", action="store_true", help="Dump the cache contents")
+    parser.add_argument("--clear", dest="clear", action="store_true", help="Empty the cache")
+    parser.add_argument("--debug", dest="debug", action="store_true")  # Always have the debug optional
+    parser.add_argument("--verbose", dest="verbose", action="store_true")  # Always have the verbose optional
+
+    profiling.add_profile_argument(parser)
+    args = parser.parse_args(argv)
+
+    if args.debug:  # Always include method for switching verbosity
+        c_log.setLevel(logging.DEBUG)
+    if args.verbose:
+        c_log.setLevel(logging.INFO)
+    c_log.debug(args)
+    profiling.start(args.profile)
+
+    cache = OxidationCache(args.cache)
+    if args.clear:
+        cache.clear()
+    for filename in args.poscar:
+        with profiling.phase("parse"):
+            structure = Structure.from_file(filename)
+        with profiling.phase("guess"):
+            structure = add_oxidation_state_cached(structure, cache=cache, time_budget=args.budget)
+        print(f"{filename}: {' '.join(sorted(set(site.species_string for site in structure)))}")
+    if args.list:
+        for formula, states, budget in cache.items():
+            print(f"{formula}: {states if states is not None else f'bond valence (guess ran past {budget} s)'}")
+    cache.close()
+    profiling.report()
+
+
+if __name__ == "__main__":
+    cli_run(sys.argv[1:])
@@ -1,38 +1,354 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
-import sys, argparse, logging
+from __future__ import annotations  # Type hints only, pandas is imported where the table is built
 
+import sys, argparse, logging, os, json, sqlite3, hashlib, fnmatch, time, inspect, warnings
+from concurrent.futures import ProcessPoolExecutor
+from typing import TYPE_CHECKING
+
+import numpy as np
 
-from pymatgen.io.vasp import Oszicar
 from pymatgen.io.vasp import Vasprun
-from pymatgen.io.vasp import Outcar
+from pymatgen.io.vasp import Incar
 from pymatgen.io.vasp import Kpoints
 from pymatgen.core import Structure
 
+from poscar_writer import poscar_string, structure_arrays
+from compressed import find_file, variants
+from vasp_scan import scan_oszicar, scan_outcar, scan_status
+import profiling
+
+if TYPE_CHECKING:
+    import pandas as pd
+
 # Adopted format: level - current function name - mess. Width is fixed as visual aid
 c_log = logging.getLogger(__name__)
 std_format = '[%(levelname)5s - %(funcName)10s] %(message)s'
 logging.basicConfig(format=std_format)
 c_log.setLevel(logging.WARNING)
 
+# Any of these (or their .gz / .xz / .bz2) in a folder marks it as a calculation folder
+CALC_FILES = ("INCAR", "OSZICAR", "OUTCAR", "vasprun.xml", "CONTCAR")
+# Files whose change means the folder has to be parsed again
+TRACKED_FILES = tuple(x for name in CALC_FILES + ("KPOINTS",) for x in variants(name))
+INDEX_NAME = ".harvest_index.sqlite"
+
+
+def find_calc_folders(root: str) -> list:
+    """
+    Walks root and returns every folder holding at least one of CALC_FILES, sorted so the table order is stable.
+    """
+    folders = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        if any(x in filenames for name in CALC_FILES for x in variants(name)):
+            folders.append(dirpath)
+    folders.sort()
+    return folders
+
+
+def _read_vasprun(folder: str) -> tuple:
+    """
+    Last resort source, only opened when the cheaper files are missing. Returns (vasprun, complete), complete
+    being whether the xml parsed to the end, which it only does once VASP has finished and closed it.
+    """
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        vasprun = Vasprun(filename=find_file(os.path.join(folder, "vasprun.xml")),
+                          parse_dos=False, parse_eigen=False, parse_projected_eigen=False,
+                          parse_potcar_file=False, exception_on_bad_xml=False)
+    malformed = [w for w in caught if "XML is malformed" in str(w.message)]
+    for w in caught:  # Pass the rest on as if nothing was recorded
+        if w not in malformed:
+            warnings.warn_explicit(w.message, w.category, w.filename, w.lineno)
+    return vasprun, not malformed
+
 
 def parse_vasp_folder(folder,
-                      read_contcar=True, read_incar=True, read_vasprun=True, read_kpoints=True) -> None:
+                      read_contcar=True, read_incar=True, read_vasprun=True, read_kpoints=True) -> dict:
     """
     Method for parsing a folder containing a vasp calculation and parsing potentially important information.
+
+    Each quantity comes from the cheapest file that has it (OSZICAR before OUTCAR before vasprun) and a file
+    is only opened if something still needs it. read_vasprun=False never touches the vasprun at all.
+    Returns a flat dict (one table row): energy, max force, final structure (as POSCAR text),
+    INCAR (json), kpoints and convergence flags, plus which file each came from.
     """
+    row = {"path": folder, "energy": np.nan, "energy_source": None, "n_ionic": 0,
+           "max_force": np.nan, "force_source": None,
+           "formula": None, "n_sites": 0, "structure": None, "structure_source": None,
+           "incar": None, "kpoints": None,
+           "completed": None, "ionic_converged": None, "electronic_converged": None, "error": None}
+
+    def path(name):  # Plain or compressed
+        return find_file(os.path.join(folder, name))
+
+    def has(name):
+        filename = path(name)
+        return filename is not None and os.path.getsize(filename) > 0
+
+    vasprun = None
+    try:
+        if has("OSZICAR"):
+            scan = scan_oszicar(path("OSZICAR"))
+            if len(scan["energies"]):
+                row.update(energy=scan["energies"][-1], energy_source="OSZICAR", n_ionic=len(scan["energies"]))
+
+        if has("OUTCAR"):
+            outcar = path("OUTCAR")
+            scan = scan_outcar(outcar)
+            if row["energy_source"] is None and len(scan["energies"]):
+                row.update(energy=scan["energies"][-1], energy_source="OUTCAR", n_ionic=len(scan["energies"]))
+            if len(scan["forces"]):
+                row.update(max_force=np.linalg.norm(scan["forces"][-1], axis=1).max(), force_source="OUTCAR")
+            status = scan_status(outcar)
+            row.update(completed=status["completed"], ionic_converged=status["ionic_converged"],
+                       electronic_converged=status["electronic_converged"])
 
-    if read_contcar:
-        contcar = folder + "/CONTCAR"
-        structure = Structure.from_file(filename=contcar)
+        need_vasprun = (row["energy_source"] is None or row["force_source"] is None or row["completed"] is None
+                        or (read_contcar and not has("CONTCAR")) or (read_incar and not has("INCAR")))
+        if read_vasprun and need_vasprun and has("vasprun.xml"):
+            c_log.debug(f"{folder}: falling back to vasprun.xml")
+            vasprun, complete = _read_vasprun(folder)
+            if vasprun.ionic_steps:
+                last = vasprun.ionic_steps[-1]
+                if row["energy_source"] is None:
+                    row.update(energy=last["e_fr_energy"], energy_source="vasprun", n_ionic=len(vasprun.ionic_steps))
+                if row["force_source"] is None and "forces" in last:
+                    row.update(max_force=np.linalg.norm(last["forces"], axis=1).max(), force_source="vasprun")
+            if row["completed"] is None:
+                row.update(completed=complete,
+                           ionic_converged=vasprun.converged_ionic, electronic_converged=vasprun.converged_electronic)
+
+        if read_contcar:
+            structure = None
+            if has("CONTCAR"):
+                structure = Structure.from_file(filename=path("CONTCAR"))
+                row["structure_source"] = "CONTCAR"
+            elif vasprun is not None:
+                structure = vasprun.final_structure
+                row["structure_source"] = "vasprun"
+            if structure is not None:
+                row.update(formula=structure.composition.reduced_formula, n_sites=len(structure),
+                           structure=poscar_string(**structure_arrays(structure)))
 
-    if read_vasprun:
-        vasprun = folder + "/vasprun.xml"
-        vasprun = Vasprun(filename=vasprun)
         if read_incar:
-            incar = vasprun.incar
-    pass
+            if has("INCAR"):
+                row["incar"] = json.dumps(dict(Incar.from_file(path("INCAR"))), sort_keys=True)
+            elif vasprun is not None:
+                row["incar"] = json.dumps(dict(vasprun.incar), sort_keys=True)
+
+        if read_kpoints and has("KPOINTS"):
+            kpoints = Kpoints.from_file(path("KPOINTS"))
+            row["kpoints"] = f"{kpoints.style.name} {' '.join(str(x) for x in np.ravel(kpoints.kpts))}"
+    except Exception as e:  # One broken folder shouldn't take down a harvest of thousands
+        c_log.warning(f"{folder}: {type(e).__name__}: {e}")
+        row["error"] = f"{type(e).__name__}: {e}"
+
+    return row
+
+
+def folder_signature(folder: str) -> str:
+    """
+    Stat only fingerprint of a folder: name, mtime and size of every tracked file. No file is opened.
+    """
+    sig = []
+    for name in TRACKED_FILES:
+        try:
+            st = os.stat(os.path.join(folder, name))
+        except FileNotFoundError:
+            continue
+        sig.append(f"{name}:{st.st_mtime_ns}:{st.st_size}")
+    return "|".join(sig)
+
+
+def partial_hash(folder: str, nbytes: int = 65536) -> str:
+    """
+    Content fingerprint of a folder from the first and last nbytes of each tracked file, enough to tell
+    a touched / copied back folder from a rerun one without reading multi GB outputs.
+    """
+    h = hashlib.sha1()
+    for name in TRACKED_FILES:
+        filename = os.path.join(folder, name)
+        if not os.path.isfile(filename):
+            continue
+        size = os.path.getsize(filename)
+        h.update(f"{name}:{size}".encode())
+        with open(filename, "rb") as f:
+            h.update(f.read(nbytes))
+            if size > 2 * nbytes:
+                f.seek(-nbytes, os.SEEK_END)
+                h.update(f.read(nbytes))
+    return h.hexdigest()
+
+
+def parse_options(**kwargs) -> str:
+    """
+    The parse_vasp_folder options a row was made with, defaults filled in, as a json key for the index.
+    """
+    defaults = {name: p.default for name, p in inspect.signature(parse_vasp_folder).parameters.items()
+                if p.default is not inspect.Parameter.empty}
+    return json.dumps({**defaults, **kwargs}, sort_keys=True)
+
+
+class HarvestIndex:
+    """
+    Persistent SQLite index of harvested folders, keyed by path (relative to the tree root) with the stat signature
+    and partial content hash of each folder, so a rescan only parses folders that are new or have changed.
+    Each row also records the parse options (parse_options) it was made with, a row made with others is parsed
+    again. Lives next to the tree (root/.harvest_index.sqlite) by default.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.execute("CREATE TABLE IF NOT EXISTS folders ("
+                        "path TEXT PRIMARY KEY, signature TEXT, hash TEXT, row TEXT, updated REAL, options TEXT)")
+        columns = [name for _, name, *_ in self.db.execute("PRAGMA table_info(folders)")]
+        if "options" not in columns:  # Index from before options were stored, its rows never match and get reparsed
+            self.db.execute("ALTER TABLE folders ADD COLUMN options TEXT")
+        self.db.commit()
+
+    def lookup(self, paths) -> dict:
+        """
+        path -> (signature, hash, options, row dict) for every indexed path in paths.
+        """
+        found = {}
+        paths = list(paths)
+        for start in range(0, len(paths), 900):  # Stay under sqlite's bound parameter limit
+            chunk = paths[start:start + 900]
+            query = (f"SELECT path, signature, hash, options, row FROM folders "
+                     f"WHERE path IN ({','.join('?' * len(chunk))})")
+            for path, signature, digest, options, row in self.db.execute(query, chunk):
+                found[path] = (signature, digest, options, json.loads(row))
+        return found
+
+    def store(self, entries) -> None:
+        """
+        entries: iterable of (path, signature, hash, options, row dict), written in one transaction.
+        """
+        now = time.time()
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO folders (path, signature, hash, row, updated, options) "
+                                "VALUES (?, ?, ?, ?, ?, ?)",
+                                [(path, sig, digest, json.dumps(row), now, options)
+                                 for path, sig, digest, options, row in entries])
+
+    def invalidate(self, pattern: str = "*") -> int:
+        """
+        Drops every entry whose path matches the glob pattern so it is parsed again next run. Returns the count.
+        """
+        paths = [p for (p,) in self.db.execute("SELECT path FROM folders") if fnmatch.fnmatch(p, pattern)]
+        with self.db:
+            self.db.executemany("DELETE FROM folders WHERE path = ?", [(p,) for p in paths])
+        return len(paths)
+
+    def compact(self, existing) -> int:
+        """
+        Removes entries whose path is not in existing (the folders found on the last walk) and vacuums the file.
+        Returns the number of entries removed.
+        """
+        existing = set(existing)
+        stale = [p for (p,) in self.db.execute("SELECT path FROM folders") if p not in existing]
+        with self.db:
+            self.db.executemany("DELETE FROM folders WHERE path = ?", [(p,) for p in stale])
+        self.db.execute("VACUUM")
+        return len(stale)
+
+    def close(self) -> None:
+        self.db.close()
+
+
+def _parse_kwargs(args):
+    """
+    Picklable single argument wrapper for the process pool.
+    """
+    folder, kwargs = args
+    return parse_vasp_folder(folder, **kwargs)
+
+
+def _reparse_if_changed(args):
+    """
+    Pool job for a folder whose stat signature changed: hash it first and only parse if the content moved.
+    Returns (hash, row), row is None if the stored row is still good.
+    """
+    folder, old_hash, kwargs = args
+    digest = partial_hash(folder)
+    if digest == old_hash:
+        return digest, None
+    return digest, parse_vasp_folder(folder, **kwargs)
+
+
+def harvest(root: str, processes: int = None, chunksize: int = 16, index: HarvestIndex = None,
+            **kwargs) -> pd.DataFrame:
+    """
+    Parses every calculation folder under root on a process pool and returns one row per folder.
+    With an index only new or changed folders are parsed, the rest come straight out of the index, as long as
+    they were parsed with the same options. kwargs are passed through to parse_vasp_folder.
+    """
+    import pandas as pd
+
+    folders = find_calc_folders(root)
+    c_log.info(f"Found {len(folders)} calculation folders under {root}")
+    if not folders:
+        return pd.DataFrame()
+
+    if index is None:
+        jobs = [(folder, kwargs) for folder in folders]
+        if processes == 1:
+            rows = [_parse_kwargs(job) for job in jobs]
+        else:
+            with ProcessPoolExecutor(max_workers=processes) as pool:
+                rows = list(pool.map(_parse_kwargs, jobs, chunksize=chunksize))
+        return pd.DataFrame(rows)
+
+    keys = {folder: os.path.relpath(folder, root) for folder in folders}
+    signatures = {folder: folder_signature(folder) for folder in folders}
+    options = parse_options(**kwargs)
+    stored = index.lookup(keys.values())
+    known = {folder: stored[key] for folder, key in keys.items() if key in stored and stored[key][2] == options}
+    rows = {folder: dict(entry[3], path=folder) for folder, entry in known.items() if entry[0] == signatures[folder]}
+    todo = [folder for folder in folders if folder not in rows]
+    c_log.info(f"Index hits: {len(rows)}, folders to check: {len(todo)}")
+
+    jobs = [(folder, known[folder][1] if folder in known else None, kwargs) for folder in todo]
+    if processes == 1 or len(jobs) < 2:
+        results = [_reparse_if_changed(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            results = list(pool.map(_reparse_if_changed, jobs, chunksize=chunksize))
+
+    updates = []
+    for folder, (digest, row) in zip(todo, results):
+        if row is None:  # Touched but unchanged, keep the stored row and refresh the signature
+            row = dict(known[folder][3], path=folder)
+        rows[folder] = row
+        updates.append((keys[folder], signatures[folder], digest, options, row))
+    index.store(updates)
+    c_log.info(f"Parsed {sum(1 for _, (_, row) in zip(todo, results) if row is not None)} folders")
+
+    return pd.DataFrame([rows[folder] for folder in folders])
+
+
+def write_table(table: pd.DataFrame, filename: str) -> str:
+    """
+    Writes the harvest as a single columnar file picked from the extension (.parquet, .feather or .csv).
+    parquet / feather need pyarrow, if it is missing the table is written as csv next to the requested name.
+    Returns the filename written.
+    """
+    try:
+        if filename.endswith(".parquet"):
+            table.to_parquet(filename, index=False)
+            return filename
+        if filename.endswith(".feather"):
+            table.reset_index(drop=True).to_feather(filename)
+            return filename
+    except ImportError as e:
+        c_log.warning(f"{e}; writing csv instead")
+        filename = os.path.splitext(filename)[0] + ".csv"
+    table.to_csv(filename, index=False)
+    return filename
+
 
 def cli_run(argv) -> None:
     """
@@ -42,19 +358,57 @@ def cli_run(argv) -> None:
     global c_log
 
     parser = argparse.ArgumentParser(description=parse_vasp_folder.__doc__)  # Parser init
-    parser.add_argument("positional_argument", type=str, default="NONE", help="PositionalArgument")
-    parser.add_argument("--optional", dest="optional", type=int, default=4, help="OptionalArgument")
+    parser.add_argument("root", type=str, default=".", nargs="?", help="Top of the tree of calculation folders")
+    parser.add_argument("-o", "--output", dest="output", type=str, default="harvest.parquet",
+                        help="Output table, .parquet / .feather / .csv")
+    parser.add_argument("-n", "--nproc", dest="processes", type=int, default=None,
+                        help="Number of worker processes (default: all cores)")
+    parser.add_argument("--no-vasprun", dest="read_vasprun", action="store_false",
+                        help="Never fall back to parsing vasprun.xml")
+    parser.add_argument("--no-structure", dest="read_contcar", action="store_false",
+                        help="Skip the final structure")
+    parser.add_argument("--index", dest="index", type=str, default=None,
+                        help=f"Fingerprint index file (default: root/{INDEX_NAME})")
+    parser.add_argument("--no-index", dest="use_index", action="store_false",
+                        help="Parse everything and leave the index alone")
+    parser.add_argument("--invalidate", dest="invalidate", type=str, default=None, metavar="GLOB",
+                        help="Drop index entries matching GLOB (i.e '*' for all) before harvesting")
+    parser.add_argument("--compact", dest="compact", action="store_true",
+                        help="Drop index entries for folders that are gone and vacuum the index")
     parser.add_argument("--debug", dest="debug", action="store_true")  # Always have the debug optional
     parser.add_argument("--verbose", dest="verbose", action="store_true")  # Always have the verbose optional
 
+    profiling.add_profile_argument(parser)
     args = parser.parse_args(argv)
 
     if args.debug:  # Always include method for switching verbosity
         c_log.setLevel(logging.DEBUG)
     if args.verbose:
         c_log.setLevel(logging.INFO)
+    c_log.debug(args)
+    profiling.start(args.profile)
+
+    index = None
+    if args.use_index:
+        index = HarvestIndex(args.index if args.index else os.path.join(args.root, INDEX_NAME))
+        if args.invalidate is not None:
+            c_log.info(f"Invalidated {index.invalidate(args.invalidate)} index entries")
+
+    try:
+        with profiling.phase("harvest"):
+            table = harvest(args.root, processes=args.processes, index=index,
+                            read_vasprun=args.read_vasprun, read_contcar=args.read_contcar)
+        if index is not None and args.compact:
+            existing = [os.path.relpath(folder, args.root) for folder in (table["path"] if len(table) else [])]
+            c_log.info(f"Compacted {index.compact(existing=existing)} stale entries")
+    finally:
+        if index is not None:
+            index.close()
 
-    print(called_function(var_1=1, var_2=2, var_3=3))  # Writing to the CLI happens in cli run to separate pmg from cli
+    with profiling.phase("write"):
+        filename = write_table(table, args.output)
+    print(f"{len(table)} folders -> {filename}")  # Writing to the CLI happens in cli run to separate pmg from cli
+    profiling.report()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import sys, argparse, logging, os, json, glob
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from pymatgen.core import Structure, Molecule
+from pymatgen.core.surface import Slab
+from pymatgen.analysis.adsorption import AdsorbateSiteFinder, get_mi_vec
+
+from freeze_slab_center import frz_central_slab
+from poscar_writer import write_structure
+import profiling
+
+# Adopted format: level - current function name - mess. Width is fixed as visual aid
+c_log = logging.getLogger(__name__)
+std_format = '[%(levelname)5s - %(funcName)10s] %(message)s'
+logging.basicConfig(format=std_format)
+c_log.setLevel(logging.WARNING)
+
+
+def find_slab_files(paths) -> list:
+    """
+    Slab files to work on: files as given, folders (i.e make_surface's slabs/) give their slab_*.json,
+    or every *.vasp if there are no json files
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            found = sorted(glob.glob(os.path.join(path, "slab_*.json")), key=lambda f: (len(f), f))
+            files.extend(found if found else sorted(glob.glob(os.path.join(path, "*.vasp"))))
+        else:
+            files.append(path)
+    return files
+
+
+def read_slab(filename: str) -> Structure:
+    """
+    Slab as a plain Structure, a Slab from make_surface's json loses its slab attributes here so nothing
+    downstream falls back to the Voronoi based get_surface_sites
+    """
+    if filename.endswith(".json"):
+        with open(filename) as f:
+            slab = Slab.from_dict(json.load(f))
+        return Structure.from_sites(slab, to_unit_cell=True)
+    return Structure.from_file(filename)
+
+
+def surface_height(structure: Structure, layer_tol: float = 0.25, default: float = 0.9) -> float:
+    """
+    Layer based surface detection: heights along the surface normal are sorted and split into layers wherever
+    the gap is bigger than layer_tol. Returns the window below the topmost site that holds exactly the top layer,
+    which is what AdsorbateSiteFinder's height criterion needs. Stepped surfaces without distinct layers get
+    AdsorbateSiteFinder's own default window instead.
+    """
+    heights = np.sort(structure.cart_coords @ get_mi_vec(structure))
+    breaks = np.flatnonzero(np.diff(heights) > layer_tol)
+    if not len(breaks):
+        c_log.info(f"No layers separated by more than {layer_tol} A, using a {default} A window")
+        return default
+    top_min, below_max = heights[breaks[-1] + 1], heights[breaks[-1]]
+    return heights[-1] - (top_min + below_max) / 2
+
+
+def read_adsorbate(adsorbate: str) -> Molecule:
+    """
+    Element symbol for a single atom, otherwise a molecule file (xyz, ...)
+    """
+    if os.path.isfile(adsorbate):
+        return Molecule.from_file(adsorbate)
+    return Molecule([adsorbate], [[0, 0, 0]])
+
+
+def place_adsorbate(slab: Structure, molecule: Molecule, positions=("ontop", "bridge", "hollow"),
+                    distance: float = 2.0, repeat=None, min_lw: float = 5.0, frz_prop: float = None,
+                    layer_tol: float = 0.25, symm_reduce: float = 1e-2) -> list:
+    """
+    Adsorbate + slab structures for every symmetry unique site of the chosen types on the top surface.
+    Surface sites come from the layer based height window rather than a Voronoi analysis, sites equivalent under
+    the slab's symmetry are removed by AdsorbateSiteFinder. With frz_prop the centre of the slab is frozen
+    (as freeze_slab_center does) before the adsorbate, which is always free, is added.
+    Returns (position, site number, structure) tuples.
+    """
+    slab = slab.copy()
+    if frz_prop is not None:
+        slab = frz_central_slab(slab, frz_prop)
+    asf = AdsorbateSiteFinder(slab, height=surface_height(slab, layer_tol=layer_tol))
+    c_log.debug(f"{len(asf.surface_sites)} surface sites")
+    sites = asf.find_adsorption_sites(distance=distance, positions=positions, symm_reduce=symm_reduce)
+
+    if repeat is None:  # Same rule as generate_adsorption_structures, keeps adsorbates min_lw apart
+        repeat = [int(np.ceil(min_lw / np.linalg.norm(slab.lattice.matrix[i]))) for i in (0, 1)] + [1]
+    structures = []
+    for position in positions:
+        for n, coords in enumerate(sites[position]):
+            structures.append((position, n, asf.add_adsorbate(molecule, coords, repeat=repeat)))
+    return structures
+
+
+def _place_one(job: dict) -> list:
+    """
+    Worker: every adsorbate structure for one slab file, written straight to disk. Returns the table rows.
+    """
+    filename, output = job["filename"], job["output"]
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    try:
+        slab = read_slab(filename)
+        structures = place_adsorbate(slab, job["molecule"], positions=job["positions"], distance=job["distance"],
+                                     repeat=job["repeat"], min_lw=job["min_lw"], frz_prop=job["frz_prop"],
+                                     layer_tol=job["layer_tol"])
+    except Exception as e:  # One bad slab shouldn't stop the batch
+        c_log.warning(f"{filename}: {type(e).__name__}: {e}")
+        return [[stem, "failed", "", "", ""]]
+
+    rows = []
+    for position, n, structure in structures:
+        name = f"{stem}_{position}_{n}.vasp"
+        structure.remove_site_property("surface_properties")
+        write_structure(structure, selective_dynamics=structure.site_properties.get("selective_dynamics"),
+                        comment=f"{structure.formula} {position} {n} from {stem}",
+                        filename=os.path.join(output, name), end="\n")
+        rows.append([name, position, len(structure), round(structure.lattice.abc[0], 3),
+                     round(structure.lattice.abc[1], 3)])
+    return rows
+
+
+def cli_run(argv) -> None:
+    """
+    Wrapper for the above command, handles parsing of args and logging, to avoid mess
+    """
+
+    global c_log
+
+    parser = argparse.ArgumentParser(description=place_adsorbate.__doc__)  # Parser init
+    parser.add_argument("slabs", type=str, nargs="*", default=["slabs"],
+                        help="Slab files (json or POSCAR) or folders of them, default is make_surface's slabs/")
+    parser.add_argument("-a", "--adsorbate", dest="adsorbate", type=str, required=True,
+                        help="Element symbol or molecule file (xyz ...)")
+    parser.add_argument("-s", "--sites", dest="positions", type=str, nargs="+", default=["ontop", "bridge", "hollow"],
+                        choices=["ontop", "bridge", "hollow", "subsurface"], help="Site types to place on")
+    parser.add_argument("-d", "--distance", dest="distance", type=float, default=2.0,
+                        help="Height of the adsorbate above its site in Angstrom")
+    parser.add_argument("-r", "--repeat", dest="repeat", type=int, nargs=2, default=None,
+                        help="In plane supercell of each slab, default repeats up to --min-lw")
+    parser.add_argument("--min-lw", dest="min_lw", type=float, default=5.0,
+                        help="Minimum in plane length / width in Angstrom when --repeat isn't given")
+    parser.add_argument("-f", "--frz-prop", dest="frz_prop", type=float, default=0.35,
+                        help="Fraction of the slab (centre outward) frozen with selective dynamics")
+    parser.add_argument("--no-sd", dest="frz_prop", action="store_const", const=None,
+                        help="Don't add selective dynamics")
+    parser.add_argument("--layer-tol", dest="layer_tol", type=float, default=0.25,
+                        help="Height difference in Angstrom that separates two layers")
+    parser.add_argument("-o", "--output", dest="output", type=str, default="adsorbates", help="Output folder")
+    parser.add_argument("-n", "--processes", dest="processes", type=int, default=None,
+                        help="Worker processes, default is one per CPU")
+    parser.add_argument("--debug", dest="debug", action="store_true")  # Always have the debug optional
+    parser.add_argument("--verbose", dest="verbose", action="store_true")  # Always have the verbose optional
+
+    profiling.add_profile_argument(parser)
+    args = parser.parse_args(argv)
+
+    if args.debug:  # Always include method for switching verbosity
+        c_log.setLevel(logging.DEBUG)
+    if args.verbose:
+        c_log.setLevel(logging.INFO)
+    c_log.debug(args)
+    profiling.start(args.profile)
+
+    files = find_slab_files(args.slabs)
+    if not files:
+        parser.error(f"No slab files found in {' '.join(args.slabs)}")
+    os.makedirs(args.output, exist_ok=True)
+    molecule = read_adsorbate(args.adsorbate)
+    repeat = None if args.repeat is None else args.repeat + [1]
+    jobs = [{"filename": f, "output": args.output, "molecule": molecule, "positions": args.positions,
+             "distance": args.distance, "repeat": repeat, "min_lw": args.min_lw, "frz_prop": args.frz_prop,
+             "layer_tol": args.layer_tol} for f in files]
+    c_log.info(f"{len(files)} slabs, placing {molecule.formula} on {' '.join(args.positions)} sites")
+
+    with profiling.phase("place+write"):
+        if args.processes == 1 or len(jobs) == 1:
+            results = [_place_one(job) for job in jobs]
+        else:
+            with ProcessPoolExecutor(max_workers=args.processes) as pool:
+                results = list(pool.map(_place_one, jobs))
+
+    rows = [["NAME", "SITE", "SIZE", "A", "B"]] + [row for result in results for row in result]
+    with open(os.path.join(args.output, "place_adsorbate.dat"), "w") as f:
+        f.write("\n".join(" ".join(str(x) for x in row) for row in rows) + "\n")
+    failed = sum(row[1] == "failed" for row in rows[1:])
+    print(f"{len(rows) - 1 - failed} structures from {len(files) - failed} slabs written to {args.output}"
+          + (f", {failed} slabs failed (see place_adsorbate.dat)" if failed else ""))
+    profiling.report()
+
+
+if __name__ == "__main__":
+    cli_run(sys.argv[1:])
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import sys, argparse, logging, os
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from volumetric import VolumetricFile, DEFAULT_CHUNK
+from compressed import iterparse, find_file, variants, strip_extension
+from vasp_scan import scan_efermi
+import profiling
+
+# Adopted format: level - current function name - mess. Width is fixed as visual aid
+c_log = logging.getLogger(__name__)
+std_format = '[%(levelname)5s - %(funcName)10s] %(message)s'
+logging.basicConfig(format=std_format)
+c_log.setLevel(logging.WARNING)
+
+
+def planar_average(vol: VolumetricFile, axis: int = 2, chunk: int = DEFAULT_CHUNK) -> np.ndarray:
+    """
+    Average of the current block over the planes normal to axis, reduced chunk by chunk as the grid streams in.
+    Each grid value's plane index comes from its position in VASP's x fastest order, so the 3D array never exists.
+    """
+    strides = (1, vol.grid[0], vol.grid[0] * vol.grid[1])
+    n_planes = vol.grid[axis]
+    total = np.zeros(n_planes)
+    start = 0
+    for values in vol.values(chunk):
+        planes = np.arange(start, start + len(values)) // strides[axis] % n_planes
+        total += np.bincount(planes, weights=values, minlength=n_planes)
+        start += len(values)
+    return total / (vol.n_points // n_planes)
+
+
+def plane_spacing(lattice: np.ndarray, axis: int = 2) -> float:
+    """
+    Length of the cell along the normal to the plane of the other two lattice vectors
+    """
+    a, b = (lattice[i] for i in range(3) if i != axis)
+    return abs(np.linalg.det(lattice)) / np.linalg.norm(np.cross(a, b))
+
+
+def macroscopic_average(profile: np.ndarray, length: float, widths) -> np.ndarray:
+    """
+    Planar average convolved with a box of each width (Angstrom) in turn. The convolution is periodic and done
+    in reciprocal space, a box of width w is sinc(q w / 2) there. Two widths are for interfaces of two materials.
+    """
+    factor = np.ones(len(profile) // 2 + 1)
+    m = np.arange(len(factor))
+    for width in widths:
+        factor *= np.sinc(m * width / length)
+    return np.fft.irfft(np.fft.rfft(profile) * factor, n=len(profile))
+
+
+def atom_heights(frac_coords: np.ndarray, length: float, axis: int = 2) -> np.ndarray:
+    """
+    Sorted positions of the atoms along the normal, wrapped into the cell
+    """
+    return np.sort(frac_coords[:, axis] % 1.0) * length
+
+
+def vacuum_gap(heights: np.ndarray, length: float) -> tuple:
+    """
+    Centre and width of the largest gap between atoms along the normal, across the periodic boundary too
+    """
+    gaps = np.diff(np.append(heights, heights[0] + length))
+    i = int(np.argmax(gaps))
+    return (heights[i] + gaps[i] / 2) % length, gaps[i]
+
+
+def layer_spacing(heights: np.ndarray, length: float, layer_tol: float = 0.25) -> float:
+    """
+    Median distance between neighbouring atomic layers of the slab (the vacuum gap left out), the natural
+    macroscopic averaging width. 0 when there are fewer than two layers.
+    """
+    centre, _ = vacuum_gap(heights, length)
+    unrolled = np.sort((heights - centre) % length)  # Slab now runs unbroken from the start of the cell
+    breaks = np.flatnonzero(np.diff(unrolled) > layer_tol)
+    if not len(breaks):
+        return 0.0
+    layers = [layer.mean() for layer in np.split(unrolled, breaks + 1)]
+    return float(np.median(np.diff(layers)))
+
+
+def vacuum_level(distance: np.ndarray, profile: np.ndarray, heights: np.ndarray, length: float,
+                 fraction: float = 0.5) -> tuple:
+    """
+    Mean of the planar average over the central fraction of the vacuum gap, with its spread (max - min) there.
+    A spread above a few meV means the vacuum is too thin or a dipole correction is missing.
+    """
+    centre, gap = vacuum_gap(heights, length)
+    offset = (distance - centre + length / 2) % length - length / 2
+    window = np.abs(offset) <= fraction * gap / 2
+    if not window.any():
+        window[np.argmin(np.abs(offset))] = True
+    return float(profile[window].mean()), float(np.ptp(profile[window]))
+
+
+def read_efermi(folder: str):
+    """
+    Fermi energy of the calculation in folder, from the OUTCAR or else the vasprun.xml. None if neither has it.
+    """
+    outcar, vasprun = find_file(os.path.join(folder, "OUTCAR")), find_file(os.path.join(folder, "vasprun.xml"))
+    if outcar is not None:
+        efermi = scan_efermi(outcar)
+        if efermi is not None:
+            return efermi
+    efermi = None
+    if vasprun is not None:
+        try:
+            for _, elem in iterparse(vasprun, events=("end",)):
+                if elem.tag == "i" and elem.get("name") == "efermi":
+                    efermi = float(elem.text)
+                elif elem.tag in ("calculation", "projected", "eigenvalues"):
+                    elem.clear()
+        except ET.ParseError:  # Running job, keep whatever was read
+            pass
+    return efermi
+
+
+def slab_profile(filename: str, axis: int = 2, widths=None, density: bool = None, fraction: float = 0.5,
+                 layer_tol: float = 0.25, efermi: float = None, chunk: int = DEFAULT_CHUNK,
+                 threads: int = None) -> dict:
+    """
+    Planar and macroscopic averaged profile of a LOCPOT (eV) or CHGCAR (e/A^3) along a lattice axis, normally the
+    slab normal, with the vacuum level and, for potentials with a Fermi energy, the work function.
+    widths default to the slab's layer spacing, density defaults to whether the file name has CHG in it.
+    The Fermi energy is read from the OUTCAR / vasprun.xml next to the file unless given.
+    """
+    density = "CHG" in os.path.basename(filename) if density is None else density
+    with VolumetricFile(filename, threads=threads) as vol:
+        profile = planar_average(vol, axis=axis, chunk=chunk)
+        lattice, frac_coords = vol.lattice, vol.frac_coords
+    if density:  # CHGCAR holds rho * V
+        profile = profile / abs(np.linalg.det(lattice))
+
+    length = plane_spacing(lattice, axis)
+    distance = np.arange(len(profile)) * length / len(profile)
+    heights = atom_heights(frac_coords, length, axis)
+    if widths is None:
+        spacing = layer_spacing(heights, length, layer_tol)
+        widths = [spacing] if spacing > 0 else []
+    macro = macroscopic_average(profile, length, widths) if widths else profile.copy()
+    vacuum, spread = vacuum_level(distance, profile, heights, length, fraction)
+
+    if efermi is None and not density:
+        efermi = read_efermi(os.path.dirname(os.path.abspath(filename)))
+    result = {"distance": distance, "planar": profile, "macro": macro, "widths": list(widths),
+              "vacuum": vacuum, "spread": spread, "efermi": efermi,
+              "work_function": vacuum - efermi if efermi is not None and not density else None}
+    c_log.debug(f"{filename}: vacuum {vacuum:.4f} (spread {spread:.4f}), efermi {efermi}, widths {widths}")
+    return result
+
+
+def write_profile(result: dict, filename: str) -> None:
+    header = f"# distance planar macro  widths = {' '.join(f'{w:.4f}' for w in result['widths'])}  " \
+             f"vacuum = {result['vacuum']:.6f}  efermi = {result['efermi']}\n"
+    data = np.column_stack((result["distance"], result["planar"], result["macro"]))
+    with open(filename, "w") as f:
+        f.write(header + ("%12.6f %16.8E %16.8E\n" * len(data)) % tuple(data.ravel().tolist()))
+
+
+def find_volumetric_files(paths, name: str = "LOCPOT") -> list:
+    """
+    Files as given, folders are searched recursively for name (or its compressed versions)
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                present = [x for x in variants(name) if x in filenames]
+                if present:
+                    files.append(os.path.join(dirpath, present[0]))
+        else:
+            files.append(path)
+    return sorted(files)
+
+
+def _profile_one(job: dict) -> list:
+    """
+    Worker: profile of one file written next to it, returns its summary row
+    """
+    filename = job.pop("filename")
+    try:
+        result = slab_profile(filename, **job)
+    except Exception as e:  # One bad file shouldn't stop the batch
+        c_log.warning(f"{filename}: {type(e).__name__}: {e}")
+        return [filename, "failed", "", "", "", ""]
+    write_profile(result, strip_extension(filename) + "_profile.dat")
+    fmt = lambda x: "N/A" if x is None else f"{x:.4f}"
+    return [filename, fmt(result["vacuum"]), fmt(result["spread"]), fmt(result["efermi"]),
+            fmt(result["work_function"]), " ".join(f"{w:.3f}" for w in result["widths"]) or "none"]
+
+
+def cli_run(argv) -> None:
+    """
+    Wrapper for the above command, handles parsing of args and logging, to avoid mess
+    """
+
+    global c_log
+
+    parser = argparse.ArgumentParser(description=slab_profile.__doc__)  # Parser init
+    parser.add_argument("inputs", type=str, nargs="*", default=["LOCPOT"],
+                        help="LOCPOT / CHGCAR files, or folders searched for --name")
+    parser.add_argument("--name", dest="name", type=str, default="LOCPOT", help="File name looked for in folders")
+    parser.add_argument("-a", "--axis", dest="axis", type=int, default=2, choices=[0, 1, 2],
+                        help="Lattice vector the profile runs along, the slab normal")
+    parser.add_argument("-w", "--widths", dest="widths", type=float, nargs="*", default=None,
+                        help="Macroscopic averaging widths in Angstrom, default is the layer spacing, bare -w to skip")
+    parser.add_argument("--density", dest="density", action="store_true", default=None,
+                        help="Treat inputs as charge densities, default is by file name")
+    parser.add_argument("--potential", dest="density", action="store_false", help="Treat inputs as potentials")
+    parser.add_argument("-e", "--efermi", dest="efermi", type=float, default=None,
+                        help="Fermi energy, default is read from the OUTCAR / vasprun.xml next to each file")
+    parser.add_argument("-f", "--vacuum-fraction", dest="fraction", type=float, default=0.5,
+                        help="Central fraction of the vacuum gap averaged for the vacuum level")
+    parser.add_argument("--layer-tol", dest="layer_tol", type=float, default=0.25,
+                        help="Height difference in Angstrom that separates two layers")
+    parser.add_argument("-c", "--chunk", dest="chunk", type=int, default=DEFAULT_CHUNK, help="Grid values per chunk")
+    parser.add_argument("-n", "--processes", dest="processes", type=int, default=None,
+                        help="Worker processes, default is one per CPU")
+    parser.add_argument("-j", "--threads", dest="threads", type=int, default=None,
+                        help="Threads converting grid text per file, default is one per CPU for a single process")
+    parser.add_argument("--debug", dest="debug", action="store_true")  # Always have the debug optional
+    parser.add_argument("--verbose", dest="verbose", action="store_true")  # Always have the verbose optional
+
+    profiling.add_profile_argument(parser)
+    args = parser.parse_args(argv)
+
+    if args.debug:  # Always include method for switching verbosity
+        c_log.setLevel(logging.DEBUG)
+    if args.verbose:
+        c_log.setLevel(logging.INFO)
+    c_log.debug(args)
+    profiling.start(args.profile)
+
+    files = find_volumetric_files(args.inputs, args.name)
+    if not files:
+        parser.error(f"No {args.name} found in {' '.join(args.inputs)}")
+    pooled = args.processes != 1 and len(files) > 1
+    threads = 1 if pooled and args.threads is None else args.threads  # Processes already fill the CPUs
+    jobs = [{"filename": f, "axis": args.axis, "widths": args.widths, "density": args.density,
+             "fraction": args.fraction, "layer_tol": args.layer_tol, "efermi": args.efermi, "chunk": args.chunk,
+             "threads": threads} for f in files]
+
+    with profiling.phase("profiles"):
+        if not pooled:
+            rows = [_profile_one(job) for job in jobs]
+        else:
+            with ProcessPoolExecutor(max_workers=args.processes) as pool:
+                rows = list(pool.map(_profile_one, jobs))
+
+    rows = [["FILE", "VACUUM", "SPREAD", "EFERMI", "WORK_FUNCTION", "WIDTHS"]] + rows
+    width = max(len(row[0]) for row in rows)
+    for row in rows:
+        print(f"{row[0]:{width}s} " + " ".join(f"{x:>13s}" for x in row[1:5]) + f"  {row[5]}")
+    profiling.report()
+
+
+if __name__ == "__main__":
+    cli_run(sys.argv[1:])
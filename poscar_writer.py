@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import sys, io, logging
+from typing import Optional, TextIO
+
+import numpy as np
+
+# Adopted format: level - current function name - mess. Width is fixed as visual aid
+c_log = logging.getLogger(__name__)
+std_format = '[%(levelname)5s - %(funcName)10s] %(message)s'
+logging.basicConfig(format=std_format)
+c_log.setLevel(logging.WARNING)
+
+
+def poscar_string(lattice: np.ndarray, frac_coords: np.ndarray, labels, symbols, comment: str,
+                  selective_dynamics=None, significant_figures: int = 16, chunk_size: int = 65536) -> str:
+    """
+    Shared POSCAR writer for all the structure tools. Formats the coordinate block in bulk rather than
+    a python format call per site, output is byte identical to pymatgen's Poscar.get_str().
+
+    lattice: 3x3 matrix, frac_coords: Nx3 array
+    labels: per site species strings written at the end of each line (i.e Li+)
+    symbols: per site element symbols, consecutive runs give the species/count lines
+    selective_dynamics: Nx3 bools or None
+    """
+    frac_coords = np.asarray(frac_coords, dtype=float).reshape((-1, 3))
+    lattice = np.asarray(lattice, dtype=float)
+    if np.linalg.det(lattice) < 0:  # VASP crashes on left handed lattices, pymatgen flips them
+        lattice = -lattice
+
+    fmt = f"%{significant_figures + 5}.{significant_figures}f"
+    symbols = np.asarray(symbols)
+    starts = np.concatenate(([0], np.flatnonzero(symbols[1:] != symbols[:-1]) + 1))
+    counts = np.diff(np.concatenate((starts, [len(symbols)])))
+
+    buffer = io.StringIO()
+    buffer.write(f"{comment}\n1.0\n")
+    buffer.write("".join(f"{fmt} {fmt} {fmt}\n" % tuple(vec) for vec in lattice))
+    buffer.write(" ".join(symbols[starts]) + "\n")
+    buffer.write(" ".join(str(n) for n in counts) + "\n")
+    if selective_dynamics is not None:
+        buffer.write("Selective dynamics\n")
+    buffer.write("direct\n")
+
+    # Build one object block per chunk (floats, T/F flags, labels) and let a single % do the formatting
+    n_cols = 4 if selective_dynamics is None else 7
+    row_fmt = f"{fmt} {fmt} {fmt}" + (" %s %s %s" if selective_dynamics is not None else "") + " %s\n"
+    labels = np.asarray(labels, dtype=object)
+    if selective_dynamics is not None:
+        sd_flags = np.where(np.asarray(selective_dynamics, dtype=bool), "T", "F")
+    for start in range(0, len(frac_coords), chunk_size):
+        stop = min(start + chunk_size, len(frac_coords))
+        block = np.empty((stop - start, n_cols), dtype=object)
+        block[:, :3] = frac_coords[start:stop]
+        if selective_dynamics is not None:
+            block[:, 3:6] = sd_flags[start:stop]
+        block[:, -1] = labels[start:stop]
+        buffer.write((row_fmt * len(block)) % tuple(block.ravel().tolist()))
+
+    return buffer.getvalue()
+
+
+def structure_arrays(structure, selective_dynamics=None) -> dict:
+    """
+    Pulls the arrays poscar_string needs out of a pymatgen structure, following the same
+    selective dynamics / comment defaults as pymatgen's Poscar.
+    """
+    if selective_dynamics is not None and np.asarray(selective_dynamics).all():
+        selective_dynamics = None  # pymatgen drops an all True S.D block
+    if selective_dynamics is None:
+        selective_dynamics = structure.site_properties.get("selective_dynamics")
+
+    return {"lattice": structure.lattice.matrix,
+            "frac_coords": structure.frac_coords,
+            "labels": [site.species_string for site in structure],
+            "symbols": [site.specie.symbol for site in structure],
+            "comment": structure.formula,
+            "selective_dynamics": selective_dynamics}
+
+
+def write_poscar(poscar_str: str, filename: Optional[str] = None, stream: Optional[TextIO] = None,
+                 end: str = "") -> None:
+    """
+    Writes an already built POSCAR string in a single write, to filename if given otherwise to stream (stdout).
+    end mimics print so CLI output stays the same as print(Poscar(...)).
+    """
+    if filename is not None:
+        with open(filename, "w") as f:
+            f.write(poscar_str + end)
+        return
+    if stream is None:
+        stream = sys.stdout
+    stream.write(poscar_str + end)
+    stream.flush()
+
+
+def write_structure(structure, selective_dynamics=None, comment: Optional[str] = None,
+                    filename: Optional[str] = None, stream: Optional[TextIO] = None, end: str = "") -> None:
+    """
+    Drop in for print(Poscar(structure, selective_dynamics=..., comment=...)), via the vectorised writer.
+    """
+    arrays = structure_arrays(structure, selective_dynamics=selective_dynamics)
+    if comment is not None:
+        arrays["comment"] = comment
+    c_log.debug(f"Writing {len(structure)} sites, selective dynamics: {arrays['selective_dynamics'] is not None}")
+    write_poscar(poscar_string(**arrays), filename=filename, stream=stream, end=end)
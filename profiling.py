@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import sys, argparse, logging, os, json, time, functools
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows, peak RSS is reported as 0
+    resource = None
+
+# Adopted format: level - current function name - mess. Width is fixed as visual aid
+c_log = logging.getLogger(__name__)
+std_format = '[%(levelname)5s - %(funcName)10s] %(message)s'
+logging.basicConfig(format=std_format)
+c_log.setLevel(logging.WARNING)
+
+
+def peak_rss_mb() -> float:
+    """
+    Peak resident set size of this process so far in MB (ru_maxrss is KB on Linux, bytes on macOS)
+    """
+    if resource is None:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+def _cpu_time() -> float:
+    """
+    User + system time of this process and of any waited for children (process pools)
+    """
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+class Phase:
+    """
+    One timed phase: wall and CPU seconds, peak RSS at the end and how much it grew during the phase.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.wall = self.cpu = 0.0
+        self.peak_rss = self.rss_growth = 0.0
+        self._start_wall = time.perf_counter()
+        self._start_cpu = _cpu_time()
+        self._start_rss = peak_rss_mb()
+
+    def elapsed(self) -> float:
+        """
+        Wall time so far, usable inside the with block for progress logging
+        """
+        return time.perf_counter() - self._start_wall
+
+    def stop(self) -> None:
+        self.wall = self.elapsed()
+        self.cpu = _cpu_time() - self._start_cpu
+        self.peak_rss = peak_rss_mb()
+        self.rss_growth = max(self.peak_rss - self._start_rss, 0.0)
+
+    def as_dict(self) -> dict:
+        return {"name": self.name, "wall": self.wall, "cpu": self.cpu,
+                "peak_rss_mb": self.peak_rss, "rss_growth_mb": self.rss_growth}
+
+
+class Profiler:
+    """
+    Records named phases (parse, analyse, write ...). Phases are always timed, so tools can log their own
+    durations, but only kept and reported when a cli_run is given --profile.
+    """
+
+    def __init__(self):
+        self.phases = []
+        self.mode = None  # None (off), "summary", "json" or an absolute filename for the JSON
+
+    @contextmanager
+    def phase(self, name: str):
+        record = Phase(name)
+        try:
+            yield record
+        finally:
+            record.stop()
+            if self.mode is not None:  # Library calls outside a --profile run don't pile up records
+                self.phases.append(record)
+            c_log.debug(f"{name}: {record.wall:.3f} s wall, {record.cpu:.3f} s cpu, {record.peak_rss:.1f} MB peak")
+
+    def timed(self, name: str = None):
+        """
+        Decorator version of phase, the phase name defaults to the function name
+        """
+        def decorate(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.phase(name or func.__name__):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def totals(self) -> list:
+        """
+        Phases of the same name merged: count, summed wall / cpu and the largest peak RSS, in first seen order
+        """
+        merged = {}
+        for p in self.phases:
+            entry = merged.setdefault(p.name, {"name": p.name, "count": 0, "wall": 0.0, "cpu": 0.0,
+                                               "peak_rss_mb": 0.0, "rss_growth_mb": 0.0})
+            entry["count"] += 1
+            entry["wall"] += p.wall
+            entry["cpu"] += p.cpu
+            entry["peak_rss_mb"] = max(entry["peak_rss_mb"], p.peak_rss)
+            entry["rss_growth_mb"] += p.rss_growth
+        return list(merged.values())
+
+    def summary(self) -> str:
+        lines = [f"{'phase':20s} {'calls':>6s} {'wall s':>10s} {'cpu s':>10s} {'peak MB':>10s} {'+MB':>8s}"]
+        for p in self.totals():
+            lines.append(f"{p['name']:20s} {p['count']:6d} {p['wall']:10.3f} {p['cpu']:10.3f} "
+                         f"{p['peak_rss_mb']:10.1f} {p['rss_growth_mb']:8.1f}")
+        return "\n".join(lines)
+
+    def report(self, stream=None) -> None:
+        """
+        Prints the summary table (to stderr so tool output stays clean) or writes JSON, depending on mode.
+        """
+        if self.mode is None:
+            return
+        stream = sys.stderr if stream is None else stream
+        if self.mode == "summary":
+            stream.write(self.summary() + "\n")
+            return
+        data = json.dumps({"phases": [p.as_dict() for p in self.phases], "totals": self.totals(),
+                           "peak_rss_mb": peak_rss_mb()}, indent=2)
+        if self.mode == "json":
+            stream.write(data + "\n")
+        else:
+            with open(self.mode, "w") as f:
+                f.write(data + "\n")
+
+    def reset(self) -> None:
+        self.phases = []
+        self.mode = None
+
+
+PROFILER = Profiler()
+phase = PROFILER.phase
+timed = PROFILER.timed
+
+
+def add_profile_argument(parser) -> None:
+    """
+    The profiling flags every cli_run shares, all setting args.profile: --profile prints a summary, --profile-json
+    prints JSON and --profile-out FILE writes the JSON to FILE. None of them take an optional value, so they can't
+    swallow a positional argument that follows.
+    """
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--profile", dest="profile", action="store_const", const="summary", default=None,
+                       help="Report wall / cpu time and peak RSS per phase on stderr")
+    group.add_argument("--profile-json", dest="profile", action="store_const", const="json",
+                       help="Same as --profile as JSON")
+    group.add_argument("--profile-out", dest="profile", type=os.path.abspath, metavar="FILE",
+                       help="Write the --profile JSON to FILE")
+
+
+def start(mode) -> None:
+    """
+    Turns reporting on for this run (mode from --profile) and clears anything recorded earlier in the process.
+    """
+    PROFILER.reset()
+    PROFILER.mode = mode
+
+
+def report() -> None:
+    PROFILER.report()
@@ -3,7 +3,9 @@
 
 import sys, argparse, logging
 from pymatgen.core import Structure
-from pymatgen.io.vasp import Poscar
+
+from poscar_writer import write_structure
+import profiling
 
 # Adopted format: level - current function name - mess. Width is fixed as visual aid
 c_log = logging.getLogger(__name__)
@@ -38,6 +40,7 @@ def cli_run(argv) -> None:
 
     parser.add_argument("--verbose", dest="verbose", action="store_true", help="verbose printing")
     parser.add_argument("--debug", dest="debug", action="store_true")  # Always have the debug optional
+    profiling.add_profile_argument(parser)
     args = parser.parse_args(argv)
 
     if args.debug:  # Always include method for switching verbosity
@@ -46,8 +49,15 @@ def cli_run(argv) -> None:
         c_log.setLevel(logging.INFO)
 
     c_log.debug(args)
-    structure = Structure.from_file(filename=args.poscar)
-    print(Poscar(scale_to_volume(structure=structure, volume=args.volume)))
+    profiling.start(args.profile)
+
+    with profiling.phase("parse"):
+        structure = Structure.from_file(filename=args.poscar)
+    with profiling.phase("analyse"):
+        structure = scale_to_volume(structure=structure, volume=args.volume)
+    with profiling.phase("write"):
+        write_structure(structure, end="\n")
+    profiling.report()
 
 
 if __name__ == "__main__":
@@ -4,7 +4,9 @@ import sys
 import argparse, logging
 
 from pymatgen.core import Structure, Lattice
-from pymatgen.io.vasp import Poscar
+
+from poscar_writer import write_structure
+import profiling
 
 # Init global logger for this scope.
 c_log = logging.getLogger(__name__)
@@ -86,6 +88,7 @@ def cli_run(argv) -> None:
                         help="Loud printouts")
     parser.add_argument("--debug", action="store_true", dest="debug",
                         help="show debugging information, mostly if the code goes grossly wrong")
+    profiling.add_profile_argument(parser)
     args = parser.parse_args(argv)
 
     if args.verbose:
@@ -94,10 +97,15 @@ def cli_run(argv) -> None:
         c_log.setLevel(level=logging.DEBUG)
 
     c_log.debug(args)
-
-    structure = Structure.from_file(filename=args.filename)
-    ns = stretch_cell(structure, dimension=args.dimension, scale_amount=args.scale_amount, fix_bonds=args.fix)
-    print(Poscar(ns))
+    profiling.start(args.profile)
+
+    with profiling.phase("parse"):
+        structure = Structure.from_file(filename=args.filename)
+    with profiling.phase("analyse"):
+        ns = stretch_cell(structure, dimension=args.dimension, scale_amount=args.scale_amount, fix_bonds=args.fix)
+    with profiling.phase("write"):
+        write_structure(ns, end="\n")
+    profiling.report()
 
 
 if __name__ == "__main__":
@@ -6,9 +6,11 @@ import numpy as np
 import re
 
 from pymatgen.core import Structure
-from pymatgen.io.vasp import Poscar
 from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
 
+from poscar_writer import write_structure
+import profiling
+
 # Adopted format: level - current function name - mess. Width is fixed as visual aid
 c_log = logging.getLogger(__name__)
 std_format = '[%(levelname)5s - %(funcName)10s] %(message)s'
@@ -80,6 +82,7 @@ def cli_run(argv) -> None:
     parser.add_argument("-v", "--verbose", dest="verbose", action="store_true", help="Prints verbose output")
     parser.add_argument("-q", "--quiet", dest="quiet", action="store_true", help="Quietens the space group operations")
 
+    profiling.add_profile_argument(parser)
     args = parser.parse_args(argv)
 
     if args.debug:  # Always include method for switching verbosity
@@ -87,12 +90,16 @@ def cli_run(argv) -> None:
     if args.verbose:
         c_log.setLevel(logging.INFO)
     c_log.debug(args)
+    profiling.start(args.profile)
 
-    structure = Structure.from_file(args.poscar)
-    sg = symm_info(structure=structure)
+    with profiling.phase("parse"):
+        structure = Structure.from_file(args.poscar)
+    with profiling.phase("analyse"):
+        sg = symm_info(structure=structure)
 
     if not args.quiet:
-        print(operations_to_str(sg))
+        with profiling.phase("write"):
+            print(operations_to_str(sg))
 
     if args.sg:
         print(f"Crystal System: {sg.get_crystal_system()}\n"
@@ -101,13 +108,15 @@ def cli_run(argv) -> None:
               f"Space Group: {sg.get_space_group_number()}  {sg.get_space_group_symbol()}\n")
 
     if args.prim_cell:
-        print(Poscar(sg.get_primitive_standard_structure(), comment="HEADER: Primitive Cell"))
+        write_structure(sg.get_primitive_standard_structure(), comment="HEADER: Primitive Cell", end="\n")
     if args.conv_cell:
-        print(Poscar(sg.get_conventional_standard_structure(), comment="HEADER: Conventional Cell"))
+        write_structure(sg.get_conventional_standard_structure(), comment="HEADER: Conventional Cell", end="\n")
 
     if args.tm:
-        c_string = find_trans_matrix(big_cell=structure, min_cell=sg.get_primitive_standard_structure())
+        with profiling.phase("transform"):
+            c_string = find_trans_matrix(big_cell=structure, min_cell=sg.get_primitive_standard_structure())
         print(c_string)
+    profiling.report()
 
 
 if __name__ == "__main__":
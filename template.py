@@ -3,6 +3,8 @@
 
 import sys, argparse, logging
 
+import profiling
+
 # Adopted format: level - current function name - mess. Width is fixed as visual aid
 c_log = logging.getLogger(__name__)
 std_format = '[%(levelname)5s - %(funcName)10s] %(message)s'
@@ -33,6 +35,7 @@ def cli_run(argv) -> None:
     parser.add_argument("--optional", dest="optional", type=int, default=4, help="OptionalArgument")
     parser.add_argument("--debug", dest="debug", action="store_true")  # Always have the debug optional
     parser.add_argument("--verbose", dest="verbose", action="store_true")  # Always have the verbose optional
+    profiling.add_profile_argument(parser)  # --profile prints wall / cpu / peak RSS per phase
 
     args = parser.parse_args(argv)
 
@@ -40,8 +43,12 @@ def cli_run(argv) -> None:
         c_log.setLevel(logging.DEBUG)
     if args.verbose:
         c_log.setLevel(logging.INFO)
+    profiling.start(args.profile)
 
-    print(called_function(var_1=1, var_2=2, var_3=3))  # Writing to the CLI happens in cli run to separate pmg from cli
+    with profiling.phase("analyse"):  # Wrap the parse / analyse / write steps so --profile can see them
+        x = called_function(var_1=1, var_2=2, var_3=3)
+    print(x)  # Writing to the CLI happens in cli run to separate pmg from cli
+    profiling.report()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+SCF statistics on running / truncated runs, built from truncated copies of tests/OUTCAR
+"""
+
+import sys, os
+
+import numpy as np
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(TESTS_DIR))
+
+import energy_from_vasprun
+from energy_from_vasprun import read_scf, scf_statistics, flag_scf, scf_parameters, _scf_summary
+
+OSZICAR = """ N       E                     dE             d eps       ncg     rms          rms(c)
+DAV:   1    -0.100000000000E+02   -0.10000E+02   -0.10000E+02   100   0.100E+01
+DAV:   2    -0.110000000000E+02   -0.10000E+01   -0.10000E+01   100   0.100E+00
+   1 F= -.11000000E+02 E0= -.11000000E+02  d E =-.110000E+02
+DAV:   1    -0.112000000000E+02   -0.20000E+00   -0.20000E+00   100   0.100E+00
+"""
+
+
+@pytest.fixture(scope="module")
+def outcar_text():
+    with open(os.path.join(TESTS_DIR, "OUTCAR")) as f:
+        return f.read()
+
+
+def _write(folder, name, text):
+    os.makedirs(folder, exist_ok=True)
+    filename = os.path.join(folder, name)
+    with open(filename, "w") as f:
+        f.write(text)
+    return filename
+
+
+def test_no_complete_step(tmp_path, outcar_text):
+    """
+    Cut inside the first ionic step: no statistics, only the running step is reported
+    """
+    filename = _write(tmp_path, "OUTCAR", outcar_text[:outcar_text.index("free  energy   TOTEN")])
+    data = read_scf(filename)
+    stats = scf_statistics(data["scf_energies"], data["scf_offsets"], nelm=data["nelm"], ediff=data["ediff"])
+    assert len(stats["n_scf"]) == 0
+    assert stats["n_running"] == len(data["scf_energies"]) > 0
+    assert flag_scf(stats, nelm=data["nelm"])[0] == "no complete ionic steps"
+    assert flag_scf(stats, nelm=data["nelm"])[-1].startswith("running")
+
+
+def test_partial_second_step(tmp_path, outcar_text):
+    """
+    One complete ionic step followed by the first electronic steps of the next
+    """
+    end = outcar_text.index("\n", outcar_text.index("free  energy   TOTEN")) + 1
+    first_scf = outcar_text.index("free energy    TOTEN")
+    second_scf = outcar_text.index("free energy    TOTEN", first_scf + 1)
+    third_scf = outcar_text.index("free energy    TOTEN", second_scf + 1)
+    filename = _write(tmp_path, "OUTCAR", outcar_text[:end] + outcar_text[first_scf - 100:third_scf + 100])
+    data = read_scf(filename)
+    stats = scf_statistics(data["scf_energies"], data["scf_offsets"], nelm=data["nelm"], ediff=data["ediff"])
+    full = read_scf(os.path.join(TESTS_DIR, "OUTCAR"))
+    assert list(stats["n_scf"]) == [len(full["scf_energies"])]
+    assert stats["n_running"] == 3
+    assert flag_scf(stats, nelm=data["nelm"])[-1] == "running: 3 electronic steps into ionic step 1"
+
+
+def test_outcar_ediff():
+    data = read_scf(os.path.join(TESTS_DIR, "OUTCAR"))
+    assert (data["nelm"], data["ediff"]) == (60, 1e-5)
+
+
+def test_oszicar_parameters(tmp_path):
+    filename = _write(tmp_path, "OSZICAR", OSZICAR)
+    assert scf_parameters(filename) == (None, None)
+    data = read_scf(filename)
+    stats = scf_statistics(data["scf_energies"], data["scf_offsets"], nelm=data["nelm"], ediff=data["ediff"])
+    assert stats["converged"] is None and stats["hit_nelm"] is None and stats["n_running"] == 1
+    assert flag_scf(stats, nelm=data["nelm"]) == ["running: 1 electronic steps into ionic step 1"]
+
+    _write(tmp_path, "INCAR", "ENCUT = 520\nEDIFF = 1E-6  # tight\n# NELM = 10\n")
+    assert scf_parameters(filename) == (60, 1e-6)
+
+
+def test_summary_keeps_going(tmp_path, monkeypatch):
+    filename = _write(tmp_path, "OSZICAR", OSZICAR)
+
+    def broken(*args, **kwargs):
+        raise ValueError("broken")
+    monkeypatch.setattr(energy_from_vasprun, "scf_statistics", broken)
+    row = _scf_summary(filename)
+    assert row["n_ionic"] == 0 and row["flags"] == ["unreadable: ValueError"]
+
+
+def test_statistics_unchanged_when_complete():
+    e = np.array([-1.0, -1.1, -1.11, -2.0, -2.01])
+    stats = scf_statistics(e, [0, 3, 5], nelm=60, ediff=0.02)
+    assert list(stats["n_scf"]) == [3, 2] and stats["n_running"] == 0
+    assert list(stats["converged"]) == [True, True]
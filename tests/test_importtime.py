@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Import time checks for the bud-tools entry point and the streaming readers, run with python -m pytest tests.
+Set BUD_IMPORTTIME_BASELINE to a json saved by bud-tools importtime --save to also check against it.
+"""
+
+import sys, os, subprocess
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import bud_tools
+
+# Subcommands that only need numpy at import, pymatgen / pandas are imported where used
+LIGHT_MODULES = ["vasp_scan", "forces_from_vasprun", "energy_from_vasprun", "band_from_vasprun", "dos_from_vasprun",
+                 "export_trajectory", "chgcar_arith", "planar_average"]
+LIGHT_BUDGET = 1.0  # Seconds, generous so a cold cache passes but pulling pymatgen in (~1.5 s warm) does not
+HEAVY = ("pymatgen", "pandas", "scipy")
+
+
+def test_entry_budget():
+    assert bud_tools.import_time("bud_tools") < bud_tools.ENTRY_BUDGET
+
+
+@pytest.mark.parametrize("module", LIGHT_MODULES)
+def test_light_module_budget(module):
+    assert bud_tools.import_time(module) < LIGHT_BUDGET
+
+
+@pytest.mark.parametrize("module", ["bud_tools"] + LIGHT_MODULES)
+def test_no_heavy_imports(module):
+    code = f"import sys, {module}; print(' '.join(x for x in {HEAVY!r} if x in sys.modules))"
+    proc = subprocess.run([sys.executable, "-c", code], cwd=bud_tools.TOOLS_DIR, capture_output=True, text=True,
+                          check=True)
+    assert proc.stdout.split() == []
+
+
+@pytest.mark.skipif("BUD_IMPORTTIME_BASELINE" not in os.environ, reason="no BUD_IMPORTTIME_BASELINE to compare to")
+def test_baseline():
+    assert bud_tools.importtime_check(["bud_tools"] + LIGHT_MODULES, baseline=os.environ["BUD_IMPORTTIME_BASELINE"])
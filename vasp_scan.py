@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import sys, argparse, logging, mmap, os, re
+
+import numpy as np
+
+from compressed import compression, read_file
+import profiling
+
+# Adopted format: level - current function name - mess. Width is fixed as visual aid
+c_log = logging.getLogger(__name__)
+std_format = '[%(levelname)5s - %(funcName)10s] %(message)s'
+logging.basicConfig(format=std_format)
+c_log.setLevel(logging.WARNING)
+
+# Precompiled byte patterns, the ionic TOTEN has two spaces after free, the electronic one has one
+IONIC_TOTEN = re.compile(rb"free  energy   TOTEN\s+=\s+(\S+)\s+eV")
+SCF_TOTEN = re.compile(rb"free energy    TOTEN\s+=\s+(\S+)\s+eV")
+FORCE_BLOCK = re.compile(rb"TOTAL-FORCE \(eV/Angst\)[^\n]*\n\s*-+\s*\n(.*?)\n\s*-{10,}", re.S)
+NIONS = re.compile(rb"NIONS\s*=\s*(\d+)")
+OSZICAR_IONIC = re.compile(rb"^\s*\d+\s+F=\s*(\S+)\s+E0=\s*(\S+)", re.M)
+OSZICAR_SCF = re.compile(rb"^\s*(?:DAV|RMM|CG|SDA|DIA):\s*\d+\s+(\S+)", re.M)
+NELM = re.compile(rb"NELM\s*=\s*(\d+)")
+NSW = re.compile(rb"NSW\s*=\s*(\d+)")
+EDIFF = re.compile(rb"EDIFF\s*=\s*([-+.\dEe]+)")
+EFERMI = re.compile(rb"E-fermi :\s*(\S+)")
+JOB_DONE = b"General timing and accounting"
+REACHED_ACCURACY = b"reached required accuracy"
+
+
+def _map_file(filename: str):
+    """
+    Read only memory map of the file, empty files can't be mapped so return plain bytes instead.
+    Compressed files are decompressed into memory, the scans need the whole file anyway.
+    """
+    if compression(filename) is not None:
+        return read_file(filename)
+    with open(filename, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def scan_outcar(filename: str = "OUTCAR", electronic: bool = False) -> dict:
+    """
+    Byte level scan of an OUTCAR for ionic energies and forces without going through pymatgen's Outcar.
+    Truncated files are fine, only complete TOTEN / TOTAL-FORCE blocks are returned.
+
+    Returns a dict of:
+        energies: (n_ionic,) free energy TOTEN per ionic step
+        forces: (n_ionic, n_ions, 3) forces per ionic step
+        scf_energies / scf_offsets: (only if electronic) ragged electronic step energies,
+            scf_energies[scf_offsets[i]:scf_offsets[i + 1]] belong to ionic step i
+    """
+    buf = _map_file(filename)
+    try:
+        ionic = [(m.start(), float(m.group(1))) for m in IONIC_TOTEN.finditer(buf)]
+        energies = np.array([e for _, e in ionic], dtype=float)
+
+        n_ions = NIONS.search(buf)
+        blocks = [m.group(1) for m in FORCE_BLOCK.finditer(buf)]
+        if blocks:
+            flat = np.fromstring(b" ".join(blocks), sep=" ")  # One bulk conversion for every block
+            n_ions = int(n_ions.group(1)) if n_ions else len(blocks[0].splitlines())
+            forces = flat.reshape((len(blocks), n_ions, 6))[:, :, 3:]
+        else:
+            forces = np.zeros((0, int(n_ions.group(1)) if n_ions else 0, 3))
+
+        result = {"energies": energies, "forces": forces}
+        if electronic:
+            scf = [(m.start(), float(m.group(1))) for m in SCF_TOTEN.finditer(buf)]
+            scf_pos = np.array([p for p, _ in scf], dtype=np.int64)
+            ionic_pos = np.array([p for p, _ in ionic], dtype=np.int64)
+            result["scf_energies"] = np.array([e for _, e in scf], dtype=float)
+            result["scf_offsets"] = np.concatenate(([0], np.searchsorted(scf_pos, ionic_pos)))
+    finally:
+        if isinstance(buf, mmap.mmap):
+            buf.close()
+
+    c_log.debug(f"{filename}: {len(energies)} ionic energies, {len(forces)} force blocks")
+    if len(energies) != len(forces):
+        c_log.info(f"Energy / force block count mismatch ({len(energies)} vs {len(forces)}), file is likely truncated")
+    return result
+
+
+def scan_oszicar(filename: str = "OSZICAR", electronic: bool = False) -> dict:
+    """
+    Same idea as scan_outcar for an OSZICAR, which only holds energies.
+    energies are the F= values (free energy TOTEN), e0 the E0= values (sigma -> 0).
+    """
+    buf = _map_file(filename)
+    try:
+        ionic = [(m.start(), float(m.group(1)), float(m.group(2))) for m in OSZICAR_IONIC.finditer(buf)]
+        result = {"energies": np.array([x[1] for x in ionic], dtype=float),
+                  "e0": np.array([x[2] for x in ionic], dtype=float)}
+        if electronic:
+            scf = [(m.start(), float(m.group(1))) for m in OSZICAR_SCF.finditer(buf)]
+            scf_pos = np.array([p for p, _ in scf], dtype=np.int64)
+            ionic_pos = np.array([x[0] for x in ionic], dtype=np.int64)
+            result["scf_energies"] = np.array([e for _, e in scf], dtype=float)
+            result["scf_offsets"] = np.concatenate(([0], np.searchsorted(scf_pos, ionic_pos)))
+    finally:
+        if isinstance(buf, mmap.mmap):
+            buf.close()
+    return result
+
+
+def scan_status(filename: str = "OUTCAR") -> dict:
+    """
+    Cheap convergence flags from an OUTCAR: whether the job finished, whether the ionic loop reached EDIFFG
+    and whether the last ionic step needed fewer than NELM electronic steps. NELM / EDIFF / NSW are read from
+    the parameter header, VASP's defaults if it hasn't been written yet.
+    """
+    buf = _map_file(filename)
+    try:
+        nelm = NELM.search(buf)
+        nsw = NSW.search(buf)
+        ediff = EDIFF.search(buf)
+        nelm = int(nelm.group(1)) if nelm else 60
+        ediff = float(ediff.group(1)) if ediff else 1e-4
+        nsw = int(nsw.group(1)) if nsw else 0
+
+        last_ionic = buf.rfind(b"free  energy   TOTEN")
+        prev_ionic = buf.rfind(b"free  energy   TOTEN", 0, last_ionic) if last_ionic > 0 else -1
+        last_scf = len(SCF_TOTEN.findall(buf, max(prev_ionic, 0), max(last_ionic, 0))) if last_ionic > 0 else 0
+        completed = buf.find(JOB_DONE) != -1
+        status = {"completed": completed,
+                  "ionic_converged": buf.find(REACHED_ACCURACY) != -1 or (completed and nsw <= 1),
+                  "electronic_converged": 0 < last_scf < nelm,
+                  "nelm": nelm, "ediff": ediff, "nsw": nsw}
+    finally:
+        if isinstance(buf, mmap.mmap):
+            buf.close()
+    return status
+
+
+def scan_efermi(filename: str = "OUTCAR"):
+    """
+    Last Fermi energy printed in an OUTCAR, None if there is none yet
+    """
+    buf = _map_file(filename)
+    try:
+        last = buf.rfind(b"E-fermi :")
+        match = EFERMI.match(buf, last) if last != -1 else None
+        efermi = float(match.group(1)) if match else None
+    finally:
+        if isinstance(buf, mmap.mmap):
+            buf.close()
+    return efermi
+
+
+def scan_file(filename: str, electronic: bool = False) -> dict:
+    """
+    Picks the OUTCAR or OSZICAR scanner from the file name.
+    """
+    if "OSZICAR" in os.path.basename(filename):
+        return scan_oszicar(filename, electronic=electronic)
+    return scan_outcar(filename, electronic=electronic)
+
+
+def cli_run(argv) -> None:
+    """
+    Wrapper for the above command, handles parsing of args and logging, to avoid mess
+    """
+
+    global c_log
+
+    parser = argparse.ArgumentParser(description=scan_outcar.__doc__)  # Parser init
+    parser.add_argument("filename", type=str, default="OUTCAR", nargs="?", help="OUTCAR or OSZICAR location")
+    parser.add_argument("--debug", dest="debug", action="store_true")  # Always have the debug optional
+    parser.add_argument("--verbose", dest="verbose", action="store_true")  # Always have the verbose optional
+
+    profiling.add_profile_argument(parser)
+    args = parser.parse_args(argv)
+
+    if args.debug:  # Always include method for switching verbosity
+        c_log.setLevel(logging.DEBUG)
+    if args.verbose:
+        c_log.setLevel(logging.INFO)
+    c_log.debug(args)
+    profiling.start(args.profile)
+
+    with profiling.phase("parse"):
+        scan = scan_file(args.filename)
+    with profiling.phase("write"):
+        for step, energy in enumerate(scan["energies"]):
+            line = f"{step} {round(energy, 5)}"
+            if "forces" in scan and step < len(scan["forces"]):
+                line += f" {np.linalg.norm(scan['forces'][step], axis=1).max():.6f}"
+            print(line)
+    profiling.report()
+
+
+if __name__ == "__main__":
+    cli_run(sys.argv[1:])
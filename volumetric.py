@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import logging, os, mmap
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from compressed import compression, open_file
+
+# Adopted format: level - current function name - mess. Width is fixed as visual aid
+c_log = logging.getLogger(__name__)
+std_format = '[%(levelname)5s - %(funcName)10s] %(message)s'
+logging.basicConfig(format=std_format)
+c_log.setLevel(logging.WARNING)
+
+READ_BYTES = 1 << 24  # Largest raw read, about 1M values of a CHGCAR
+DEFAULT_CHUNK = 1 << 18  # Values handed out per chunk, 2 MB of float64
+FORMAT_BATCH = 1 << 16  # Values formatted per % call when writing, bounds the temporary tuple and string
+BYTES_PER_VALUE = 18  # " 0.61836412704E+03", reads are sized from the chunk with this
+PART_BYTES = 1 << 23  # Text per conversion task in parse_grid, bounds each thread's temporary
+THREAD_MIN_BYTES = 1 << 20  # Reads smaller than this aren't worth handing to threads
+
+
+def _is_int_line(line: bytes) -> bool:
+    return bool(line.split()) and all(x.lstrip(b"-").isdigit() for x in line.split())
+
+
+def read_header(f) -> dict:
+    """
+    Parses the POSCAR part of a CHGCAR / LOCPOT / ELFCAR from an open binary file, leaving f at the first grid value.
+    Returns the raw header bytes (everything before the grid line), the scaled lattice, species, counts,
+    fractional coordinates and grid.
+    """
+    lines = [f.readline() for _ in range(6)]
+    scale = float(lines[1].split()[0])
+    lattice = np.array([[float(x) for x in line.split()[:3]] for line in lines[2:5]])
+    if _is_int_line(lines[5]):  # VASP 4, no species line
+        species, counts = [], [int(x) for x in lines[5].split()]
+    else:
+        lines.append(f.readline())
+        species, counts = lines[5].decode().split(), [int(x) for x in lines[6].split()]
+    line = f.readline()
+    lines.append(line)
+    if line.strip()[:1] in (b"s", b"S"):  # Selective dynamics
+        line = f.readline()
+        lines.append(line)
+    cartesian = line.strip()[:1] in (b"c", b"C", b"k", b"K")
+    sites = [f.readline() for _ in range(sum(counts))]
+    lines.extend(sites)
+
+    line = f.readline()
+    while line and not _is_int_line(line):  # Blank separator line(s)
+        lines.append(line)
+        line = f.readline()
+    if not line:
+        raise ValueError("No grid dimensions found after the structure")
+
+    if scale < 0:  # Negative scale is the cell volume
+        scale = (-scale / abs(np.linalg.det(lattice))) ** (1 / 3)
+    coords = np.array([[float(x) for x in site.split()[:3]] for site in sites]).reshape((-1, 3))
+    if cartesian:
+        coords = coords * scale @ np.linalg.inv(lattice * scale)
+    grid = tuple(int(x) for x in line.split())
+    return {"header": b"".join(lines), "grid_line": line, "lattice": lattice * scale, "species": species,
+            "counts": counts, "frac_coords": coords, "grid": grid}
+
+
+def _line_bounds(buf, start: int, end: int, n_parts: int) -> list:
+    """
+    Byte offsets cutting buf[start:end] into about n_parts ranges of whole lines
+    """
+    bounds = [start]
+    for i in range(1, n_parts):
+        cut = buf.find(b"\n", max(start + (end - start) * i // n_parts, bounds[-1]), end) + 1
+        if cut > bounds[-1]:
+            bounds.append(cut)
+    if bounds[-1] < end:
+        bounds.append(end)
+    return bounds
+
+
+def parse_grid(buf, n_values: int, start: int = 0, end: int = None, threads: int = None) -> np.ndarray:
+    """
+    Converts the grid text buf[start:end] (bytes or an mmap) to n_values floats in parallel threads.
+    The text is cut into byte ranges at line boundaries, each range's place in the output follows from the line
+    counts before it (every line but the last holds the same number of values), and np.fromstring, which releases
+    the GIL, converts the ranges straight into one preallocated array.
+    Raises ValueError when the text doesn't hold exactly n_values in that layout.
+    """
+    end = len(buf) if end is None else end
+    threads = threads if threads else os.cpu_count() or 1
+    first = buf.find(b"\n", start, end)
+    per_line = len(buf[start:first if first != -1 else end].split())
+    if not per_line:
+        raise ValueError(f"No grid values at byte {start}")
+    bounds = _line_bounds(buf, start, end, max(threads, -(-(end - start) // PART_BYTES)))
+    out = np.empty(n_values)
+
+    def count_lines(i: int) -> int:
+        return int(np.count_nonzero(np.frombuffer(buf, np.uint8, bounds[i + 1] - bounds[i], bounds[i]) == 10))
+
+    def convert(i: int) -> None:
+        values = np.fromstring(buf[bounds[i]:bounds[i + 1]], sep=" ")
+        if len(values) != offsets[i + 1] - offsets[i]:
+            raise ValueError(f"{len(values)} values in bytes {bounds[i]}-{bounds[i + 1]}, "
+                             f"expected {offsets[i + 1] - offsets[i]}")
+        out[offsets[i]:offsets[i + 1]] = values
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        lines = list(pool.map(count_lines, range(len(bounds) - 1)))
+        if buf[end - 1:end] != b"\n":  # Unterminated last line
+            lines[-1] += 1
+        if sum(lines) != -(-n_values // per_line):
+            raise ValueError(f"{sum(lines)} lines of {per_line} values can't hold exactly {n_values} values")
+        offsets = [0] + [min(x, n_values) for x in np.cumsum(lines) * per_line]
+        list(pool.map(convert, range(len(bounds) - 1)))
+    return out
+
+
+class VolumetricFile:
+    """
+    Streaming reader for the grid blocks of a VASP volumetric file. Values come out in chunks of exactly the asked
+    size (the last one shorter) whatever the number of values per line, so chunks of several files line up.
+    Only a read buffer and one chunk are held, the 3D array is never built.
+    Grid order is VASP's: x fastest, then y, then z. Text is converted by parse_grid on threads threads
+    (default one per CPU). Compressed files are decompressed as they stream in.
+    """
+
+    def __init__(self, filename: str, threads: int = None):
+        self.filename = filename
+        self.threads = threads if threads else os.cpu_count() or 1
+        self.compressed = compression(filename) is not None
+        self.f = open_file(filename)
+        header = read_header(self.f)
+        self.header, self.grid_line = header["header"], header["grid_line"]
+        self.lattice, self.grid = header["lattice"], header["grid"]
+        self.species, self.counts = header["species"], header["counts"]
+        self.frac_coords = header["frac_coords"]
+        self.n_points = int(np.prod(self.grid))
+        self.block = 0
+        self._rest, self._pos = b"", 0  # Bytes read past the current point, _pos is how far into them we are
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self) -> None:
+        self.f.close()
+
+    def _read(self, size: int = READ_BYTES) -> bytes:
+        """
+        Whatever is buffered plus the next size bytes of the file
+        """
+        data = self._rest[self._pos:] + self.f.read(size)
+        self._rest, self._pos = b"", 0
+        return data
+
+    def _readline(self) -> bytes:
+        while self._rest.find(b"\n", self._pos) == -1:
+            more = self.f.read(READ_BYTES)
+            if not more:
+                line, self._rest, self._pos = self._rest[self._pos:], b"", 0
+                return line
+            self._rest, self._pos = self._rest[self._pos:] + more, 0
+        end = self._rest.find(b"\n", self._pos) + 1
+        line, self._pos = self._rest[self._pos:end], end
+        return line
+
+    def values(self, chunk: int = DEFAULT_CHUNK):
+        """
+        Generator over the current grid block in chunks of chunk values. Must be run to the end before next_block.
+        """
+        remaining = self.n_points
+        pending = np.zeros(0)
+        per_line = None
+        size = min(READ_BYTES, max(chunk, 1024) * BYTES_PER_VALUE)
+        while remaining > 0:
+            data = self._read(size)
+            if not data:
+                raise ValueError(f"{self.filename} ends {remaining} values short of block {self.block}")
+            if per_line is None:  # Taken from the first line, only the last line of a block may be shorter
+                per_line = len(data[:data.find(b"\n")].split())
+            lines_left = -(-remaining // per_line)
+            if data.count(b"\n") >= lines_left:  # Block ends in this read, what follows goes back to the buffer
+                self._rest = data.split(b"\n", lines_left)[-1]
+                body = data[:len(data) - len(self._rest)]
+            else:  # Whole lines only, unless this is an unterminated last line
+                cut = data.rfind(b"\n") + 1 or len(data)
+                body, self._rest = data[:cut], data[cut:]
+            if self.threads > 1 and len(body) > THREAD_MIN_BYTES:
+                n_lines = body.count(b"\n") + (not body.endswith(b"\n"))
+                parsed = parse_grid(body, min(n_lines * per_line, remaining), threads=self.threads)
+            else:
+                parsed = np.fromstring(body, sep=" ")[:remaining]
+            remaining -= len(parsed)
+            pending = np.concatenate((pending, parsed)) if len(pending) else parsed
+            while len(pending) >= chunk:
+                yield pending[:chunk]
+                pending = pending[chunk:]
+        if len(pending):
+            yield pending
+
+    def read_block(self) -> np.ndarray:
+        """
+        Whole current block as an (nx, ny, nz) array, for files small enough to hold.
+        The block is parsed in place from a memory map when its lines have a fixed width (as VASP and pymatgen
+        write them), which locates the block end without scanning, otherwise (and for compressed files) it is
+        read through values.
+        """
+        flat = None
+        if not self.compressed:
+            start = self.f.tell() - (len(self._rest) - self._pos)
+            with mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                first = buf.find(b"\n", start) + 1
+                per_line = len(buf[start:first].split())
+                if first and per_line:
+                    last = start + (-(-self.n_points // per_line) - 1) * (first - start)  # Start of the last line
+                    end = buf.find(b"\n", last) + 1 or len(buf)
+                    try:
+                        flat = parse_grid(buf, self.n_points, start, end, threads=self.threads)
+                    except ValueError as e:
+                        c_log.debug(f"Lines aren't fixed width, streaming instead: {e}")
+        if flat is None:
+            flat = np.concatenate(list(self.values()))
+        else:
+            self.f.seek(end)
+            self._rest, self._pos = b"", 0
+        return flat.reshape(self.grid[::-1]).transpose()
+
+    def next_block(self) -> bool:
+        """
+        Skips what follows the current block (augmentation occupancies, magnetic moments) up to the next grid line.
+        Returns False when there are no more blocks.
+        """
+        target = self.grid_line.split()
+        line = self._readline()
+        while line:
+            if line.split() == target:
+                self.block += 1
+                return True
+            line = self._readline()
+        return False
+
+
+def check_compatible(files, lattice_tol: float = 1e-4) -> None:
+    """
+    Raises ValueError unless every file has the same grid and (within lattice_tol Angstrom) the same lattice
+    """
+    reference = files[0]
+    for other in files[1:]:
+        if other.grid != reference.grid:
+            raise ValueError(f"Grid mismatch: {reference.filename} {reference.grid} vs {other.filename} {other.grid}")
+        if not np.allclose(other.lattice, reference.lattice, atol=lattice_tol):
+            raise ValueError(f"Lattice mismatch between {reference.filename} and {other.filename}:\n"
+                             f"{reference.lattice}\n{other.lattice}")
+
+
+def format_values(values: np.ndarray, per_line: int = 5) -> str:
+    """
+    Grid values as VASP lays them out, per_line to a line, formatted in one % call
+    """
+    n_full = len(values) // per_line * per_line
+    line = " %17.11E" * per_line + "\n"
+    text = (line * (n_full // per_line)) % tuple(values[:n_full].tolist())
+    if n_full < len(values):
+        text += (" %17.11E" * (len(values) - n_full)) % tuple(values[n_full:].tolist()) + "\n"
+    return text
+
+
+class VolumetricWriter:
+    """
+    Incremental writer: header and grid line, then chunks of values as they come. Values that don't fill a line
+    are carried to the next chunk so the output has whole lines of per_line values.
+    """
+
+    def __init__(self, filename: str, header: bytes, grid_line: bytes, per_line: int = 5):
+        self.f = open(filename, "w")
+        self.header = header.decode()
+        self.grid_line = grid_line.decode()
+        self.per_line = per_line
+        self._carry = np.zeros(0)
+        self.f.write(self.header)
+        self.f.write(self.grid_line)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, values: np.ndarray) -> None:
+        values = np.concatenate((self._carry, values)) if len(self._carry) else values
+        n_full = len(values) // self.per_line * self.per_line
+        batch = FORMAT_BATCH // self.per_line * self.per_line
+        for start in range(0, n_full, batch):
+            self.f.write(format_values(values[start:min(start + batch, n_full)], self.per_line))
+        self._carry = values[n_full:]
+
+    def end_block(self) -> None:
+        if len(self._carry):
+            self.f.write(format_values(self._carry, self.per_line))
+        self._carry = np.zeros(0)
+
+    def new_block(self) -> None:
+        """
+        Starts another block (i.e the magnetisation after the total), separated the way pymatgen writes it
+        """
+        self.end_block()
+        self.f.write("\n" + self.grid_line)
+
+    def close(self) -> None:
+        self.end_block()
+        self.f.close()